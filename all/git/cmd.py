@@ -6,6 +6,7 @@
 
 from contextlib import contextmanager
 import io
+from itertools import islice
 import logging
 import os
 import signal
@@ -1090,6 +1091,50 @@ class Git(LazyMixin):
         hexsha, typename, size = self.__get_object_header(cmd, ref)
         return (hexsha, typename, size, self.CatFileContentStream(size, cmd.stdout))
 
+    def iter_object_data(self, refs, batch_size=64):
+        """ As get_object_data, but for many refs. They are written to the persistent
+        command in batches, ahead of reading the results, which saves a round trip
+        per object.
+
+        :param refs: iterable of refs, which is consumed lazily
+        :param batch_size: amount of refs to request at once. All requests of a batch
+            have to fit into the pipe to the command, which is at least 4096 bytes
+        :return: iterator yielding (hexsha, type_string, size_as_int, data_string)
+            for each ref, in order
+        :raise ValueError: once the results for a ref which could not be resolved
+            are reached
+        :note: not threadsafe. All results of a batch are read before they are
+            yielded, which allows to use the command while the iterator is suspended"""
+        cmd = self._get_persistent_cmd("cat_file_all", "cat_file", batch=True)
+        refs = iter(refs)
+        while True:
+            batch = list(islice(refs, batch_size))
+            if not batch:
+                break
+            cmd.stdin.write(b''.join(self._prepare_ref(ref) for ref in batch))
+            cmd.stdin.flush()
+
+            # read all results to keep the command in sync, even if some failed
+            results = list()
+            for _ in batch:
+                try:
+                    hexsha, typename, size = self._parse_object_header(cmd.stdout.readline())
+                except ValueError as err:
+                    results.append(err)
+                    continue
+                # END handle unresolved refs
+                data = cmd.stdout.read(size)
+                cmd.stdout.read(1)      # the terminating newline
+                results.append((hexsha, typename, size, data))
+            # END for each ref in batch
+
+            for result in results:
+                if isinstance(result, ValueError):
+                    raise result
+                yield result
+            # END for each result
+        # END for each batch
+
     def clear_cache(self):
         """Clear all kinds of internal caches to release resources.
 
@@ -12,6 +12,8 @@ import inspect
 import logging
 import os
 import re
+import threading
+import time
 
 from git.compat import (
     string_types,
@@ -19,7 +21,6 @@ from git.compat import (
     defenc,
     force_text,
     with_metaclass,
-    PY3
 )
 from git.odict import OrderedDict
 from git.util import LockFile
@@ -40,6 +41,106 @@ __all__ = ('GitConfigParser', 'SectionConstraint')
 log = logging.getLogger('git.config')
 log.addHandler(logging.NullHandler())
 
+# Parsed configuration files shared by all parsers of this process, mapping their paths
+# to tuple(stat_key, layer), with the least recently used file first. Layers are never
+# changed, parsers copy their values.
+_layer_cache = OrderedDict()
+_layer_cache_lock = threading.Lock()
+# maximum amount of files in the cache
+_layer_cache_size = 256
+# files changed less than this amount of seconds ago are not cached, as they might be
+# changed again without changing their stat information
+_racy_seconds = 2
+
+
+# escape sequences git knows within values, others are kept as they are
+_value_escapes = {'\\': '\\', '"': '"', 'n': '\n', 't': '\t', 'b': '\b'}
+_re_value_escape = re.compile(r'\\(.)')
+
+
+def _replace_escape(match):
+    return _value_escapes.get(match.group(1), match.group(0))
+
+
+def _ends_with_escape(value):
+    """:return: True if value ends with a backslash which isn't escaped itself"""
+    return (len(value) - len(value.rstrip('\\'))) % 2 == 1
+
+
+def _unescape_value(value):
+    """:return: value with its escape sequences replaced, and its trailing backslash
+        removed, which continues it on the next line"""
+    if _ends_with_escape(value):
+        value = value[:-1]
+    if '\\' in value:
+        value = _re_value_escape.sub(_replace_escape, value)
+    return value
+
+
+def _wildmatch(pattern, ignore_case=False):
+    """:return: compiled regex matching paths like git matches them against the given glob
+        pattern, where * and ? don't match slashes, and ** matches any amount of directories"""
+    out = list()
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith('**/', i):
+            out.append('(?:.*/)?')
+            i += 3
+        elif pattern.startswith('**', i):
+            out.append('.*')
+            i += 2
+        elif pattern[i] in '*?':
+            out.append(pattern[i] == '*' and '[^/]*' or '[^/]')
+            i += 1
+        elif pattern[i] == '[' and pattern.find(']', i + 2) != -1:
+            end = pattern.find(']', i + 2)
+            chars = pattern[i + 1:end]
+            if chars[0] in '!^':
+                chars = '^' + chars[1:]
+            out.append('[%s]' % chars.replace('\\', '\\\\'))
+            i = end + 1
+        else:
+            out.append(re.escape(pattern[i]))
+            i += 1
+        # END handle pattern character
+    # END for each character
+    return re.compile(''.join(out) + r'\Z', ignore_case and re.IGNORECASE or 0)
+
+
+def _stat_key(st):
+    """:return: tuple identifying the state of a file by its stat result"""
+    return (st.st_ino, st.st_size, getattr(st, 'st_mtime_ns', st.st_mtime))
+
+
+def _cached_layer(path, key):
+    """:return: the parsed layer of the file at path if it was cached with the given key,
+        or None"""
+    with _layer_cache_lock:
+        entry = _layer_cache.pop(path, None)
+        if entry is None or entry[0] != key:
+            return None
+        # reinsert to mark it as recently used
+        _layer_cache[path] = entry
+    # END with lock
+    return entry[1]
+
+
+def _cache_layer(path, key, layer):
+    """Keep the given layer of the file at path, until the file changes"""
+    with _layer_cache_lock:
+        _layer_cache.pop(path, None)
+        _layer_cache[path] = (key, layer)
+        while len(_layer_cache) > _layer_cache_size:
+            _layer_cache.popitem(last=False)
+        # END drop least recently used
+    # END with lock
+
+
+def _uncache_layer(path):
+    """Forget the parsed layer of the file at path, if there is one"""
+    with _layer_cache_lock:
+        _layer_cache.pop(path, None)
+
 
 class MetaParserBuilder(abc.ABCMeta):
 
@@ -159,6 +260,10 @@ class GitConfigParser(with_metaclass(MetaParserBuilder, cp.RawConfigParser, obje
     The configuration file will be locked if you intend to change values preventing other
     instances to write concurrently.
 
+    Files are parsed only once per process as long as their stat information doesn't
+    change. All parsers copy the values of the shared parsed files, so changing them
+    doesn't affect other parsers.
+
     :note:
         The config is case-sensitive even when queried, hence section and option names
         must match perfectly.
@@ -181,10 +286,27 @@ class GitConfigParser(with_metaclass(MetaParserBuilder, cp.RawConfigParser, obje
 
     del optvalueonly_source
 
+    # matches the names of conditional include sections
+    re_include_if = re.compile(r'^includeIf\s+"(gitdir|gitdir/i|onbranch):(.+)"$')
+
+    # classifies a line of a configuration file by the name of the last group it matches.
+    # Names and values have surrounding whitespace removed.
+    re_config_line = re.compile(r'''
+        ^(?:
+            (?P<rem>[rR][eE][mM](?:[^\S\n].*)?)                           # remarks, not indented
+          | [^\S\n]*(?:
+                (?P<comment>(?:[#;].*)?)                                 # comments, blank lines
+              | \[(?P<header>.+)\].*                                     # section headers
+              | (?P<option>[^:=\s](?:[^:=\n]*[^:=\s])?)[^\S\n]*[:=][^\S\n]*(?P<value>(?:.*\S)?)
+              | (?P<invalid>[:=].*)                                      # options without name
+              | (?P<novalue>.*)                                          # options without value
+            )
+        )[^\S\n]*$''', re.MULTILINE | re.VERBOSE)
+
     # list of RawConfigParser methods able to change the instance
     _mutating_methods_ = ("add_section", "remove_section", "remove_option", "set")
 
-    def __init__(self, file_or_files, read_only=True, merge_includes=True):
+    def __init__(self, file_or_files, read_only=True, merge_includes=True, repo=None):
         """Initialize a configuration reader to read the given file_or_files and to
         possibly allow changes to it by setting read_only False
 
@@ -199,7 +321,10 @@ class GitConfigParser(with_metaclass(MetaParserBuilder, cp.RawConfigParser, obje
         :param merge_includes: if True, we will read files mentioned in [include] sections and merge their
             contents into ours. This makes it impossible to write back an individual configuration file.
             Thus, if you want to modify a single configuration file, turn this off to leave the original
-            dataset unaltered when reading it."""
+            dataset unaltered when reading it.
+        :param repo: the Repo whose git directory and active branch are matched against the
+            conditions of [includeIf] sections. If None, or if this isn't a read-only instance,
+            these sections are ignored."""
         cp.RawConfigParser.__init__(self, dict_type=OrderedDict)
 
         # Used in python 3, needs to stay in sync with sections for underlying implementation to work
@@ -211,6 +336,8 @@ class GitConfigParser(with_metaclass(MetaParserBuilder, cp.RawConfigParser, obje
         self._dirty = False
         self._is_initialized = False
         self._merge_includes = merge_includes
+        self._repo = repo
+        self._include_if_origins = dict()   # includeIf section -> list of paths of files containing it
         self._lock = None
         self._acquire_lock()
 
@@ -272,106 +399,186 @@ class GitConfigParser(with_metaclass(MetaParserBuilder, cp.RawConfigParser, obje
         return optionstr
 
     def _read(self, fp, fpname):
-        """A direct copy of the py2.4 version of the super class's _read method
-        to assure it uses ordered dicts. Had to change one line to make it work.
+        """Read the configuration from the given file object and merge it into ours"""
+        layer, e = self._parse_layer(fp, fpname)
+        self._merge_layer(layer)
+        if e:
+            raise e
 
-        Future versions have this fixed, but in fact its quite embarrassing for the
-        guys not to have done it right in the first place !
+    def _parse_layer(self, fp, fpname):
+        """Parse the configuration in the given binary file object in a single pass,
+        classifying its lines with re_config_line.
 
-        Removed big comments to make it more compact.
+        Leading whitespace is ignored as git uses tabs. Values are kept as they are written,
+        including quotes, unless their quotes are not closed on the same line. Then they
+        continue up to the line ending with a quote, and escape sequences in them are
+        replaced. Values ending with a backslash continue on the following line as well.
 
-        Made sure it ignores initial whitespace as git uses tabs"""
+        :return: tuple(layer, error) of an ordered dict mapping the names of all sections
+            in the file to ordered dicts of their options, and the ParsingError about
+            invalid lines, or None"""
+        sections = self._dict()
         cursect = None                            # None, or a dictionary
         optname = None
-        lineno = 0
-        is_multi_line = False
+        continuation = None                       # None, or the character continuing a value
         e = None                                  # None, or an exception
-
-        def string_decode(v):
-            if v[-1] == '\\':
-                v = v[:-1]
-            # end cut trailing escapes to prevent decode error
-
-            if PY3:
-                return v.encode(defenc).decode('unicode_escape')
-            else:
-                return v.decode('string_escape')
-            # end
-        # end
-
-        while True:
-            # we assume to read binary !
-            line = fp.readline().decode(defenc)
-            if not line:
-                break
-            lineno = lineno + 1
+        optionxform = self.optionxform
+        # we assume to read binary !
+        text = fp.read().decode(defenc)
+
+        for mo in self.re_config_line.finditer(text):
+            kind = mo.lastgroup
+            if kind == 'value' and continuation is None and cursect is not None:
+                optname, optval = mo.group('option', 'value')
+                optname = optionxform(optname)
+                if optval.startswith('"'):
+                    if optval == '""':
+                        optval = ''
+                    elif len(optval) > 1 and optval[-1] != '"':
+                        continuation = '"'
+                        optval = _unescape_value(optval[1:])
+                    # end handle multi-line
+                else:
+                    if ';' in optval:
+                        pos = optval.find(';')
+                        if optval[pos - 1].isspace():
+                            optval = optval[:pos].rstrip()
+                    # end cut comment
+                    if optval.endswith('\\') and _ends_with_escape(optval):
+                        continuation = '\\'
+                        optval = optval[:-1]
+                    # end handle continuation
+                # END handle quoted value
+                cursect[optname] = optval
             # comment or blank line?
-            if line.strip() == '' or self.re_comment.match(line):
-                continue
-            if line.split(None, 1)[0].lower() == 'rem' and line[0] in "rR":
-                # no leading whitespace
+            elif kind == 'comment' or kind == 'rem':
                 continue
-
-            # is it a section header?
-            mo = self.SECTCRE.match(line.strip())
-            if not is_multi_line and mo:
-                sectname = mo.group('header').strip()
-                if sectname in self._sections:
-                    cursect = self._sections[sectname]
-                elif sectname == cp.DEFAULTSECT:
-                    cursect = self._defaults
+            elif continuation is not None:
+                value = mo.group().rstrip()
+                if continuation == '"':
+                    if value.endswith('"'):
+                        continuation = None
+                        value = value[:-1]
+                    # end handle quotations
+                    value = _unescape_value(value)
+                elif _ends_with_escape(value):
+                    value = value[:-1]
                 else:
-                    cursect = self._dict((('__name__', sectname),))
-                    self._sections[sectname] = cursect
-                    self._proxies[sectname] = None
+                    continuation = None
+                # END handle continuation type
+                cursect[optname] += value
+            elif kind == 'header':
+                sectname = mo.group('header').strip()
+                cursect = sections.get(sectname)
+                if cursect is None:
+                    cursect = sections[sectname] = self._dict((('__name__', sectname),))
                 # So sections can't start with a continuation line
                 optname = None
             # no section header in the file?
             elif cursect is None:
-                raise cp.MissingSectionHeaderError(fpname, lineno, line)
-            # an option line?
-            elif not is_multi_line:
-                mo = self.OPTCRE.match(line)
-                if mo:
-                    # We might just have handled the last line, which could contain a quotation we want to remove
-                    optname, vi, optval = mo.group('option', 'vi', 'value')
-                    if vi in ('=', ':') and ';' in optval and not optval.strip().startswith('"'):
-                        pos = optval.find(';')
-                        if pos != -1 and optval[pos - 1].isspace():
-                            optval = optval[:pos]
-                    optval = optval.strip()
-                    if optval == '""':
-                        optval = ''
-                    # end handle empty string
-                    optname = self.optionxform(optname.rstrip())
-                    if len(optval) > 1 and optval[0] == '"' and optval[-1] != '"':
-                        is_multi_line = True
-                        optval = string_decode(optval[1:])
-                    # end handle multi-line
-                    cursect[optname] = optval
-                else:
-                    # check if it's an option with no value - it's just ignored by git
-                    if not self.OPTVALUEONLY.match(line):
-                        if not e:
-                            e = cp.ParsingError(fpname)
-                        e.append(lineno, repr(line))
-                    continue
+                raise cp.MissingSectionHeaderError(fpname, text.count('\n', 0, mo.start()) + 1, mo.group())
+            elif kind == 'invalid':
+                if not e:
+                    e = cp.ParsingError(fpname)
+                e.append(text.count('\n', 0, mo.start()) + 1, repr(mo.group()))
+            # options without value are just ignored by git
+            # END handle line type
+        # END for each line
+
+        return sections, e
+
+    def _merge_layer(self, layer, config_path=None):
+        """Merge the sections of the given layer into ours, without changing the layer
+
+        :param config_path: path of the file the layer was read from, if known"""
+        for sectname, options in layer.items():
+            if sectname.startswith('includeIf'):
+                self._include_if_origins.setdefault(sectname, list()).append(config_path)
+            # END remember where conditional includes came from
+            if sectname == cp.DEFAULTSECT:
+                self._defaults.update((k, v) for k, v in options.items() if k != '__name__')
+            elif sectname in self._sections:
+                self._sections[sectname].update(options)
             else:
-                line = line.rstrip()
-                if line.endswith('"'):
-                    is_multi_line = False
-                    line = line[:-1]
-                # end handle quotations
-                cursect[optname] += string_decode(line)
-            # END parse section or option
-        # END while reading
-
-        # if any parsing errors occurred, raise an exception
+                self._sections[sectname] = self._dict(options)
+                self._proxies[sectname] = None
+            # END handle section
+        # END for each section
+
+    def _read_path(self, file_path):
+        """Read the configuration file at the given path, which is parsed only if it
+        changed since any parser of this process read it
+
+        :raise IOError: if the file cannot be read"""
+        with open(file_path, 'rb') as fp:
+            st = os.fstat(fp.fileno())
+            key = _stat_key(st)
+            layer = _cached_layer(file_path, key)
+            if layer is not None:
+                self._merge_layer(layer, file_path)
+                return
+            # END handle cached layer
+            layer, e = self._parse_layer(fp, fp.name)
+        # END with file
+
+        self._merge_layer(layer, file_path)
         if e:
             raise e
+        if st.st_mtime < time.time() - _racy_seconds:
+            _cache_layer(file_path, key, layer)
+        # END cache unless it may change unnoticed
 
     def _has_includes(self):
-        return self._merge_includes and self.has_section('include')
+        return self._merge_includes and bool(self._included_paths())
+
+    def _included_paths(self):
+        """:return: list of the paths in the [include] section, and in [includeIf] sections
+            whose condition is met"""
+        paths = list()
+        for section in self._sections:
+            if section != 'include':
+                mo = self.re_include_if.match(section)
+                if mo is None:
+                    continue
+                # gitdir conditions starting with ./ are relative to the file containing the section
+                if not any(self._include_condition_met(mo.group(1), mo.group(2), config_path)
+                           for config_path in self._include_if_origins.get(section, (None,))):
+                    continue
+            # END check condition
+            paths.extend(value for _, value in self.items(section))
+        # END for each section
+        return paths
+
+    def _include_condition_met(self, keyword, pattern, config_path):
+        """:return: True if the condition of an [includeIf] section is met by our repository"""
+        repo = self._repo
+        if repo is None or not self._read_only:
+            return False
+
+        if keyword == 'onbranch':
+            try:
+                subject = repo.active_branch.name
+            except TypeError:
+                # detached head
+                return False
+            # END handle missing branch
+        else:
+            if pattern.startswith('~/'):
+                pattern = osp.expanduser(pattern)
+            elif pattern.startswith('./'):
+                if config_path is None:
+                    return False
+                pattern = osp.join(osp.dirname(config_path), pattern[2:])
+            # END handle relative pattern
+            pattern = pattern.replace('\\', '/')
+            if not osp.isabs(pattern):
+                pattern = '**/' + pattern
+            subject = repo.git_dir.replace('\\', '/')
+        # END handle keyword
+
+        if pattern.endswith('/'):
+            pattern += '**'
+        return _wildmatch(pattern, keyword == 'gitdir/i').match(subject) is not None
 
     def read(self):
         """Reads the data stored in the files we have been initialized with. It will
@@ -401,16 +608,15 @@ class GitConfigParser(with_metaclass(MetaParserBuilder, cp.RawConfigParser, obje
             else:
                 # assume a path if it is not a file-object
                 try:
-                    with open(file_path, 'rb') as fp:
-                        file_ok = True
-                        self._read(fp, fp.name)
+                    self._read_path(file_path)
+                    file_ok = True
                 except IOError:
                     continue
 
             # Read includes and append those that we didn't handle yet
             # We expect all paths to be normalized and absolute (and will assure that is the case)
-            if self._has_includes():
-                for _, include_path in self.items('include'):
+            if self._merge_includes:
+                for include_path in self._included_paths():
                     if include_path.startswith('~'):
                         include_path = osp.expanduser(include_path)
                     if not osp.isabs(include_path):
@@ -487,6 +693,7 @@ class GitConfigParser(with_metaclass(MetaParserBuilder, cp.RawConfigParser, obje
         if not hasattr(fp, "seek"):
             with open(self._file_or_files, "wb") as fp:
                 self._write(fp)
+            _uncache_layer(self._file_or_files)
         else:
             fp.seek(0)
             # make sure we do not overwrite into an existing file
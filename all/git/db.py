@@ -1,4 +1,6 @@
 """Module with our own gitdb implementation - it uses the git command"""
+from io import BytesIO
+
 from git.util import bin_to_hex, hex_to_bin
 from gitdb.base import (
     OInfo,
@@ -42,6 +44,14 @@ class GitCmdObjectDB(LooseObjectDB):
         hexsha, typename, size, stream = self._git.stream_object_data(bin_to_hex(sha))
         return OStream(hex_to_bin(hexsha), typename, size, stream)
 
+    def stream_many(self, shas):
+        """:return: iterator yielding an OStream for each of the given binary shas, in
+            order. All objects are read through a single pipelined git command
+        :param shas: iterable of binary shas, which is consumed lazily"""
+        for hexsha, typename, size, data in self._git.iter_object_data(bin_to_hex(sha) for sha in shas):
+            yield OStream(hex_to_bin(hexsha), typename, size, BytesIO(data))
+        # END for each object
+
     # { Interface
 
     def partial_to_complete_sha_hex(self, partial_hexsha):
@@ -3,7 +3,11 @@
 #
 # This module is part of GitPython and is released under
 # the BSD License: http://www.opensource.org/licenses/bsd-license.php
+from bisect import bisect_left, bisect_right
+from collections import deque
 import re
+from stat import S_IFMT, S_ISLNK, S_ISREG
+from zlib import crc32
 
 from git.cmd import handle_process_output
 from git.compat import (
@@ -35,6 +39,25 @@ def _octal_repl(matchobj):
     return value
 
 
+def _iter_nul_separated(stream, chunk_size=64 * 1024):
+    """:return: iterator yielding the NUL separated fields read from the given stream,
+        as soon as they are complete"""
+    read = getattr(stream, 'read1', stream.read)
+    rest = b''
+    while True:
+        chunk = read(chunk_size)
+        if not chunk:
+            break
+        fields = (rest + chunk).split(b'\0')
+        rest = fields.pop()
+        for field in fields:
+            yield field
+        # END for each complete field
+    # END for each chunk
+    if rest:
+        yield rest
+
+
 def decode_path(path, has_ab_prefix=True):
     if path == b'/dev/null':
         return None
@@ -116,9 +139,45 @@ class Diffable(object):
         else:
             args.append("--raw")
 
+        proc = self._diff_process(other, paths, args, kwargs)
+
+        diff_method = (Diff._index_from_patch_format
+                       if create_patch
+                       else Diff._index_from_raw_format)
+        index = diff_method(self.repo, proc)
+
+        proc.wait()
+        return index
+
+    def iter_diff(self, other=Index, paths=None, numstat=False, **kwargs):
+        """Like ``diff`` without patches, but yields the Diffs one by one while they
+        are read from git, instead of collecting them into a DiffIndex first.
+
+        :param numstat:
+            If True, the amount of inserted and deleted lines will be set on each Diff,
+            or -1 for binary files. As git lists all changes before their line
+            counts, the first Diff is only yielded once all changes were read.
+
+        :return: iterator yielding Diff instances
+        :note: see ``diff`` for all other parameters"""
+        args = ["--abbrev=40", "--full-index", "-M", "--raw", "-z"]
+        if numstat:
+            args.append("--numstat")
+        # END handle numstat
+
+        proc = self._diff_process(other, paths, args, kwargs)
+        return Diff._iter_from_raw_z_format(self.repo, proc, numstat)
+
+    def _diff_process(self, other, paths, args, kwargs):
+        """:return: git-diff or git-diff-tree process comparing us with other, run with
+            the given format args and kwargs. See ``diff`` for all parameters"""
         # in any way, assure we don't see colored output,
         # fixes https://github.com/gitpython-developers/GitPython/issues/172
         args.append('--no-color')
+        # git passes options given as kwargs first, where -M would override them
+        if kwargs.get('no_renames') and '-M' in args:
+            args.remove('-M')
+        # END handle disabled renames
 
         if paths is not None and not isinstance(paths, (tuple, list)):
             paths = [paths]
@@ -144,15 +203,7 @@ class Diffable(object):
         # END paths handling
 
         kwargs['as_process'] = True
-        proc = diff_cmd(*self._process_diff_args(args), **kwargs)
-
-        diff_method = (Diff._index_from_patch_format
-                       if create_patch
-                       else Diff._index_from_raw_format)
-        index = diff_method(self.repo, proc)
-
-        proc.wait()
-        return index
+        return diff_cmd(*self._process_diff_args(args), **kwargs)
 
 
 class DiffIndex(list):
@@ -196,6 +247,201 @@ class DiffIndex(list):
                 yield diff
         # END for each diff
 
+    def find_renames(self, threshold=50, copies=False, max_processes=None):
+        """Detect renamed and possibly copied files without invoking git diff -M.
+
+        Deleted files are paired with added ones having the same blob first. The
+        remaining ones are compared by the chunks of their contents, like git does,
+        where only files whose sizes allow them to reach the threshold are compared.
+
+        :param threshold: minimum similarity in percent for files to be considered renamed
+        :param copies: if True, added files may also be copies of modified files, or of
+            deleted files which were renamed already
+        :param max_processes: amount of processes to compute the contents' signatures with.
+            If None or below 2, they are computed in the calling process. Only pass more
+            if the repository is large enough to make up for starting the processes.
+        :return: new DiffIndex, in which pairs of deleted and added files are replaced
+            with a Diff having a rename_from and rename_to, and with change type
+            'R' followed by the similarity. Copies have change type 'C', and a_path
+            is set to the path they were copied from"""
+        sources = [d for d in self if d.deleted_file and _is_file_blob(d.a_blob)]
+        destinations = [d for d in self if d.new_file and _is_file_blob(d.b_blob)]
+        copy_sources = list()
+        if copies:
+            copy_sources = [d for d in self if _is_file_blob(d.a_blob) and d.b_blob is not None and
+                            not d.deleted_file]
+        # END handle copy sources
+        if not (sources or copy_sources) or not destinations:
+            return DiffIndex(self)
+        # END handle nothing to pair
+
+        pairs = dict()      # id(destination) -> tuple(source, score, is_rename)
+        renamed = set()     # ids of sources used by a rename
+
+        # exact renames, and copies of unchanged contents
+        by_binsha = dict()
+        copied_binsha = dict()
+        for source in sources:
+            by_binsha.setdefault((source.a_blob.binsha, S_IFMT(source.a_mode)), list()).append(source)
+        # END for each source
+        for source in copy_sources:
+            copied_binsha.setdefault((source.a_blob.binsha, S_IFMT(source.a_mode)), source)
+        # END for each copy source
+        for dest in destinations:
+            key = (dest.b_blob.binsha, S_IFMT(dest.b_mode))
+            candidates = by_binsha.get(key)
+            if candidates:
+                source = candidates.pop(0)
+                pairs[id(dest)] = (source, 100, True)
+                renamed.add(id(source))
+                if copies:
+                    # further destinations with the same contents are copies of it
+                    copied_binsha.setdefault(key, source)
+                # END handle copies of renamed files
+            elif key in copied_binsha:
+                pairs[id(dest)] = (copied_binsha[key], 100, False)
+            # END handle exact match
+        # END for each destination
+
+        # inexact renames and copies, compared by signature
+        dests = [d for d in destinations if id(d) not in pairs]
+        srcs = [s for s in sources if copies or id(s) not in renamed] + copy_sources
+        if dests and srcs:
+            signatures = self._blob_signatures([s.a_blob for s in srcs] + [d.b_blob for d in dests],
+                                               max_processes)
+            srcs = [(signatures[s.a_blob.binsha][0], i, s) for i, s in enumerate(srcs)
+                    if signatures[s.a_blob.binsha][0]]
+            srcs.sort(key=lambda item: item[:2])
+            src_sizes = [item[0] for item in srcs]
+
+            scores = list()
+            for dest_index, dest in enumerate(dests):
+                size, sig = signatures[dest.b_blob.binsha]
+                if not size:
+                    continue
+                # the similarity cannot be larger than the ratio of both sizes
+                lo = bisect_left(src_sizes, size * threshold // 100)
+                hi = bisect_right(src_sizes, size * 100 // max(threshold, 1))
+                for src_size, src_index, source in srcs[lo:hi]:
+                    if S_IFMT(source.a_mode) != S_IFMT(dest.b_mode):
+                        continue
+                    score = similarity(signatures[source.a_blob.binsha][1], src_size, sig, size)
+                    if score >= threshold:
+                        scores.append((-score, dest_index, src_index, source))
+                # END for each candidate
+            # END for each destination
+
+            # assign the best matches first, each destination once
+            scores.sort(key=lambda item: item[:3])
+            for neg_score, dest_index, src_index, source in scores:
+                dest = dests[dest_index]
+                if id(dest) in pairs:
+                    continue
+                is_rename = source.deleted_file and id(source) not in renamed
+                if source.deleted_file and not (is_rename or copies):
+                    continue
+                # END handle source renamed already
+                pairs[id(dest)] = (source, -neg_score, is_rename)
+                if is_rename:
+                    renamed.add(id(source))
+            # END for each score
+        # END handle inexact matches
+
+        index = DiffIndex()
+        for diff in self:
+            if diff.deleted_file and id(diff) in renamed:
+                continue
+            pair = pairs.get(id(diff))
+            if pair is None:
+                index.append(diff)
+                continue
+            # END handle unpaired diff
+            source, score, is_rename = pair
+            a_blob, b_blob = source.a_blob, diff.b_blob
+            index.append(Diff(a_blob.repo, source.a_rawpath, diff.b_rawpath, a_blob.hexsha, b_blob.hexsha,
+                              '%o' % source.a_mode, '%o' % diff.b_mode, False, False,
+                              source.a_rawpath if is_rename else None, diff.b_rawpath if is_rename else None,
+                              '', '%s%03i' % (is_rename and 'R' or 'C', score)))
+        # END for each diff
+        return index
+
+    def _blob_signatures(self, blobs, max_processes):
+        """:return: dict mapping the binsha of each given blob to tuple(size, signature)"""
+        unique = list(dict((b.binsha, b) for b in blobs).values())
+        if not max_processes or max_processes < 2:
+            out = dict()
+            for blob in unique:
+                data = blob.data_stream.read()
+                out[blob.binsha] = (len(data), blob_signature(data))
+            # END for each blob
+            return out
+        # END handle single process
+
+        from multiprocessing import Pool
+        pool = Pool(max_processes, _init_signature_worker, (unique[0].repo.working_dir, ))
+        try:
+            results = pool.map(_signature_of_hexsha, [b.hexsha for b in unique], chunksize=16)
+        finally:
+            pool.terminate()
+        # END assure processes are stopped
+        return dict((b.binsha, result) for b, result in zip(unique, results))
+
+
+#{ Similarity
+
+# chunks of blobs compared during rename detection end at a newline, or after 64 bytes
+_chunk_re = re.compile(b'[^\n]{0,63}\n|[^\n]{1,64}')
+
+# git process of each worker process computing signatures
+_signature_git = None
+
+
+def blob_signature(data):
+    """:return: dict mapping the checksum of each chunk of the given blob data to the
+        amount of bytes in chunks with that checksum, as used by git to estimate the
+        similarity of blobs"""
+    sig = dict()
+    get = sig.get
+    for chunk in _chunk_re.findall(data):
+        key = crc32(chunk)
+        sig[key] = get(key, 0) + len(chunk)
+    # END for each chunk
+    return sig
+
+
+def similarity(a_sig, a_size, b_sig, b_size):
+    """:return: similarity of two blobs in percent, based on their signatures and sizes,
+        being the amount of bytes they have in common relative to the larger one"""
+    if len(a_sig) > len(b_sig):
+        a_sig, b_sig = b_sig, a_sig
+    get = b_sig.get
+    common = 0
+    for key, count in a_sig.items():
+        other = get(key)
+        if other is not None:
+            common += min(count, other)
+    # END for each chunk
+    return common * 100 // max(a_size, b_size, 1)
+
+
+def _is_file_blob(blob):
+    """:return: True if blob is a file or symlink, which may have been renamed"""
+    return blob is not None and (S_ISREG(blob.mode) or S_ISLNK(blob.mode))
+
+
+def _init_signature_worker(working_dir):
+    global _signature_git
+    from git.cmd import Git
+    _signature_git = Git(working_dir)
+
+
+def _signature_of_hexsha(hexsha):
+    """:return: tuple(size, signature) of the blob with the given hexsha, read by our worker's git"""
+    data = _signature_git.get_object_data(hexsha)[3]
+    return len(data), blob_signature(data)
+
+#} END similarity
+
 
 class Diff(object):
 
@@ -251,11 +497,11 @@ class Diff(object):
 
     __slots__ = ("a_blob", "b_blob", "a_mode", "b_mode", "a_rawpath", "b_rawpath",
                  "new_file", "deleted_file", "raw_rename_from", "raw_rename_to",
-                 "diff", "change_type")
+                 "diff", "change_type", "insertions", "deletions")
 
     def __init__(self, repo, a_rawpath, b_rawpath, a_blob_id, b_blob_id, a_mode,
                  b_mode, new_file, deleted_file, raw_rename_from,
-                 raw_rename_to, diff, change_type):
+                 raw_rename_to, diff, change_type, insertions=None, deletions=None):
 
         self.a_mode = a_mode
         self.b_mode = b_mode
@@ -292,6 +538,10 @@ class Diff(object):
         self.diff = diff
         self.change_type = change_type
 
+        # line counts, only known if requested from git
+        self.insertions = insertions
+        self.deletions = deletions
+
     def __eq__(self, other):
         for name in self.__slots__:
             if getattr(self, name) != getattr(other, name):
@@ -501,3 +751,64 @@ class Diff(object):
         handle_process_output(proc, handle_diff_line, None, finalize_process, decode_streams=False)
 
         return index
+
+    @classmethod
+    def _iter_from_raw_z_format(cls, repo, proc, numstat=False):
+        """Parse the output of the given process, which must be in raw format with NUL
+        separated fields, as produced by --raw -z, possibly followed by --numstat output.
+        :return: iterator yielding Diff instances as soon as they are complete"""
+        # handles
+        # :100644 100644 687099101... 37c5e30c8... M\0.gitignore\0
+        # :100644 100644 687099101... 37c5e30c8... R086\0old\0new\0
+        # 3\t1\t.gitignore\0
+        # 3\t1\t\0old\0new\0
+        # other fields, like the commit sha printed by diff-tree --root, are skipped
+        fields = _iter_nul_separated(proc.stdout)
+        pending = deque()
+        for field in fields:
+            if field.startswith(b':'):
+                old_mode, new_mode, a_blob_id, b_blob_id, change_type = field[1:].decode('ascii').split(None, 4)
+                a_path = b_path = next(fields)
+                deleted_file = False
+                new_file = False
+                rename_from = None
+                rename_to = None
+
+                # NOTE: We cannot conclude from the existence of a blob to change type
+                # as diffs with the working do not have blobs yet
+                if change_type == 'D':
+                    b_blob_id = None
+                    deleted_file = True
+                elif change_type == 'A':
+                    a_blob_id = None
+                    new_file = True
+                elif change_type[0] in 'RC':    # parses RXXX or CXXX, where XXX is a confidence value
+                    b_path = next(fields)
+                    if change_type[0] == 'R':
+                        rename_from, rename_to = a_path, b_path
+                # END add/remove handling
+
+                diff = Diff(repo, a_path, b_path, a_blob_id, b_blob_id, old_mode, new_mode,
+                            new_file, deleted_file, rename_from, rename_to, '', change_type)
+                if numstat:
+                    pending.append(diff)
+                else:
+                    yield diff
+            elif numstat and b'\t' in field:
+                insertions, deletions, path = field.split(b'\t', 2)
+                if not path:
+                    # renamed or copied file, followed by both paths
+                    next(fields)
+                    next(fields)
+                # END skip paths
+                diff = pending.popleft()
+                diff.insertions = -1 if insertions == b'-' else int(insertions)
+                diff.deletions = -1 if deletions == b'-' else int(deletions)
+                yield diff
+            # END handle field type
+        # END for each field
+
+        for diff in pending:
+            yield diff
+        # END yield diffs without line counts
+        finalize_process(proc)
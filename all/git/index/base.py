@@ -4,11 +4,10 @@
 # This module is part of GitPython and is released under
 # the BSD License: http://www.opensource.org/licenses/bsd-license.php
 import glob
-from io import BytesIO
+from multiprocessing import cpu_count
 import os
-from stat import S_ISLNK
+from stat import S_ISLNK, S_IFMT
 import subprocess
-import sys
 import tempfile
 
 from git.compat import (
@@ -40,9 +39,9 @@ from git.util import (
     file_contents_ro,
     to_native_path_linux,
     unbare_repo,
-    to_bin_sha
+    to_bin_sha,
+    bin_to_hex
 )
-from gitdb.base import IStream
 from gitdb.db import MemoryDB
 
 import git.diff as diff
@@ -51,18 +50,28 @@ import os.path as osp
 from .fun import (
     entry_key,
     write_cache,
+    write_cache_from_map,
     read_cache,
+    read_extensions,
+    read_cache_tree,
+    write_cache_tree,
     aggressive_tree_merge,
     write_tree_from_cache,
     stat_mode_to_index_mode,
     S_IFGITLINK,
-    run_commit_hook
+    run_commit_hook,
+    store_path,
+    working_tree_changes,
+    index_tree_changes
 )
 from .typ import (
     BaseIndexEntry,
     IndexEntry,
+    IndexEntryMap,
+    CE_EXTENDED_SHIFT,
 )
 from .util import (
+    pack,
     TemporaryFileSwap,
     post_clear_cache,
     default_index,
@@ -95,8 +104,10 @@ class IndexFile(LazyMixin, diff.Diffable, Serializable):
 
     Make sure you use index.write() once you are done manipulating the index directly
     before operating on it using the git command"""
-    __slots__ = ("repo", "version", "entries", "_extension_data", "_file_path")
+    __slots__ = ("repo", "version", "entries", "_extension_data", "_file_path", "_cache_tree")
     _VERSION = 2            # latest version we support
+    _PARALLEL_STAT_THRESHOLD = 5000     # entries to compare with the working tree before using threads
+    _PARALLEL_STORE_THRESHOLD = 100     # files to add before storing them using threads
     S_IFGITLINK = S_IFGITLINK  # a submodule
 
     def __init__(self, repo, file_path=None):
@@ -109,6 +120,7 @@ class IndexFile(LazyMixin, diff.Diffable, Serializable):
         self.version = self._VERSION
         self._extension_data = b''
         self._file_path = file_path or self._index_path()
+        self._cache_tree = None
 
     def _set_cache_(self, attr):
         if attr == "entries":
@@ -128,12 +140,11 @@ class IndexFile(LazyMixin, diff.Diffable, Serializable):
                     lfd.rollback()
             # END exception handling
 
-            # Here it comes: on windows in python 2.5, memory maps aren't closed properly
-            # Hence we are in trouble if we try to delete a file that is memory mapped,
-            # which happens during read-tree.
-            # In this case, we will just read the memory in directly.
-            # Its insanely bad ... I am disappointed !
-            allow_mmap = (is_win or sys.version_info[1] > 5)
+            # Entries are unpacked from the index data on demand, and unchanged ones are
+            # written by copying their data, which keeps it alive as long as our entries.
+            # On windows, a memory map would prevent the index file from being replaced,
+            # so we read its contents instead.
+            allow_mmap = not is_win
             stream = file_contents_ro(fd, stream=True, allow_mmap=allow_mmap)
 
             try:
@@ -166,19 +177,63 @@ class IndexFile(LazyMixin, diff.Diffable, Serializable):
 
     def _deserialize(self, stream):
         """Initialize this instance with index values read from the given stream"""
-        self.version, self.entries, self._extension_data, conten_sha = read_cache(stream)  # @UnusedVariable
+        self.version, entries, self._extension_data, conten_sha = read_cache(stream, lazy=True)  # @UnusedVariable
+        self.entries = entries
+
+        # the cache tree is only valid as long as it belongs to our entries
+        self._cache_tree = None
+        for signature, data in read_extensions(self._extension_data):
+            if signature == b"TREE":
+                self._cache_tree = (entries, read_cache_tree(data))
+                entries.changed_paths = set()
+        # END for each extension
         return self
 
+    def _get_cache_tree(self):
+        """:return: root CacheTree matching our current entries, or None if there is none.
+            All paths changed since the cache tree was read are invalidated."""
+        entries = self.entries
+        if self._cache_tree is None or self._cache_tree[0] is not entries:
+            return None
+        cache_tree = self._cache_tree[1]
+        for path in entries.changed_paths:
+            cache_tree.invalidate(path)
+        entries.changed_paths.clear()
+        return cache_tree
+
+    def _extension_data_for_entries(self):
+        """:return: our extension data with the TREE extension matching our current entries.
+            It is removed if we cannot know whether it represents our entries."""
+        extensions = read_extensions(self._extension_data)
+        if not any(signature == b"TREE" for signature, data in extensions):
+            return self._extension_data
+        # END handle no cache tree
+
+        cache_tree = self._get_cache_tree()
+        out = list()
+        for signature, data in extensions:
+            if signature == b"TREE":
+                if cache_tree is None:
+                    continue
+                data = write_cache_tree(cache_tree)
+            # END handle cache tree
+            out.append(signature + pack(">L", len(data)) + data)
+        # END for each extension
+        return b''.join(out)
+
     def _entries_sorted(self):
         """:return: list of entries, in a sorted fashion, first by path, then by stage"""
         return sorted(self.entries.values(), key=lambda e: (e.path, e.stage))
 
     def _serialize(self, stream, ignore_extension_data=False):
-        entries = self._entries_sorted()
-        extension_data = self._extension_data
-        if ignore_extension_data:
-            extension_data = None
-        write_cache(entries, stream, extension_data)
+        extension_data = None
+        if not ignore_extension_data:
+            extension_data = self._extension_data_for_entries()
+        # entries we read and didn't change are copied instead of being serialized again
+        if isinstance(self.entries, IndexEntryMap):
+            write_cache_from_map(self.entries, stream, extension_data)
+        else:
+            write_cache(self._entries_sorted(), stream, extension_data)
         return self
 
     #} END serializable interface
@@ -193,15 +248,12 @@ class IndexFile(LazyMixin, diff.Diffable, Serializable):
             the one you gave.
 
         :param ignore_extension_data:
-            If True, the TREE type extension data read in the index will not
+            If True, the extension data read in the index will not
             be written to disk. NOTE that no extension data is actually written.
-            Use this if you have altered the index and
-            would like to use git-write-tree afterwards to create a tree
-            representing your written changes.
-            If this data is present in the written index, git-write-tree
-            will instead write the stored/cached tree.
-            Alternatively, use IndexFile.write_tree() to handle this case
-            automatically
+            Otherwise, the TREE type extension will be invalidated for all entries
+            changed through the entries dictionary, or dropped if the entries
+            dictionary was replaced, so git-write-tree will not write a stale
+            cached tree.
 
         :return: self"""
         # make sure we have our entries read before getting a write lock
@@ -276,7 +328,7 @@ class IndexFile(LazyMixin, diff.Diffable, Serializable):
             New IndexFile instance. Its path will be undefined.
             If you intend to write such a merged Index, supply an alternate file_path
             to its 'write' method."""
-        base_entries = aggressive_tree_merge(repo.odb, [to_bin_sha(str(t)) for t in tree_sha])
+        base_entries = aggressive_tree_merge(repo.odb, [to_bin_sha(str(t)) for t in tree_sha], repo.tree_cache)
 
         inst = cls(repo)
         # convert to entries dict
@@ -543,7 +595,9 @@ class IndexFile(LazyMixin, diff.Diffable, Serializable):
         # If we are a new index, the entries access will load our data accordingly
         mdb = MemoryDB()
         entries = self._entries_sorted()
-        binsha, tree_items = write_tree_from_cache(entries, mdb, slice(0, len(entries)))
+        # subtrees which didn't change since the cache tree was written are reused
+        binsha, tree_items = write_tree_from_cache(entries, mdb, slice(0, len(entries)),
+                                                   cache_tree=self._get_cache_tree(), tree_odb=self.repo.odb)
 
         # copy changed trees only
         mdb.stream_copy(mdb.sha_iter(), self.repo.odb)
@@ -554,6 +608,140 @@ class IndexFile(LazyMixin, diff.Diffable, Serializable):
         root_tree._cache = tree_items
         return root_tree
 
+    @unbare_repo
+    def iter_working_tree_changes(self, paths=None, max_threads=None):
+        """Compare this index with the working tree without invoking git. Files are
+        only read if their stat data indicates they might have changed.
+
+        :param paths:
+            list of repository relative paths to files or directories to limit the
+            comparison to, or None to compare all entries. Paths are normalized, hence
+            './dir' is the same as 'dir', and '.' compares all entries. Pathspecs like
+            globs are not supported.
+        :param max_threads:
+            amount of threads to stat and hash files with. If None, large indices are
+            compared using one thread per CPU, and small ones in the calling thread.
+        :return:
+            Iterator yielding a Diff for each changed path as it is found. The working
+            tree side has no blob. Unmerged paths are yielded once with change_type 'U'.
+            Entries marked assume-unchanged or skip-worktree are not compared.
+        :note:
+            Unlike ``diff(None)``, which runs git-diff, submodules are only checked for
+            their existence, and filters or line ending conversions are not applied to
+            file contents. Files converted that way may hence be reported as modified."""
+        root = self.repo.working_tree_dir
+        try:
+            racy_mtime = int(os.stat(self._file_path).st_mtime)
+        except OSError:
+            racy_mtime = None
+        # END handle missing index file
+
+        if paths is not None:
+            paths = [to_native_path_linux(osp.normpath(self._to_relative_path(p))) for p in paths]
+            if '.' in paths:
+                paths = None
+            # END the working tree's root includes all entries
+        # END handle paths
+
+        directories = dict()
+        unmerged = set()
+        for entry in self._entries_sorted():
+            if paths is not None and not any(entry.path == p or entry.path.startswith(p + '/') for p in paths):
+                continue
+            if entry.stage != 0:
+                if entry.path not in unmerged:
+                    unmerged.add(entry.path)
+                    yield self._working_tree_diff(entry, 'U', None)
+                continue
+            # END handle unmerged entries
+            directories.setdefault(entry.path.rpartition('/')[0], list()).append(entry)
+        # END for each entry
+        directories = list(mviter(directories))
+
+        if max_threads is None and sum(len(d) for d in directories) > self._PARALLEL_STAT_THRESHOLD:
+            max_threads = cpu_count()
+        # END auto-select thread count
+
+        compare = lambda entries: working_tree_changes(root, entries, racy_mtime)
+        if not max_threads or max_threads < 2:
+            results = map(compare, directories)
+            pool = None
+        else:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(max_threads)
+            results = pool.imap(compare, directories)
+        # END setup threads
+
+        try:
+            for changes in results:
+                for entry, change_type, st in changes:
+                    yield self._working_tree_diff(entry, change_type, st)
+                # END for each change
+            # END for each directory
+        finally:
+            if pool is not None:
+                pool.terminate()
+        # END assure threads are stopped
+
+    def _working_tree_diff(self, entry, change_type, st):
+        """:return: Diff between the given entry and its file in the working tree"""
+        rawpath = force_bytes(entry.path, encoding=defenc)
+        a_blob_id = a_mode = b_mode = None
+        if change_type != 'U':
+            a_blob_id = entry.hexsha
+            a_mode = '%o' % entry.mode
+        if st is not None:
+            b_mode = '%o' % stat_mode_to_index_mode(st.st_mode)
+        elif change_type == 'D':
+            b_mode = '000000'
+        # END handle modes
+        return diff.Diff(self.repo, rawpath, rawpath, a_blob_id, None, a_mode, b_mode,
+                         False, change_type == 'D', None, None, '', change_type)
+
+    def _diff_tree(self, other):
+        """:return: DiffIndex of the changes between our entries and the given Tree or Commit,
+            the way ``diff`` reports them, or None if git has to compute it"""
+        if other.type == 'commit':
+            tree = other.tree
+        elif other.type == 'tree':
+            tree = other
+        else:
+            return None
+        # END get tree
+
+        cache_tree = self._get_cache_tree()
+        if cache_tree is not None and cache_tree.valid and cache_tree.binsha == tree.binsha:
+            return diff.DiffIndex()
+        # END handle unchanged index
+
+        entries = self._entries_sorted()
+        if any(e.stage or e[2] >> CE_EXTENDED_SHIFT for e in entries):
+            return None
+        # END let git handle unmerged and intent-to-add entries
+
+        changes = index_tree_changes(self.repo.odb, entries, tree.binsha, cache_tree, self.repo.tree_cache)
+        if any(e is None for p, e, t in changes) and any(t is None for p, e, t in changes):
+            return None
+        # END let git detect renames
+
+        index = diff.DiffIndex()
+        for path, entry, tree_entry in changes:
+            rawpath = force_bytes(path, encoding=defenc)
+            if tree_entry is None:
+                index.append(diff.Diff(self.repo, rawpath, rawpath, entry.hexsha, None, '%o' % entry.mode, '000000',
+                                       False, True, None, None, '', 'D'))
+            elif entry is None:
+                index.append(diff.Diff(self.repo, rawpath, rawpath, None, bin_to_hex(tree_entry[0]).decode('ascii'),
+                                       '000000', '%o' % tree_entry[1], True, False, None, None, '', 'A'))
+            else:
+                change_type = 'M' if S_IFMT(entry.mode) == S_IFMT(tree_entry[1]) else 'T'
+                index.append(diff.Diff(self.repo, rawpath, rawpath, entry.hexsha,
+                                       bin_to_hex(tree_entry[0]).decode('ascii'), '%o' % entry.mode,
+                                       '%o' % tree_entry[1], False, False, None, None, '', change_type))
+            # END handle change type
+        # END for each change
+        return index
+
     def _process_diff_args(self, args):
         try:
             args.pop(args.index(self))
@@ -594,22 +782,50 @@ class IndexFile(LazyMixin, diff.Diffable, Serializable):
     def _store_path(self, filepath, fprogress):
         """Store file at filepath in the database and return the base index entry
         Needs the git_working_dir decorator active ! This must be assured in the calling code"""
-        st = os.lstat(filepath)     # handles non-symlinks as well
-        if S_ISLNK(st.st_mode):
-            # in PY3, readlink is string, but we need bytes. In PY2, it's just OS encoded bytes, we assume UTF-8
-            open_stream = lambda: BytesIO(force_bytes(os.readlink(filepath), encoding=defenc))
-        else:
-            open_stream = lambda: open(filepath, 'rb')
-        with open_stream() as stream:
-            fprogress(filepath, False, filepath)
-            istream = self.repo.odb.store(IStream(Blob.type, st.st_size, stream))
-            fprogress(filepath, True, filepath)
+        fprogress(filepath, False, filepath)
+        st, binsha = store_path(self.repo.odb, filepath)
+        fprogress(filepath, True, filepath)
         return BaseIndexEntry((stat_mode_to_index_mode(st.st_mode),
-                               istream.binsha, 0, to_native_path_linux(filepath)))
+                               binsha, 0, to_native_path_linux(filepath)))
+
+    def _store_paths(self, filepaths, fprogress, max_threads=None):
+        """Store all files at the given filepaths in the database, using multiple threads
+        if there are many of them.
+        Needs the git_working_dir decorator active ! This must be assured in the calling code
+
+        :param max_threads: amount of threads to use, or None to use one per CPU for
+            large amounts of files
+        :return: list of base index entries in the order of filepaths"""
+        if max_threads is None and len(filepaths) >= self._PARALLEL_STORE_THRESHOLD:
+            max_threads = cpu_count()
+        if not max_threads or max_threads < 2:
+            return [self._store_path(filepath, fprogress) for filepath in filepaths]
+        # END handle serial storage
+
+        # worker threads must not depend on the current working directory
+        root = self.repo.working_tree_dir
+        odb = self.repo.odb
+        store = lambda filepath: store_path(odb, osp.join(root, filepath))
+
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(max_threads)
+        entries = list()
+        try:
+            # results come in the order of their paths, which keeps the index deterministic
+            for filepath, (st, binsha) in izip(filepaths, pool.imap(store, filepaths)):
+                fprogress(filepath, False, filepath)
+                entries.append(BaseIndexEntry((stat_mode_to_index_mode(st.st_mode),
+                                               binsha, 0, to_native_path_linux(filepath))))
+                fprogress(filepath, True, filepath)
+            # END for each stored path
+        finally:
+            pool.terminate()
+        # END assure threads are stopped
+        return entries
 
     @unbare_repo
     @git_working_dir
-    def _entries_for_paths(self, paths, path_rewriter, fprogress, entries):
+    def _entries_for_paths(self, paths, path_rewriter, fprogress, entries, max_threads=None):
         entries_added = list()
         if path_rewriter:
             for path in paths:
@@ -632,14 +848,12 @@ class IndexFile(LazyMixin, diff.Diffable, Serializable):
 
         # HANDLE PATHS
         assert len(entries_added) == 0
-        for filepath in self._iter_expand_paths(paths):
-            entries_added.append(self._store_path(filepath, fprogress))
-        # END for each filepath
+        entries_added.extend(self._store_paths(list(self._iter_expand_paths(paths)), fprogress, max_threads))
         # END path handling
         return entries_added
 
     def add(self, items, force=True, fprogress=lambda *args: None, path_rewriter=None,
-            write=True, write_extension_data=False):
+            write=True, write_extension_data=False, max_threads=None):
         """Add files from the working tree, specific blobs or BaseIndexEntries
         to the index.
 
@@ -705,6 +919,8 @@ class IndexFile(LazyMixin, diff.Diffable, Serializable):
             item is set to the actual item we handle, either a Path or a BaseIndexEntry
             Please note that the processed path is not guaranteed to be present
             in the index already as the index is currently being processed.
+            If paths are stored by multiple threads, progress is reported in order
+            once their objects were written.
 
         :param path_rewriter:
             Function with signature (string) func(BaseIndexEntry) function returning a path
@@ -720,16 +936,21 @@ class IndexFile(LazyMixin, diff.Diffable, Serializable):
             the changes only exist in memory and are not available to git commands.
 
         :param write_extension_data:
-            If True, extension data will be written back to the index. This can lead to issues in case
-            it is containing the 'TREE' extension, which will cause the `git commit` command to write an
-            old tree, instead of a new one representing the now changed index.
-            This doesn't matter if you use `IndexFile.commit()`, which ignores the `TREE` extension altogether.
-            You should set it to True if you intend to use `IndexFile.commit()` exclusively while maintaining
+            If True, extension data will be written back to the index. The 'TREE' extension is
+            invalidated for all added paths, so `git commit` and `IndexFile.commit()` only reuse
+            cached trees which are unaffected by the change.
+            You should set it to True if you intend to commit repeatedly with large indices, or to maintain
             support for third-party extensions. Besides that, you can usually safely ignore the built-in
             extensions when using GitPython on repositories that are not handled manually at all.
             All current built-in extensions are listed here:
             http://opensource.apple.com/source/Git/Git-26/src/git-htmldocs/technical/index-format.txt
 
+        :param max_threads:
+            Amount of threads to hash, compress and store files with. If None, one
+            thread per CPU is used when adding many files. Files are streamed into the
+            object database, so memory usage is bounded no matter their size. The
+            resulting index is the same no matter how many threads are used.
+
         :return:
             List(BaseIndexEntries) representing the entries just actually added.
 
@@ -747,7 +968,7 @@ class IndexFile(LazyMixin, diff.Diffable, Serializable):
         # That way, we are OK on a bare repository as well.
         # If there are no paths, the rewriter has nothing to do either
         if paths:
-            entries_added.extend(self._entries_for_paths(paths, path_rewriter, fprogress, entries))
+            entries_added.extend(self._entries_for_paths(paths, path_rewriter, fprogress, entries, max_threads))
 
         # HANDLE ENTRIES
         if entries:
@@ -763,9 +984,10 @@ class IndexFile(LazyMixin, diff.Diffable, Serializable):
             if null_entries_indices:
                 @git_working_dir
                 def handle_null_entries(self):
-                    for ei in null_entries_indices:
+                    new_entries = self._store_paths([entries[ei].path for ei in null_entries_indices],
+                                                    fprogress, max_threads)
+                    for ei, new_entry in izip(null_entries_indices, new_entries):
                         null_entry = entries[ei]
-                        new_entry = self._store_path(null_entry.path, fprogress)
 
                         # update null entry
                         entries[ei] = BaseIndexEntry(
@@ -1221,6 +1443,9 @@ class IndexFile(LazyMixin, diff.Diffable, Serializable):
         :note:
             Will only work with indices that represent the default git index as
             they have not been initialized with a stream.
+        :note:
+            Diffs against a Tree or Commit without paths, patches or kwargs are computed
+            in-process from our entries, unless they could contain renames.
         """
         # index against index is always empty
         if other is self.Index:
@@ -1233,6 +1458,12 @@ class IndexFile(LazyMixin, diff.Diffable, Serializable):
             other = self.repo.rev_parse(other)
         # END object conversion
 
+        if isinstance(other, Object) and not (paths or create_patch or kwargs):
+            index = self._diff_tree(other)
+            if index is not None:
+                return index
+        # END handle in-process diff
+
         if isinstance(other, Object):
             # invert the existing R flag
             cur_val = kwargs.get('R', False)
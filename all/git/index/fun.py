@@ -1,7 +1,9 @@
 # Contains standalone functions to accompany the index implementation and make it
 # more versatile
 # NOTE: Autodoc hates it if this is a docstring
+from array import array
 from io import BytesIO
+import mmap
 import os
 from stat import (
     S_IFDIR,
@@ -16,12 +18,15 @@ import subprocess
 from git.cmd import PROC_CREATIONFLAGS, handle_process_output
 from git.compat import (
     PY3,
+    byte_ord,
     defenc,
     force_text,
     force_bytes,
     is_posix,
+    is_win,
     safe_encode,
     safe_decode,
+    xrange,
 )
 from git.exc import (
     UnmergedEntriesError,
@@ -29,32 +34,55 @@ from git.exc import (
 )
 from git.objects.fun import (
     tree_to_stream,
+    iter_trees_recursive,
     traverse_tree_recursive,
-    traverse_trees_recursive
+    _tree_entries
 )
 from git.util import IndexFileSHA1Writer, finalize_process
 from gitdb.base import IStream
-from gitdb.typ import str_tree_type
+from gitdb.fun import loose_object_header
+from gitdb.util import make_sha
+from gitdb.typ import str_blob_type, str_tree_type
 
 import os.path as osp
 
 from .typ import (
     BaseIndexEntry,
+    CacheTree,
     IndexEntry,
+    IndexEntryMap,
     CE_NAMEMASK,
-    CE_STAGESHIFT
+    CE_STAGEMASK,
+    CE_STAGESHIFT,
+    CE_EXTENDED,
+    CE_EXTENDED_SHIFT,
+    CE_VALID,
+    CE_SKIP_WORKTREE
 )
 from .util import (
-    pack,
-    unpack
+    unpack,
+    Struct
 )
 
 
 S_IFGITLINK = S_IFLNK | S_IFDIR     # a submodule
+scandir = getattr(os, 'scandir', None)
 CE_NAMEMASK_INV = ~CE_NAMEMASK
 
-__all__ = ('write_cache', 'read_cache', 'write_tree_from_cache', 'entry_key',
-           'stat_mode_to_index_mode', 'S_IFGITLINK', 'run_commit_hook', 'hook_path')
+#{ Index file layout
+# header: signature, version, number of entries
+_header = Struct(">4sLL")
+# entry: ctime, mtime, dev, ino, mode, uid, gid, size, sha, flags
+_entry = Struct(">8s8sLLLLLL20sH")
+_entry_flags = Struct(">H")
+_entry_path_offset = _entry.size
+_extension_header = Struct(">4sL")
+#} END index file layout
+
+__all__ = ('write_cache', 'write_cache_from_map', 'read_cache', 'read_extensions', 'read_cache_tree',
+           'write_cache_tree', 'write_tree_from_cache', 'entry_key', 'stat_mode_to_index_mode', 'compare_stat',
+           'hash_path', 'store_path', 'working_tree_changes', 'index_tree_changes', 'S_IFGITLINK',
+           'run_commit_hook', 'hook_path')
 
 
 def hook_path(name, git_dir):
@@ -108,6 +136,296 @@ def stat_mode_to_index_mode(mode):
     return S_IFREG | 0o644 | (mode & 0o111)       # blobs with or without executable bit
 
 
+def compare_stat(entry, st, racy_mtime=None):
+    """Compare the stat data of an index entry with the result of an lstat call on
+    its file in the working tree, the way git does to avoid reading file contents.
+
+    :param entry: IndexEntry to compare
+    :param st: result of ``os.lstat`` for the entry's path
+    :param racy_mtime: modification time of the index file in seconds since epoch.
+        Files modified within the same second the index was written may have changed
+        without their stat data telling, and need their contents to be compared.
+        If None, stat data is never trusted.
+    :return:
+        * None if the entry is unchanged
+        * 'T' if the type of the entry changed, i.e. from file to symlink
+        * 'M' if the entry changed its mode or size
+        * 'S' if the contents have to be compared as the stat data differs"""
+    index_mode = stat_mode_to_index_mode(st.st_mode)
+    if S_IFMT(index_mode) != S_IFMT(entry[0]):
+        return 'T'
+    if S_IFMT(index_mode) == S_IFGITLINK:
+        return None
+    # END handle submodules
+    if not is_win and index_mode != entry[0]:
+        return 'M'
+    # END handle executable bit, which is unreliable on windows
+    size = entry[10]
+    if size and size != st.st_size & 0xffffffff:
+        return 'M'
+    # END handle size, which is null in entries not written by git
+
+    mtime, mtime_ns = unpack(">LL", entry[5])
+    if racy_mtime is None or mtime >= racy_mtime or size != st.st_size & 0xffffffff or \
+            mtime != int(st.st_mtime) & 0xffffffff:
+        return 'S'
+    if mtime_ns and hasattr(st, 'st_mtime_ns') and mtime_ns != st.st_mtime_ns % 1000000000:
+        return 'S'
+    if not is_win and (unpack(">L", entry[4][:4])[0] != int(st.st_ctime) & 0xffffffff or
+                       entry[7] != st.st_ino & 0xffffffff):
+        return 'S'
+    # END handle ctime and inode, which are unreliable on windows
+    return None
+
+
+def hash_path(path, st, chunk_size=512 * 1024):
+    """:return: binary sha of the blob git would create from the file or symlink at path,
+        without storing it. Filters and line ending conversions are not applied.
+        None is returned if the file changed its size while it was read.
+    :param st: result of ``os.lstat`` for path
+    :param chunk_size: amount of bytes to read at once, to keep memory usage bounded"""
+    if S_ISLNK(st.st_mode):
+        data = force_bytes(os.readlink(path), encoding=defenc)
+        sha = make_sha(loose_object_header(str_blob_type, len(data)))
+        sha.update(data)
+        return sha.digest()
+    # END handle symlinks
+
+    sha = make_sha(loose_object_header(str_blob_type, st.st_size))
+    size = 0
+    with open(path, 'rb') as fp:
+        read = fp.read
+        while True:
+            chunk = read(chunk_size)
+            if not chunk:
+                break
+            size += len(chunk)
+            sha.update(chunk)
+        # END for each chunk
+    # END open file
+    if size != st.st_size:
+        return None
+    return sha.digest()
+
+
+def store_path(odb, path):
+    """Store the file or symlink at path as blob in the given object database.
+    The file is streamed into the database, so only a chunk of it is held in memory.
+
+    :return: tuple(st, binsha) of the lstat result of path and the sha of the blob"""
+    st = os.lstat(path)     # handles non-symlinks as well
+    if S_ISLNK(st.st_mode):
+        # in PY3, readlink is string, but we need bytes. In PY2, it's just OS encoded bytes, we assume UTF-8
+        open_stream = lambda: BytesIO(force_bytes(os.readlink(path), encoding=defenc))
+    else:
+        open_stream = lambda: open(path, 'rb')
+    with open_stream() as stream:
+        istream = odb.store(IStream(str_blob_type, st.st_size, stream))
+    return st, istream.binsha
+
+
+def _lstat_directory(directory, names):
+    """:return: list of lstat results or None for each name in the given directory"""
+    if scandir is not None:
+        try:
+            it = scandir(directory)
+        except OSError:
+            return [None] * len(names)
+        # END handle missing directory
+        dir_entries = dict((e.name, e) for e in it)
+        if hasattr(it, 'close'):
+            it.close()
+        out = list()
+        for name in names:
+            dir_entry = dir_entries.get(name)
+            out.append(dir_entry and dir_entry.stat(follow_symlinks=False))
+        # END for each name
+        return out
+    # END use scandir
+
+    out = list()
+    for name in names:
+        try:
+            out.append(os.lstat(osp.join(directory, name)))
+        except OSError:
+            out.append(None)
+    # END for each name
+    return out
+
+
+def working_tree_changes(root, entries, racy_mtime=None):
+    """Compare index entries of a single directory with the files in the working tree.
+    Only files whose stat data differs from the entry will be read and hashed.
+
+    :param root: path to the working tree directory
+    :param entries: list of IndexEntries at stage 0, all located in the same directory
+    :param racy_mtime: see ``compare_stat``
+    :return: list of tuple(entry, change_type, st) for each changed entry, where
+        change_type is 'D' if the file was deleted, 'T' if its type changed or 'M'
+        if it was modified. st is the lstat result of the file, or None if it was deleted.
+        Like git, entries marked assume-unchanged or skip-worktree are never changed."""
+    entries = [e for e in entries if not e.flags & (CE_VALID | CE_SKIP_WORKTREE)]
+    if not entries:
+        return list()
+    directory, _ = osp.split(entries[0].path)
+    directory = osp.join(root, directory)
+    names = [osp.split(e.path)[1] for e in entries]
+    out = list()
+    for entry, name, st in zip(entries, names, _lstat_directory(directory, names)):
+        if st is None or (S_ISDIR(st.st_mode) and S_IFMT(entry.mode) != S_IFGITLINK):
+            out.append((entry, 'D', None))
+            continue
+        # END handle deleted files
+        change_type = compare_stat(entry, st, racy_mtime)
+        if change_type == 'S':
+            change_type = None
+            if hash_path(osp.join(directory, name), st) != entry.binsha:
+                change_type = 'M'
+        # END compare contents
+        if change_type is not None:
+            out.append((entry, change_type, st))
+    # END for each entry
+    return out
+
+
+def _index_children(entries, start, prefix):
+    """:return: tuple(children, end) for the entries below prefix, starting at index start.
+        children is a list of tuple(key, start, end) of the files and directories directly
+        below prefix, with a '/' appended to the key of directories, and end is the index
+        after the last entry below prefix"""
+    children = list()
+    plen = len(prefix)
+    i = start
+    num_entries = len(entries)
+    while i < num_entries:
+        path = entries[i].path
+        if not path.startswith(prefix):
+            break
+        slash = path.find('/', plen)
+        if slash < 0:
+            children.append((path[plen:], i, i + 1))
+            i += 1
+            continue
+        # END handle file
+        dir_prefix = path[:slash + 1]
+        j = i + 1
+        while j < num_entries and entries[j].path.startswith(dir_prefix):
+            j += 1
+        # END skip directory
+        children.append((dir_prefix[plen:], i, j))
+        i = j
+    # END for each entry below prefix
+    return children, i
+
+
+def _index_tree_changes(odb, entries, start, tree_sha, prefix, cache_tree, cache, out):
+    """Compare the entries below prefix with the tree of tree_sha, see ``index_tree_changes``
+    :return: index after the last entry below prefix"""
+    index_children, end = _index_children(entries, start, prefix)
+    tree_children = list()
+    for binsha, mode, name in _tree_entries(odb, tree_sha, cache):
+        if mode >> 12 == 0o04:
+            name += '/'
+        tree_children.append((name, binsha, mode))
+    # END for each tree entry
+    tree_children.sort()
+
+    ii = ti = 0
+    num_index, num_tree = len(index_children), len(tree_children)
+    while ii < num_index or ti < num_tree:
+        index_key = index_children[ii][0] if ii < num_index else None
+        tree_key = tree_children[ti][0] if ti < num_tree else None
+        if tree_key is None or (index_key is not None and index_key < tree_key):
+            # only in the index
+            key, i, j = index_children[ii]
+            out.extend((entry.path, entry, None) for entry in entries[i:j])
+            ii += 1
+            continue
+        # END handle index only
+        key, binsha, mode = tree_children[ti]
+        ti += 1
+        if index_key != tree_key:
+            # only in the tree
+            if key.endswith('/'):
+                out.extend((t[2], None, t) for t in traverse_tree_recursive(odb, binsha, prefix + key, cache))
+            else:
+                out.append((prefix + key, None, (binsha, mode, prefix + key)))
+            continue
+        # END handle tree only
+
+        i, j = index_children[ii][1:]
+        ii += 1
+        if key.endswith('/'):
+            subtree = cache_tree and cache_tree.subtrees.get(key[:-1])
+            if subtree is not None and subtree.valid and subtree.binsha == binsha:
+                continue
+            _index_tree_changes(odb, entries, i, binsha, prefix + key, subtree, cache, out)
+            continue
+        # END handle directory
+
+        entry = entries[i]
+        if entry.binsha != binsha or entry.mode != mode:
+            out.append((entry.path, entry, (binsha, mode, entry.path)))
+    # END for each child
+    return end
+
+
+def index_tree_changes(odb, entries, tree_sha, cache_tree=None, cache=None):
+    """Compare index entries with a tree without invoking git.
+
+    Directories whose cache tree node is valid and matches the respective tree are
+    skipped without looking at their entries.
+
+    :param odb: object database to read trees from
+    :param entries: list of IndexEntries at stage 0, sorted by path
+    :param tree_sha: binary sha of the tree to compare with
+    :param cache_tree: root CacheTree of the entries, or None
+    :param cache: TreeCache to read trees through, or None
+    :return: list of tuple(path, entry, tree_entry) for each differing path, in the order
+        of the tree, where tree_entry is a tuple(binsha, mode, path). The entry is None
+        if the path only exists in the tree, and the tree_entry if it only exists in the index"""
+    out = list()
+    if cache_tree is not None and cache_tree.valid and cache_tree.binsha == tree_sha:
+        return out
+    _index_tree_changes(odb, entries, 0, tree_sha, '', cache_tree, cache, out)
+    return out
+
+
+def _serialize_entry(entry):
+    """:return: bytes of the given entry as stored in index files of version 2 or 3,
+        including the padding to the next entry"""
+    path = force_bytes(entry[3], encoding=defenc)
+    plen = min(len(path), CE_NAMEMASK)      # path length, longer paths are null-terminated
+    extended_flags = entry[2] >> CE_EXTENDED_SHIFT
+    flags = plen | (entry[2] & CE_NAMEMASK_INV & 0xffff & ~CE_EXTENDED)     # clear possible previous values
+    if extended_flags:
+        flags |= CE_EXTENDED
+        path = _entry_flags.pack(extended_flags) + path
+    # END handle extended flags
+    size = _entry.size + len(path)
+    return b''.join((_entry.pack(entry[4], entry[5], entry[6], entry[7], entry[0],
+                                 entry[8], entry[9], entry[10], entry[1], flags),
+                     path, b"\0" * (((size + 8) & ~7) - size)))
+
+
+def _write_cache_data(stream, version, num_entries, chunks, extension_data, ShaStreamCls):
+    """Write header, serialized entries, extension data and sha of an index"""
+    # wrap the stream into a compatible writer
+    stream = ShaStreamCls(stream)
+    write = stream.write
+    write(_header.pack(b"DIRC", version, num_entries))
+    for chunk in chunks:
+        write(chunk)
+    # END for each chunk
+
+    # write previously cached extensions data
+    if extension_data is not None:
+        write(extension_data)
+
+    # write the sha over the content
+    stream.write_sha()
+
+
 def write_cache(entries, stream, extension_data=None, ShaStreamCls=IndexFileSHA1Writer):
     """Write the cache represented by entries to a stream
 
@@ -119,41 +437,63 @@ def write_cache(entries, stream, extension_data=None, ShaStreamCls=IndexFileSHA1
         while writing to it, before the data is passed on to the wrapped stream
 
     :param extension_data: any kind of data to write as a trailer, it must begin
-        a 4 byte identifier, followed by its size ( 4 bytes )"""
-    # wrap the stream into a compatible writer
-    stream = ShaStreamCls(stream)
-
-    tell = stream.tell
-    write = stream.write
+        a 4 byte identifier, followed by its size ( 4 bytes )
 
-    # header
+    :note: The index is written in version 2, unless entries carry extended flags
+        which requires version 3. Path compression of version 4 is never written."""
     version = 2
-    write(b"DIRC")
-    write(pack(">LL", version, len(entries)))
-
-    # body
     for entry in entries:
-        beginoffset = tell()
-        write(entry[4])         # ctime
-        write(entry[5])         # mtime
-        path = entry[3]
-        path = force_bytes(path, encoding=defenc)
-        plen = len(path) & CE_NAMEMASK      # path length
-        assert plen == len(path), "Path %s too long to fit into index" % entry[3]
-        flags = plen | (entry[2] & CE_NAMEMASK_INV)     # clear possible previous values
-        write(pack(">LLLLLL20sH", entry[6], entry[7], entry[0],
-                   entry[8], entry[9], entry[10], entry[1], flags))
-        write(path)
-        real_size = ((tell() - beginoffset + 8) & ~7)
-        write(b"\0" * ((beginoffset + real_size) - tell()))
+        if entry[2] >> CE_EXTENDED_SHIFT:
+            version = 3
+            break
     # END for each entry
+    _write_cache_data(stream, version, len(entries), (_serialize_entry(e) for e in entries),
+                      extension_data, ShaStreamCls)
 
-    # write previously cached extensions data
-    if extension_data is not None:
-        stream.write(extension_data)
 
-    # write the sha over the content
-    stream.write_sha()
+def write_cache_from_map(entry_map, stream, extension_data=None, ShaStreamCls=IndexFileSHA1Writer):
+    """Write the entries of the given IndexEntryMap to a stream, like ``write_cache``.
+
+    Entries which were not changed since they were read are not serialized again.
+    Instead, runs of adjacent unchanged entries are copied from the index data as a
+    whole, so only changed entries are spliced in between.
+
+    :param entry_map: IndexEntryMap as returned by ``read_cache`` if lazy is True
+    :note: if unchanged entries of a version 3 index are copied, the index is
+        written in version 3 as these may carry extended flags"""
+    data = entry_map.data
+    offsets = entry_map.offsets
+    raw_index = entry_map.raw_index
+    chunks = list()
+    version = 2
+    run_start = run_end = None
+    for key in sorted(entry_map):
+        index = raw_index(key)
+        if index is not None:
+            if index == run_end:
+                run_end += 1
+                continue
+            if run_start is not None:
+                chunks.append(data[offsets[run_start]:offsets[run_end]])
+            run_start, run_end = index, index + 1
+            if entry_map.version == 3:
+                version = 3
+        else:
+            if run_start is not None:
+                chunks.append(data[offsets[run_start]:offsets[run_end]])
+                run_start = run_end = None
+            # END flush unchanged entries
+            entry = entry_map[key]
+            if entry[2] >> CE_EXTENDED_SHIFT:
+                version = 3
+            chunks.append(_serialize_entry(entry))
+        # END handle entry
+    # END for each entry
+    if run_start is not None:
+        chunks.append(data[offsets[run_start]:offsets[run_end]])
+    # END flush unchanged entries
+
+    _write_cache_data(stream, version, len(entry_map), chunks, extension_data, ShaStreamCls)
 
 
 def read_header(stream):
@@ -163,8 +503,7 @@ def read_header(stream):
         raise AssertionError("Invalid index file header: %r" % type_id)
     version, num_entries = unpack(">LL", stream.read(4 * 2))
 
-    # TODO: handle version 3: extended data, see read-cache.c
-    assert version in (1, 2)
+    assert version in (1, 2, 3, 4), "Unsupported index version: %i" % version
     return version, num_entries
 
 
@@ -178,34 +517,101 @@ def entry_key(*entry):
     # END handle entry
 
 
-def read_cache(stream):
+def _read_varint(data, offset):
+    """:return: tuple(value, offset_after_value) of the offset encoded integer at
+        offset as used by version 4 indices to encode the path prefix length"""
+    c = byte_ord(data[offset])
+    offset += 1
+    value = c & 0x7f
+    while c & 0x80:
+        value += 1
+        c = byte_ord(data[offset])
+        offset += 1
+        value = (value << 7) + (c & 0x7f)
+    # END while value continues
+    return value, offset
+
+
+def _entry_unpacker(data):
+    """:return: Function(path, offset) returning the IndexEntry found at offset
+        in the given index data"""
+    unpack_entry = _entry.unpack_from
+    unpack_flags = _entry_flags.unpack_from
+
+    def make_entry(path, offset):
+        ctime, mtime, dev, ino, mode, uid, gid, size, sha, flags = unpack_entry(data, offset)
+        if flags & CE_EXTENDED:
+            flags |= unpack_flags(data, offset + _entry_path_offset)[0] << CE_EXTENDED_SHIFT
+        return IndexEntry((mode, sha, flags, path, ctime, mtime, dev, ino, uid, gid, size))
+    # END make entry
+    return make_entry
+
+
+def read_cache(stream, lazy=False):
     """Read a cache file from the given stream
     :return: tuple(version, entries_dict, extension_data, content_sha)
     * version is the integer version number
     * entries dict is a dictionary which maps IndexEntry instances to a path at a stage
     * extension_data is '' or 4 bytes of type + 4 bytes of size + size bytes
-    * content_sha is a 20 byte sha on all cache file contents"""
-    version, num_entries = read_header(stream)
-    count = 0
-    entries = dict()
+    * content_sha is a 20 byte sha on all cache file contents
+    :param stream: memory map of the index file, or stream to read the index from.
+        Memory maps are parsed in place without copying their contents.
+    :param lazy: if True, entries_dict will be an IndexEntryMap which unpacks entries
+        on first access only. It keeps a reference to the index data, which allows
+        to write unchanged entries without serializing them again.
+    :note: Versions 2, 3 and 4 are supported. Extended flags of version 3 entries
+        are kept in the upper bits of the entry flags, see CE_EXTENDED_SHIFT"""
+    if isinstance(stream, mmap.mmap):
+        data = stream
+    else:
+        data = stream.read()
+    # END obtain random access data
 
-    read = stream.read
-    tell = stream.tell
-    while count < num_entries:
-        beginoffset = tell()
-        ctime = unpack(">8s", read(8))[0]
-        mtime = unpack(">8s", read(8))[0]
-        (dev, ino, mode, uid, gid, size, sha, flags) = \
-            unpack(">LLLLLL20sH", read(20 + 4 * 6 + 2))
-        path_size = flags & CE_NAMEMASK
-        path = read(path_size).decode(defenc)
-
-        real_size = ((tell() - beginoffset + 8) & ~7)
-        read((beginoffset + real_size) - tell())
-        entry = IndexEntry((mode, sha, flags, path, ctime, mtime, dev, ino, uid, gid, size))
+    type_id, version, num_entries = _header.unpack_from(data, 0)
+    if type_id != b"DIRC":
+        raise AssertionError("Invalid index file header: %r" % type_id)
+    assert version in (1, 2, 3, 4), "Unsupported index version: %i" % version
+
+    entries = dict()
+    offsets = array('L')
+    make_entry = _entry_unpacker(data)
+    unpack_flags = _entry_flags.unpack_from
+    find = data.find
+    offset = _header.size
+    prev_path = b''
+    for _ in xrange(num_entries):
+        flags = unpack_flags(data, offset + _entry_path_offset - 2)[0]
+        path_offset = offset + _entry_path_offset
+        if flags & CE_EXTENDED:
+            path_offset += 2
+        # END skip extended flags
+
+        if version < 4:
+            path_size = flags & CE_NAMEMASK
+            if path_size == CE_NAMEMASK:
+                path_end = find(b"\0", path_offset)
+            else:
+                path_end = path_offset + path_size
+            # END handle overlong paths
+            path = data[path_offset:path_end]
+            next_offset = offset + ((path_end - offset + 8) & ~7)
+        else:
+            strip, path_offset = _read_varint(data, path_offset)
+            path_end = find(b"\0", path_offset)
+            path = prev_path[:len(prev_path) - strip] + data[path_offset:path_end]
+            prev_path = path
+            next_offset = path_end + 1
+        # END handle path compression
+
+        path = path.decode(defenc)
         # entry_key would be the method to use, but we safe the effort
-        entries[(path, entry.stage)] = entry
-        count += 1
+        key = (path, (flags & CE_STAGEMASK) >> CE_STAGESHIFT)
+        if lazy:
+            entries[key] = len(offsets)
+            offsets.append(offset)
+        else:
+            entries[key] = make_entry(path, offset)
+        offset = next_offset
     # END for each entry
 
     # the footer contains extension data and a sha on the content so far
@@ -214,7 +620,7 @@ def read_cache(stream):
     # 4 bytes ID
     # 4 bytes length of chunk
     # repeated 0 - N times
-    extension_data = stream.read(~0)
+    extension_data = data[offset:]
     assert len(extension_data) > 19, "Index Footer was not at least a sha on content as it was only %i bytes in size"\
                                      % len(extension_data)
 
@@ -223,10 +629,76 @@ def read_cache(stream):
     # truncate the sha in the end as we will dynamically create it anyway
     extension_data = extension_data[:-20]
 
+    if lazy:
+        offsets.append(offset)
+        entries = IndexEntryMap(entries, make_entry, data, offsets, version)
+    # END handle lazy entries
+
     return (version, entries, extension_data, content_sha)
 
 
-def write_tree_from_cache(entries, odb, sl, si=0):
+def read_extensions(extension_data):
+    """:return: list of tuple(signature, data) pairs, one for each extension
+        contained in the given extension data as returned by ``read_cache``
+    :param extension_data: extension data without the trailing sha"""
+    out = list()
+    offset = 0
+    end = len(extension_data)
+    while offset + _extension_header.size <= end:
+        signature, size = _extension_header.unpack_from(extension_data, offset)
+        offset += _extension_header.size
+        out.append((signature, extension_data[offset:offset + size]))
+        offset += size
+    # END for each extension
+    return out
+
+
+def _read_cache_tree_node(data, offset):
+    """:return: tuple(name, CacheTree, offset_after_node) of the node at offset"""
+    name_end = data.index(b"\0", offset)
+    name = data[offset:name_end].decode(defenc)
+    line_end = data.index(b"\n", name_end)
+    entry_count, subtree_count = (int(v) for v in data[name_end + 1:line_end].split(b" "))
+    offset = line_end + 1
+    node = CacheTree(entry_count)
+    if entry_count >= 0:
+        node.binsha = data[offset:offset + 20]
+        offset += 20
+    # END read sha of valid node
+    for _ in xrange(subtree_count):
+        subtree_name, subtree, offset = _read_cache_tree_node(data, offset)
+        node.subtrees[subtree_name] = subtree
+    # END for each subtree
+    return name, node, offset
+
+
+def read_cache_tree(data):
+    """:return: root CacheTree node parsed from the data of a TREE extension
+    :param data: extension data as returned by ``read_extensions``"""
+    return _read_cache_tree_node(data, 0)[1]
+
+
+def _write_cache_tree_node(node, name, write):
+    subtrees = [(force_bytes(n, encoding=defenc), t) for n, t in node.subtrees.items()]
+    # git keeps subtrees sorted by name length first, then by name
+    subtrees.sort(key=lambda item: (len(item[0]), item[0]))
+    write(name + b"\0" + ("%i %i\n" % (node.entry_count, len(subtrees))).encode('ascii'))
+    if node.valid:
+        write(node.binsha)
+    for subtree_name, subtree in subtrees:
+        _write_cache_tree_node(subtree, subtree_name, write)
+    # END for each subtree
+
+
+def write_cache_tree(cache_tree):
+    """:return: data of a TREE extension representing the given root CacheTree,
+        without the extension header"""
+    out = list()
+    _write_cache_tree_node(cache_tree, b'', out.append)
+    return b''.join(out)
+
+
+def write_tree_from_cache(entries, odb, sl, si=0, cache_tree=None, tree_odb=None):
     """Create a tree from the given sorted list of entries and put the respective
     trees into the given object database
 
@@ -234,12 +706,23 @@ def write_tree_from_cache(entries, odb, sl, si=0):
     :param odb: object database to store the trees in
     :param si: start index at which we should start creating subtrees
     :param sl: slice indicating the range we should process on the entries list
+    :param cache_tree: CacheTree node representing the processed range, or None.
+        Subtrees of valid nodes are not written again, but their cached sha is used
+        if the tree exists. It is updated to represent the written trees, and must be
+        invalidated for all paths changed since it was valid.
+    :param tree_odb: object database in which trees of the cache_tree must exist to be
+        reused, or None to use odb
     :return: tuple(binsha, list(tree_entry, ...)) a tuple of a sha and a list of
         tree entries being a tuple of hexsha, mode, name"""
     tree_items = list()
     tree_items_append = tree_items.append
     ci = sl.start
     end = sl.stop
+    subtrees = None
+    if cache_tree is not None:
+        subtrees = dict()
+        tree_odb = tree_odb or odb
+    # END prepare updated subtrees
     while ci < end:
         entry = entries[ci]
         if entry.stage != 0:
@@ -253,6 +736,24 @@ def write_tree_from_cache(entries, odb, sl, si=0):
         else:
             # find common base range
             base = entry.path[si:rbound]
+            subtree = None
+            if subtrees is not None:
+                subtree = subtrees[base] = cache_tree.subtrees.get(base) or CacheTree()
+                if subtree.entry_count > 0:
+                    # the cached range must still match the entries we see, and the tree
+                    # must exist, as git may have pruned it or written it elsewhere
+                    xi = ci - 1 + subtree.entry_count
+                    prefix = entry.path[:rbound + 1]
+                    if xi <= end and entries[xi - 1].path.startswith(prefix) and \
+                            (xi == end or not entries[xi].path.startswith(prefix)) and \
+                            tree_odb.has_object(subtree.binsha):
+                        tree_items_append((subtree.binsha, S_IFDIR, base))
+                        ci = xi
+                        continue
+                    # END reuse cached tree
+                # END handle valid cache
+            # END handle cache tree
+
             xi = ci
             while xi < end:
                 oentry = entries[xi]
@@ -265,7 +766,8 @@ def write_tree_from_cache(entries, odb, sl, si=0):
 
             # enter recursion
             # ci - 1 as we want to count our current item as well
-            sha, tree_entry_list = write_tree_from_cache(entries, odb, slice(ci - 1, xi), rbound + 1)  # @UnusedVariable
+            sha, tree_entry_list = write_tree_from_cache(entries, odb, slice(ci - 1, xi), rbound + 1,  # @UnusedVariable
+                                                         subtree, tree_odb)
             tree_items_append((sha, S_IFDIR, base))
 
             # skip ahead
@@ -279,6 +781,12 @@ def write_tree_from_cache(entries, odb, sl, si=0):
     sio.seek(0)
 
     istream = odb.store(IStream(str_tree_type, len(sio.getvalue()), sio))
+
+    if cache_tree is not None:
+        cache_tree.entry_count = end - sl.start
+        cache_tree.binsha = istream.binsha
+        cache_tree.subtrees = subtrees
+    # END update cache tree
     return (istream.binsha, tree_items)
 
 
@@ -286,7 +794,14 @@ def _tree_entry_to_baseindexentry(tree_entry, stage):
     return BaseIndexEntry((tree_entry[1], tree_entry[0], stage << CE_STAGESHIFT, tree_entry[2]))
 
 
-def aggressive_tree_merge(odb, tree_shas):
+def _is_trivial_tree_merge(entries):
+    """:return: True if the tree entries of base, ours and theirs can be merged by
+        taking one side as a whole, as at most one side changed"""
+    base, ours, theirs = (e and e[0] for e in entries)
+    return ours == theirs or base == ours or base == theirs
+
+
+def aggressive_tree_merge(odb, tree_shas, cache=None):
     """
     :return: list of BaseIndexEntries representing the aggressive merge of the given
         trees. All valid entries are on stage 0, whereas the conflicting ones are left
@@ -294,14 +809,15 @@ def aggressive_tree_merge(odb, tree_shas):
         2 to our tree and 3 to 'their' tree.
     :param tree_shas: 1, 2 or 3 trees as identified by their binary 20 byte shas
         If 1 or two, the entries will effectively correspond to the last given tree
-        If 3 are given, a 3 way merge is performed"""
+        If 3 are given, a 3 way merge is performed
+    :param cache: TreeCache to obtain the trees from, or None to read them from the odb"""
     out = list()
     out_append = out.append
 
     # one and two way is the same for us, as we don't have to handle an existing
     # index, instrea
     if len(tree_shas) in (1, 2):
-        for entry in traverse_tree_recursive(odb, tree_shas[-1], ''):
+        for entry in traverse_tree_recursive(odb, tree_shas[-1], '', cache):
             out_append(_tree_entry_to_baseindexentry(entry, 0))
         # END for each entry
         return out
@@ -310,8 +826,25 @@ def aggressive_tree_merge(odb, tree_shas):
     if len(tree_shas) > 3:
         raise ValueError("Cannot handle %i trees at once" % len(tree_shas))
 
-    # three trees
-    for base, ours, theirs in traverse_trees_recursive(odb, tree_shas, ''):
+    # three trees. Subtrees which are unchanged on one side are taken from the
+    # other one as a whole, which is what the rules below would yield for each
+    # of their entries
+    for base, ours, theirs in iter_trees_recursive(odb, tree_shas, '', cache, _is_trivial_tree_merge):
+        if S_ISDIR((base or ours or theirs)[1]):
+            base_sha, ours_sha, theirs_sha = (e and e[0] for e in (base, ours, theirs))
+            if ours_sha == theirs_sha or base_sha == theirs_sha:
+                entry = ours
+            else:
+                entry = theirs
+            # END pick changed side
+            if entry is not None:
+                for item in traverse_tree_recursive(odb, entry[0], entry[2] + '/', cache):
+                    out_append(_tree_entry_to_baseindexentry(item, 0))
+                # END for each item
+            # END handle tree deleted on changed side
+            continue
+        # END handle unchanged subtree
+
         if base is not None:
             # base version exists
             if ours is not None:
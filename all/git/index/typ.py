@@ -2,6 +2,11 @@
 
 from binascii import b2a_hex
 
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+
 from .util import (
     pack,
     unpack
@@ -9,7 +14,7 @@ from .util import (
 from git.objects import Blob
 
 
-__all__ = ('BlobFilter', 'BaseIndexEntry', 'IndexEntry')
+__all__ = ('BlobFilter', 'BaseIndexEntry', 'IndexEntry', 'IndexEntryMap', 'CacheTree')
 
 #{ Invariants
 CE_NAMEMASK = 0x0fff
@@ -17,6 +22,8 @@ CE_STAGEMASK = 0x3000
 CE_EXTENDED = 0x4000
 CE_VALID = 0x8000
 CE_STAGESHIFT = 12
+CE_EXTENDED_SHIFT = 16      # extended flags of version 3 indices are kept above the on-disk flags
+CE_SKIP_WORKTREE = 0x4000 << CE_EXTENDED_SHIFT
 
 #} END invariants
 
@@ -174,3 +181,123 @@ class IndexEntry(BaseIndexEntry):
         time = pack(">LL", 0, 0)
         return IndexEntry((blob.mode, blob.binsha, stage << CE_STAGESHIFT, blob.path,
                            time, time, 0, 0, 0, 0, blob.size))
+
+
+class IndexEntryMap(MutableMapping):
+
+    """Dictionary-like mapping of (path, stage) keys to IndexEntry instances, which
+    unpacks entries from the index data only once they are accessed.
+
+    All keys are known right away, but values are kept as indices of the entries
+    within the index data until they are requested. As long as an entry is not
+    set or deleted, its serialized form can be taken from the data as is, which
+    allows to write the index without serializing unchanged entries again.
+
+    If ``changed_paths`` is set to a set, paths of all entries which are set or deleted
+    are recorded in it, which allows to invalidate caches built from the original
+    entries. It is None by default, so that nothing is recorded if there are no caches."""
+    __slots__ = ('_entries', '_cache', '_make_entry', 'data', 'offsets', 'version', 'changed_paths')
+
+    def __init__(self, entries, make_entry, data=None, offsets=None, version=None):
+        """
+        :param entries: dict mapping (path, stage) keys to IndexEntry instances
+            or to integer indices of entries which still have to be unpacked
+        :param make_entry: Function(path, offset) returning the IndexEntry at the
+            given offset
+        :param data: the index data the entries were read from
+        :param offsets: sequence with the offset of each entry within data, followed
+            by the offset right behind the last entry
+        :param version: version of the index the data belongs to"""
+        self._entries = entries
+        self._cache = dict()
+        self._make_entry = make_entry
+        self.data = data
+        self.offsets = offsets
+        self.version = version
+        self.changed_paths = None
+
+    def raw_index(self, key):
+        """:return: index of the entry at key within the index data if it can be
+            written by copying its serialized form, or None if it has to be serialized.
+            Only entries of version 1 to 3 indices are stored without path compression
+            and can be copied."""
+        index = self._entries[key]
+        if isinstance(index, tuple) or self.version not in (1, 2, 3):
+            return None
+        return index
+
+    def __getitem__(self, key):
+        entry = self._entries[key]
+        if isinstance(entry, tuple):
+            return entry
+        try:
+            return self._cache[key]
+        except KeyError:
+            entry = self._cache[key] = self._make_entry(key[0], self.offsets[entry])
+            return entry
+        # END unpack on demand
+
+    def __setitem__(self, key, entry):
+        self._cache.pop(key, None)
+        self._entries[key] = entry
+        if self.changed_paths is not None:
+            self.changed_paths.add(key[0])
+
+    def __delitem__(self, key):
+        del(self._entries[key])
+        self._cache.pop(key, None)
+        if self.changed_paths is not None:
+            self.changed_paths.add(key[0])
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return "<%s with %i entries>" % (type(self).__name__, len(self._entries))
+
+    def copy(self):
+        """:return: dict with all entries of this map"""
+        return dict(self.items())
+
+
+class CacheTree(object):
+
+    """Node of the cache tree as stored in the TREE extension of the index.
+
+    Each node describes a directory of the index, the amount of index entries
+    below it and the binary sha of the tree object written for it. Nodes whose
+    entries changed since the tree was written are invalid, which is indicated
+    by an entry_count of -1."""
+    __slots__ = ('entry_count', 'binsha', 'subtrees')
+
+    def __init__(self, entry_count=-1, binsha=None):
+        self.entry_count = entry_count
+        self.binsha = binsha
+        self.subtrees = dict()      # name -> CacheTree
+
+    def __repr__(self):
+        return "<%s entries=%i subtrees=%i>" % (type(self).__name__, self.entry_count, len(self.subtrees))
+
+    @property
+    def valid(self):
+        """:return: True if binsha represents the entries below this node"""
+        return self.entry_count >= 0
+
+    def invalidate(self, path):
+        """Invalidate this node and all subtree nodes leading to the given path
+
+        :param path: path of an index entry relative to this node"""
+        node = self
+        node.entry_count = -1
+        for name in path.split('/')[:-1]:
+            node = node.subtrees.get(name)
+            if node is None:
+                break
+            node.entry_count = -1
+        # END for each directory of path
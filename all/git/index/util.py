@@ -14,6 +14,7 @@ __all__ = ('TemporaryFileSwap', 'post_clear_cache', 'default_index', 'git_workin
 #{ Aliases
 pack = struct.pack
 unpack = struct.unpack
+Struct = struct.Struct
 
 
 #} END aliases
@@ -22,9 +22,10 @@ from .util import (
     parse_date,
     altz_to_utctz_str,
     parse_actor_and_date,
+    utctz_to_altz,
     from_timestamp,
 )
-from git.compat import text_type
+from git.compat import text_type, defenc, xrange
 
 from time import (
     time,
@@ -33,6 +34,7 @@ from time import (
     timezone,
     localtime
 )
+from array import array
 import os
 from io import BytesIO
 import logging
@@ -40,7 +42,43 @@ import logging
 log = logging.getLogger('git.objects.commit')
 log.addHandler(logging.NullHandler())
 
-__all__ = ('Commit', )
+__all__ = ('Commit', 'CommitTable')
+
+# typecode of the arrays holding dates, which need 64 bits to represent dates past 2038
+# even where longs have 32 bits. Python 2 only knows longs.
+try:
+    array('q')
+    _date_typecode = 'q'
+except ValueError:
+    _date_typecode = 'l'
+# END handle missing 64 bit typecode
+
+
+def _iter_binshas_from_process_or_stream(proc_or_stream):
+    """:return: iterator yielding the binary sha of each commit listed by the given
+        git-rev-list process or stream, one sha per line"""
+    stream = proc_or_stream
+    if not hasattr(stream, 'readline'):
+        stream = proc_or_stream.stdout
+
+    readline = stream.readline
+    while True:
+        line = readline()
+        if not line:
+            break
+        hexsha = line.strip()
+        if len(hexsha) > 40:
+            # split additional information, as returned by bisect for instance
+            hexsha, _ = line.split(None, 1)
+        # END handle extra info
+
+        assert len(hexsha) == 40, "Invalid line: %s" % hexsha
+        yield hex_to_bin(hexsha)
+    # END for each line in stream
+    # TODO: Review this - it seems process handling got a bit out of control
+    # due to many developers trying to fix the open file handles issue
+    if hasattr(proc_or_stream, 'wait'):
+        finalize_process(proc_or_stream)
 
 
 class Commit(base.Object, Iterable, Diffable, Traversable, Serializable):
@@ -66,7 +104,7 @@ class Commit(base.Object, Iterable, Diffable, Traversable, Serializable):
     __slots__ = ("tree",
                  "author", "authored_date", "author_tz_offset",
                  "committer", "committed_date", "committer_tz_offset",
-                 "message", "parents", "encoding", "gpgsig")
+                 "message", "parents", "encoding", "gpgsig", "_body")
     _id_attribute_ = "hexsha"
 
     def __init__(self, repo, binsha, tree=None, author=None, authored_date=None, author_tz_offset=None,
@@ -108,6 +146,7 @@ class Commit(base.Object, Iterable, Diffable, Traversable, Serializable):
             as what time.altzone returns. The sign is inverted compared to git's
             UTC timezone."""
         super(Commit, self).__init__(repo, binsha)
+        self._body = ()
         if tree is not None:
             assert isinstance(tree, Tree), "Tree needs to be a Tree instance, was %s" % type(tree)
         if tree is not None:
@@ -138,10 +177,18 @@ class Commit(base.Object, Iterable, Diffable, Traversable, Serializable):
         return commit.parents
 
     def _set_cache_(self, attr):
-        if attr in Commit.__slots__:
+        if attr in ('message', 'gpgsig') and self._body:
+            # our headers were parsed already, decode the rest from the retained data
+            stream, gpgsig_offset, message_offset = self._body
+            if attr == 'message':
+                self.message = self._read_message(stream, message_offset)
+            else:
+                self.gpgsig = self._read_gpgsig(stream, gpgsig_offset)
+            # END handle attribute
+        elif attr in Commit.__slots__:
             # read the data in a chunk, its faster - then provide a file wrapper
             binsha, typename, self.size, stream = self.repo.odb.stream(self.binsha)  # @UnusedVariable
-            self._deserialize(BytesIO(stream.read()))
+            self._deserialize(BytesIO(stream.read()), headers_only=attr not in ('message', 'gpgsig'))
         else:
             super(Commit, self)._set_cache_(attr)
         # END handle attrs
@@ -186,7 +233,7 @@ class Commit(base.Object, Iterable, Diffable, Traversable, Serializable):
         return self.repo.git.name_rev(self)
 
     @classmethod
-    def iter_items(cls, repo, rev, paths='', **kwargs):
+    def iter_items(cls, repo, rev, paths='', prefetch=False, **kwargs):
         """Find all commits matching the given criteria.
 
         :param repo: is the Repo
@@ -199,6 +246,9 @@ class Commit(base.Object, Iterable, Diffable, Traversable, Serializable):
             ``max_count`` is the maximum number of commits to fetch
             ``skip`` is the number of commits to skip
             ``since`` all commits since i.e. '1970-01-01'
+        :param prefetch: if True, the data of all commits is read while iterating,
+            in batches through one pipeline to git. Use it if most commits will have
+            their attributes accessed, otherwise each one is read on its own.
         :return: iterator yielding Commit items"""
         if 'pretty' in kwargs:
             raise ValueError("--pretty cannot be used as parsing expects single sha's only")
@@ -212,7 +262,7 @@ class Commit(base.Object, Iterable, Diffable, Traversable, Serializable):
         # END if paths
 
         proc = repo.git.rev_list(rev, args, as_process=True, **kwargs)
-        return cls._iter_from_process_or_stream(repo, proc)
+        return cls._iter_from_process_or_stream(repo, proc, prefetch)
 
     def iter_parents(self, paths='', **kwargs):
         """Iterate _all_ parents of this commit.
@@ -248,35 +298,37 @@ class Commit(base.Object, Iterable, Diffable, Traversable, Serializable):
         return Stats._list_from_string(self.repo, text)
 
     @classmethod
-    def _iter_from_process_or_stream(cls, repo, proc_or_stream):
+    def _iter_from_process_or_stream(cls, repo, proc_or_stream, prefetch=False):
         """Parse out commit information into a list of Commit objects
         We expect one-line per commit, and parse the actual commit information directly
         from our lighting fast object database
 
         :param proc: git-rev-list process instance - one sha per line
+        :param prefetch: if True, the data of the commits is read right away, in
+            batches, instead of once per commit on first attribute access
         :return: iterator returning Commit objects"""
-        stream = proc_or_stream
-        if not hasattr(stream, 'readline'):
-            stream = proc_or_stream.stdout
+        binshas = _iter_binshas_from_process_or_stream(proc_or_stream)
+        if not prefetch:
+            for binsha in binshas:
+                yield Commit(repo, binsha)
+            # END for each sha
+            return
+        # END handle lazy commits
+
+        # read all commits through one pipeline if the database supports it
+        stream_many = getattr(repo.odb, 'stream_many', None)
+        if stream_many is None:
+            ostreams = (repo.odb.stream(binsha) for binsha in binshas)
+        else:
+            ostreams = stream_many(binshas)
+        # END get streams
 
-        readline = stream.readline
-        while True:
-            line = readline()
-            if not line:
-                break
-            hexsha = line.strip()
-            if len(hexsha) > 40:
-                # split additional information, as returned by bisect for instance
-                hexsha, _ = line.split(None, 1)
-            # END handle extra info
-
-            assert len(hexsha) == 40, "Invalid line: %s" % hexsha
-            yield Commit(repo, hex_to_bin(hexsha))
-        # END for each line in stream
-        # TODO: Review this - it seems process handling got a bit out of control
-        # due to many developers trying to fix the open file handles issue
-        if hasattr(proc_or_stream, 'wait'):
-            finalize_process(proc_or_stream)
+        for ostream in ostreams:
+            commit = Commit(repo, ostream.binsha)
+            commit.size = ostream.size
+            commit._deserialize(BytesIO(ostream.read()))
+            yield commit
+        # END for each stream
 
     @classmethod
     def create_from_tree(cls, repo, tree, message, parent_commits=None, head=False, author=None, committer=None,
@@ -444,9 +496,11 @@ class Commit(base.Object, Iterable, Diffable, Traversable, Serializable):
         # END handle encoding
         return self
 
-    def _deserialize(self, stream):
-        """:param from_rev_list: if true, the stream format is coming from the rev-list command
-        Otherwise it is assumed to be a plain data stream from our object"""
+    def _deserialize(self, stream, headers_only=False):
+        """:param headers_only: if True, only the headers are parsed. The message and the
+            signature are decoded on first access, by seeking back into the stream, which
+            must thus be a seekable in-memory stream like BytesIO. Use it if most likely
+            only the tree, parents, actors or dates will be accessed"""
         readline = stream.readline
         self.tree = Tree(self.repo, hex_to_bin(readline().split()[1]), Tree.tree_id << 12, '')
 
@@ -475,35 +529,28 @@ class Commit(base.Object, Iterable, Diffable, Traversable, Serializable):
         # end skip mergetags
 
         # now we can have the encoding line, or an empty line followed by the optional
-        # message.
+        # message. Signatures are only located, and decoded when needed
         self.encoding = self.default_encoding
-        self.gpgsig = None
+        gpgsig_offset = None
 
         # read headers
-        enc = next_line
-        buf = enc.strip()
-        while buf:
-            if buf[0:10] == b"encoding ":
-                self.encoding = buf[buf.find(' ') + 1:].decode('ascii')
-            elif buf[0:7] == b"gpgsig ":
-                sig = buf[buf.find(b' ') + 1:] + b"\n"
-                is_next_header = False
-                while True:
-                    sigbuf = readline()
-                    if not sigbuf:
-                        break
-                    if sigbuf[0:1] != b" ":
-                        buf = sigbuf.strip()
-                        is_next_header = True
-                        break
-                    sig += sigbuf[1:]
-                # end read all signature
-                self.gpgsig = sig.rstrip(b"\n").decode('ascii')
-                if is_next_header:
-                    continue
-            buf = readline().strip()
-        # decode the authors name
+        line = next_line
+        while line.strip():
+            if line.startswith(b"encoding "):
+                self.encoding = line[9:].strip().decode('ascii')
+            elif line.startswith(b"gpgsig "):
+                gpgsig_offset = stream.tell() - len(line)
+                line = readline()
+                while line.startswith(b" "):
+                    line = readline()
+                # end skip signature
+                continue
+            # END handle header
+            line = readline()
+        # END for each header
+        self._body = (stream, gpgsig_offset, stream.tell())
 
+        # decode the authors name
         try:
             self.author, self.authored_date, self.author_tz_offset = \
                 parse_actor_and_date(author_line.decode(self.encoding, 'replace'))
@@ -519,15 +566,266 @@ class Commit(base.Object, Iterable, Diffable, Traversable, Serializable):
                       exc_info=True)
         # END handle author's encoding
 
+        if not headers_only:
+            self._set_cache_('gpgsig')
+            self._set_cache_('message')
+            self._body = ()
+        # END handle full deserialization
+        return self
+
+    def _read_gpgsig(self, stream, offset):
+        """:return: signature header starting at offset in stream, or None if offset is None"""
+        if offset is None:
+            return None
+        stream.seek(offset)
+        readline = stream.readline
+        sig = readline()[7:]
+        while True:
+            sigbuf = readline()
+            if sigbuf[0:1] != b" ":
+                break
+            sig += sigbuf[1:]
+        # end read all signature
+        return sig.rstrip(b"\n").decode('ascii')
+
+    def _read_message(self, stream, offset):
+        """:return: message starting at offset in stream, decoded with our encoding"""
         # a stream from our data simply gives us the plain message
         # The end of our message stream is marked with a newline that we strip
-        self.message = stream.read()
+        stream.seek(offset)
+        message = stream.read()
         try:
-            self.message = self.message.decode(self.encoding, 'replace')
+            message = message.decode(self.encoding, 'replace')
         except UnicodeDecodeError:
-            log.error("Failed to decode message '%s' using encoding %s", self.message, self.encoding, exc_info=True)
+            log.error("Failed to decode message '%s' using encoding %s", message, self.encoding, exc_info=True)
         # END exception handling
-
-        return self
+        return message
 
     #} END serializable implementation
+
+
+class CommitTable(object):
+
+    """A compact, column-oriented table of commits, as listed by git-rev-list.
+
+    Instead of one Commit instance per commit, all commits share a few arrays
+    holding their binary shas, parents, author and committer ids, dates and timezone
+    offsets. Actors are stored only once, in the ``actors`` list, and are referred
+    to by their index in it. This allows to keep the history of large repositories
+    in memory, and to filter it quickly.
+
+    Row i describes the i'th commit, in the order git-rev-list listed them.
+    Commit instances can be obtained using ``commit(i)``, indexing or iteration."""
+    __slots__ = ('repo', 'actors', 'binshas', 'parent_offsets', 'parent_binshas',
+                 'author_ids', 'authored_dates', 'author_tz_offsets',
+                 'committer_ids', 'committed_dates', 'committer_tz_offsets', '_actor_ids')
+
+    # format of the line git-rev-list prints for each commit, after its sha and parents
+    _rev_list_format = '%an%x00%ae%x00%ad%x00%cn%x00%ce%x00%cd'
+
+    def __init__(self, repo, actors=None):
+        """Initialize an empty table
+
+        :param actors: list of Actors to share with another table, if not given
+            a new list is created"""
+        self.repo = repo
+        self.actors = actors if actors is not None else list()
+        self._actor_ids = None
+        self.binshas = bytearray()
+        self.parent_offsets = array('L', (0, ))
+        self.parent_binshas = bytearray()
+        self.author_ids = array('L')
+        self.authored_dates = array(_date_typecode)
+        self.author_tz_offsets = array('l')
+        self.committer_ids = array('L')
+        self.committed_dates = array(_date_typecode)
+        self.committer_tz_offsets = array('l')
+
+    def __len__(self):
+        return len(self.author_ids)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("commit table index out of range")
+        return self.commit(index)
+
+    def __iter__(self):
+        for index in xrange(len(self)):
+            yield self.commit(index)
+        # END for each row
+
+    #{ Construction
+
+    @classmethod
+    def from_rev_list(cls, repo, rev, paths='', **kwargs):
+        """Create a table of all commits matching the given criteria.
+
+        :param repo: is the Repo
+        :param rev: revision specifier, see git-rev-parse for viable options
+        :param paths: optional path or list of paths, see Commit.iter_items
+        :param kwargs: additional keyword arguments to git rev-list, see Commit.iter_items
+        :return: CommitTable"""
+        for forbidden in ('pretty', 'format'):
+            if forbidden in kwargs:
+                raise ValueError("--%s cannot be used as the commit table uses its own format" % forbidden)
+        # END handle output formats
+
+        args = ['--']
+        if paths:
+            args.extend((paths, ))
+        # END if paths
+
+        proc = repo.git.rev_list(rev, args, as_process=True, parents=True, date='raw',
+                                 format=cls._rev_list_format, **kwargs)
+        table = cls(repo)
+        table._read_rev_list(proc)
+        return table
+
+    def _actor_id(self, name, email):
+        """:return: index of the actor with the given name and email in our actors list,
+            which is added if needed"""
+        actor_ids = self._actor_ids
+        if actor_ids is None:
+            actor_ids = self._actor_ids = dict(((a.name, a.email), i) for i, a in enumerate(self.actors))
+        # END build actor map
+        key = (name, email)
+        try:
+            return actor_ids[key]
+        except KeyError:
+            actor_ids[key] = len(self.actors)
+            self.actors.append(Actor(name, email))
+            return actor_ids[key]
+        # END intern actor
+
+    def _read_rev_list(self, proc_or_stream):
+        """Append the commits listed by the given git-rev-list process or stream, which
+        must have been started with --parents and our format"""
+        stream = proc_or_stream
+        if not hasattr(stream, 'readline'):
+            stream = proc_or_stream.stdout
+
+        readline = stream.readline
+        actor_id = self._actor_id
+        binshas = self.binshas
+        parent_binshas = self.parent_binshas
+        while True:
+            line = readline()
+            if not line:
+                break
+            # commit <sha> [<parent sha>...]
+            tokens = line.split()
+            assert tokens[0] == b'commit', "Invalid line: %r" % line
+            binshas.extend(hex_to_bin(tokens[1]))
+            for parent in tokens[2:]:
+                parent_binshas.extend(hex_to_bin(parent))
+            # END for each parent
+            self.parent_offsets.append(len(parent_binshas) // 20)
+
+            aname, aemail, adate, cname, cemail, cdate = readline().rstrip(b'\n').decode(defenc, 'replace').split('\0')
+            adate, atz = adate.split()
+            cdate, ctz = cdate.split()
+            self.author_ids.append(actor_id(aname, aemail))
+            self.authored_dates.append(int(adate))
+            self.author_tz_offsets.append(utctz_to_altz(atz))
+            self.committer_ids.append(actor_id(cname, cemail))
+            self.committed_dates.append(int(cdate))
+            self.committer_tz_offsets.append(utctz_to_altz(ctz))
+        # END for each commit
+
+        if hasattr(proc_or_stream, 'wait'):
+            finalize_process(proc_or_stream)
+
+    #} END construction
+
+    #{ Row access
+
+    def binsha(self, index):
+        """:return: binary sha of the commit in the given row"""
+        return bytes(self.binshas[index * 20:index * 20 + 20])
+
+    def parents(self, index):
+        """:return: tuple of binary shas of the parents of the commit in the given row"""
+        parent_binshas = self.parent_binshas
+        return tuple(bytes(parent_binshas[i * 20:i * 20 + 20])
+                     for i in xrange(self.parent_offsets[index], self.parent_offsets[index + 1]))
+
+    def author(self, index):
+        """:return: Actor who authored the commit in the given row"""
+        return self.actors[self.author_ids[index]]
+
+    def committer(self, index):
+        """:return: Actor who committed the commit in the given row"""
+        return self.actors[self.committer_ids[index]]
+
+    def commit(self, index):
+        """:return: Commit of the given row, with all attributes we know already set"""
+        repo = self.repo
+        return Commit(repo, self.binsha(index),
+                      author=self.author(index),
+                      authored_date=self.authored_dates[index],
+                      author_tz_offset=self.author_tz_offsets[index],
+                      committer=self.committer(index),
+                      committed_date=self.committed_dates[index],
+                      committer_tz_offset=self.committer_tz_offsets[index],
+                      parents=tuple(Commit(repo, p) for p in self.parents(index)))
+
+    #} END row access
+
+    #{ Filters
+
+    def take(self, indices):
+        """:return: new CommitTable with the given rows of this table, in the given order.
+            It shares its actors with this table"""
+        indices = list(indices)
+        table = type(self)(self.repo, self.actors)
+        table._actor_ids = self._actor_ids
+        binshas = self.binshas
+        parent_offsets = self.parent_offsets
+        parent_binshas = self.parent_binshas
+        for index in indices:
+            table.binshas.extend(binshas[index * 20:index * 20 + 20])
+            table.parent_binshas.extend(parent_binshas[parent_offsets[index] * 20:parent_offsets[index + 1] * 20])
+            table.parent_offsets.append(len(table.parent_binshas) // 20)
+        # END for each row
+
+        for name in ('author_ids', 'authored_dates', 'author_tz_offsets',
+                     'committer_ids', 'committed_dates', 'committer_tz_offsets'):
+            column = getattr(self, name)
+            getattr(table, name).extend(column[index] for index in indices)
+        # END for each column
+        return table
+
+    def between(self, since=None, until=None, committed=True):
+        """:return: new CommitTable with the commits dated at or after since, and
+            before until
+
+        :param since: seconds since epoch, or None to not limit the start
+        :param until: seconds since epoch, or None to not limit the end
+        :param committed: if True, the commit date is compared, the author date otherwise"""
+        dates = self.committed_dates if committed else self.authored_dates
+        return self.take([i for i, date in enumerate(dates)
+                          if (since is None or since <= date) and (until is None or date < until)])
+
+    def by_author(self, *actors, **kwargs):
+        """:return: new CommitTable with the commits authored by any of the given actors
+
+        :param actors: Actor instances, or strings matching an actor's name or email
+        :param kwargs: if ``committed`` is True, the committers are compared instead
+        :raise TypeError: if other keyword arguments are given"""
+        committed = kwargs.pop('committed', False)
+        if kwargs:
+            raise TypeError("by_author() got unexpected keyword arguments: %s" % ', '.join(sorted(kwargs)))
+        # END handle unknown arguments
+        wanted = set()
+        for actor in actors:
+            if isinstance(actor, Actor):
+                wanted.update(i for i, a in enumerate(self.actors) if a == actor)
+            else:
+                wanted.update(i for i, a in enumerate(self.actors) if actor in (a.name, a.email))
+        # END for each actor to match
+        ids = self.committer_ids if committed else self.author_ids
+        return self.take([i for i, actor_id in enumerate(ids) if actor_id in wanted])
+
+    #} END filters
@@ -1,16 +1,19 @@
 """Module with functions which are supposed to be as fast as possible"""
+import heapq
+import threading
 from stat import S_ISDIR
 from git.compat import (
     byte_ord,
-    safe_decode,
     defenc,
     xrange,
     text_type,
     bchr
 )
+from git.odict import OrderedDict
 
-__all__ = ('tree_to_stream', 'tree_entries_from_data', 'traverse_trees_recursive',
-           'traverse_tree_recursive')
+__all__ = ('tree_to_stream', 'tree_entries_from_data', 'iter_tree_entries_from_data',
+           'traverse_trees_recursive', 'traverse_tree_recursive', 'iter_trees_recursive',
+           'iter_tree_changes', 'equal_trees', 'TreeCache')
 
 
 def tree_to_stream(entries, write):
@@ -42,72 +45,144 @@ def tree_to_stream(entries, write):
     # END for each item
 
 
+#{ Tree parsing
+# modes as found in tree data, mapped to their integer value. Some git versions
+# write the leading 0 of tree modes, some don't. Unusual modes are added on demand
+_tree_modes = dict((('%o' % mode).encode('ascii'), mode)
+                   for mode in (0o40000, 0o100644, 0o100755, 0o100664, 0o120000, 0o160000))
+_tree_modes.update((b'0' + key, mode) for key, mode in list(_tree_modes.items()) if len(key) == 5)
+
+
+def _tree_mode(mode_str):
+    """:return: integer mode of the given octal mode string"""
+    mode = 0
+    for c in bytearray(mode_str):
+        mode = (mode << 3) + (c - 48)     # 48 == ord('0')
+    # END for each octal digit
+    _tree_modes[mode_str] = mode
+    return mode
+
+
+def iter_tree_entries_from_data(data):
+    """Lazily reads the binary representation of a tree, without decoding the names
+    of its items.
+    :param data: data block with tree data (as bytes)
+    :return: iterator yielding tuple(binsha, mode, name_bytes) for each item. Use
+        ``safe_decode`` to obtain the tree_relative_path from name_bytes"""
+    find = data.find
+    modes = _tree_modes
+    len_data = len(data)
+    i = 0
+    while i < len_data:
+        # the mode ends at the first space, the name is NULL terminated
+        ms = find(b' ', i)
+        ns = find(b'\0', ms)
+        mode_str = data[i:ms]
+        mode = modes.get(mode_str)
+        if mode is None:
+            mode = _tree_mode(mode_str)
+        # END handle unusual mode
+        i = ns + 21
+        yield (data[ns + 1:i], mode, data[ms + 1:ns])
+    # END for each item in data
+
+
 def tree_entries_from_data(data):
     """Reads the binary representation of a tree and returns tuples of Tree items
     :param data: data block with tree data (as bytes)
     :return: list(tuple(binsha, mode, tree_relative_path), ...)"""
-    ord_zero = ord('0')
-    space_ord = ord(' ')
+    find = data.find
+    modes = _tree_modes
     len_data = len(data)
     i = 0
     out = list()
+    append = out.append
     while i < len_data:
-        mode = 0
+        ms = find(b' ', i)
+        ns = find(b'\0', ms)
+        mode_str = data[i:ms]
+        mode = modes.get(mode_str)
+        if mode is None:
+            mode = _tree_mode(mode_str)
+        # END handle unusual mode
+        i = ns + 21
 
-        # read mode
-        # Some git versions truncate the leading 0, some don't
-        # The type will be extracted from the mode later
-        while byte_ord(data[i]) != space_ord:
-            # move existing mode integer up one level being 3 bits
-            # and add the actual ordinal value of the character
-            mode = (mode << 3) + (byte_ord(data[i]) - ord_zero)
-            i += 1
-        # END while reading mode
+        # default encoding for strings in git is utf8
+        append((data[ns + 1:i], mode, data[ms + 1:ns].decode(defenc, 'surrogateescape')))
+    # END for each item in data
+    return out
 
-        # byte is space now, skip it
-        i += 1
+#} END tree parsing
 
-        # parse name, it is NULL separated
 
-        ns = i
-        while byte_ord(data[i]) != 0:
-            i += 1
-        # END while not reached NULL
+class TreeCache(object):
 
-        # default encoding for strings in git is utf8
-        # Only use the respective unicode object if the byte stream was encoded
-        name = data[ns:i]
-        name = safe_decode(name)
-
-        # byte is NULL, get next 20
-        i += 1
-        sha = data[i:i + 20]
-        i = i + 20
-        out.append((sha, mode, name))
-    # END for each byte in data stream
-    return out
+    """Bounded cache of parsed tree entries, keyed by the binary sha of the tree.
 
+    Trees which were not used for the longest time are evicted once the total size
+    of the tree data exceeds max_size bytes. Entries are handed out as new lists
+    which may be altered freely, the cache itself keeps them as tuples.
 
-def _find_by_name(tree_data, name, is_dir, start_at):
-    """return data entry matching the given name and tree mode
-    or None.
-    Before the item is returned, the respective data item is set
-    None in the tree_data list to mark it done"""
-    try:
-        item = tree_data[start_at]
-        if item and item[2] == name and S_ISDIR(item[1]) == is_dir:
-            tree_data[start_at] = None
-            return item
-    except IndexError:
-        pass
-    # END exception handling
-    for index, item in enumerate(tree_data):
-        if item and item[2] == name and S_ISDIR(item[1]) == is_dir:
-            tree_data[index] = None
-            return item
-        # END if item matches
-    # END for each item
-    return None
+    The cache may be used by multiple threads at once. Trees are read outside of its
+    lock, hence threads missing the same tree at once may both read it.
+
+    ``hits`` and ``misses`` count the requests which could be served from the cache
+    and those which required the tree to be read and parsed."""
+    __slots__ = ('max_size', 'size', 'hits', 'misses', '_trees', '_lock')
+
+    def __init__(self, max_size=8 * 1024 * 1024):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._trees = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._trees)
+
+    def __contains__(self, binsha):
+        return binsha in self._trees
+
+    def entries(self, odb, binsha):
+        """:return: list(tuple(binsha, mode, tree_relative_path), ...) of the tree
+            with the given binary sha, read from the odb if it is not cached yet"""
+        trees = self._trees
+        with self._lock:
+            item = trees.pop(binsha, None)
+            if item is not None:
+                self.hits += 1
+                trees[binsha] = item
+                return list(item[1])
+            # END handle cache hit
+            self.misses += 1
+        # END with lock
+
+        data = odb.stream(binsha).read()
+        item = (len(data), tuple(tree_entries_from_data(data)))
+        with self._lock:
+            if binsha not in trees:
+                self.size += item[0]
+                while trees and self.size > self.max_size:
+                    self.size -= trees.popitem(last=False)[1][0]
+                # END evict least recently used trees
+                trees[binsha] = item
+            # END handle tree added by another thread meanwhile
+        # END with lock
+        return list(item[1])
+
+    def clear(self):
+        """Remove all cached trees and reset the statistics"""
+        with self._lock:
+            self._trees.clear()
+            self.size = self.hits = self.misses = 0
+
+
+def _tree_entries(odb, binsha, cache):
+    """:return: list of entries of the tree with the given binsha, from cache if it is set"""
+    if cache is None:
+        return tree_entries_from_data(odb.stream(binsha).read())
+    return cache.entries(odb, binsha)
 
 
 def _to_full_path(item, path_prefix):
@@ -117,7 +192,83 @@ def _to_full_path(item, path_prefix):
     return (item[0], item[1], path_prefix + item[2])
 
 
-def traverse_trees_recursive(odb, tree_shas, path_prefix):
+def _sorted_by_name(tree_index, data):
+    """:return: list of tuple(key, tree_index, item) for each item of the given tree
+        data, sorted by key. The key is the name of the item, trees have a '/' appended
+        to differentiate them from non-tree items of the same name."""
+    out = [((name + '/' if S_ISDIR(mode) else name), tree_index, (sha, mode, name))
+           for sha, mode, name in data]
+    # git sorts tree items by the very same key, so this usually is a single pass
+    out.sort()
+    return out
+
+
+def equal_trees(entries):
+    """:return: True if all of the given tree entries are present and refer to the
+        same tree. Use it as prune function of ``iter_trees_recursive`` to skip all
+        subtrees which are identical in all trees."""
+    sha = entries[0] and entries[0][0]
+    return sha is not None and all(e is not None and e[0] == sha for e in entries)
+
+
+def iter_trees_recursive(odb, tree_shas, path_prefix, cache=None, prune=None):
+    """Walk the given trees side by side. The entries of all trees are matched by
+    name in a single pass over their sorted entries, as in a merge join.
+
+    :return: iterator yielding tuples of n entries per blob/commit in the same format
+        as ``traverse_trees_recursive``, sorted by path. If prune returned True for a
+        set of trees, the tuple of these tree entries is yielded instead of their
+        contents. Entries which are trees can be told apart by their mode.
+    :param tree_shas: iterable of binary shas pointing to trees on the same level.
+        A tree-sha may be None, which is treated like an empty tree
+    :param path_prefix: a prefix to be added to the returned paths on this level,
+        set it '' for the first iteration
+    :param cache: TreeCache to obtain the trees from, or None to read them from the odb
+    :param prune: Function(entries) returning True if the trees with the given tuple
+        of entries should not be entered. Entries of trees missing on one side are
+        None. If None, all trees are entered. See ``equal_trees``"""
+    nt = len(tree_shas)
+    keyed = list()
+    for ti, tree_sha in enumerate(tree_shas):
+        if tree_sha is not None:
+            keyed.append(_sorted_by_name(ti, _tree_entries(odb, tree_sha, cache)))
+        # END handle muted trees
+    # END for each sha to get data for
+
+    # merge the sorted entries, keys are unique within each tree
+    entries = None
+    last_key = None
+    for key, ti, item in (keyed[0] if len(keyed) == 1 else heapq.merge(*keyed)):
+        if key != last_key:
+            if entries is not None:
+                for out in _iter_matched_entries(odb, last_key, entries, path_prefix, cache, prune):
+                    yield out
+            # END handle previous entries
+            entries = [None] * nt
+            last_key = key
+        # END handle new key
+        entries[ti] = item
+    # END for each item
+    if entries is not None:
+        for out in _iter_matched_entries(odb, last_key, entries, path_prefix, cache, prune):
+            yield out
+    # END handle last entries
+
+
+def _iter_matched_entries(odb, key, entries, path_prefix, cache, prune):
+    """Handle the entries matched for the given key by ``iter_trees_recursive``"""
+    if key[-1] != '/':
+        yield tuple(_to_full_path(e, path_prefix) for e in entries)
+    elif prune is not None and prune(entries):
+        yield tuple(_to_full_path(e, path_prefix) for e in entries)
+    else:
+        for out in iter_trees_recursive(odb, [e and e[0] for e in entries],
+                                        path_prefix + key, cache, prune):
+            yield out
+    # END handle trees
+
+
+def traverse_trees_recursive(odb, tree_shas, path_prefix, cache=None):
     """
     :return: list with entries according to the given binary tree-shas.
         The result is encoded in a list
@@ -131,75 +282,44 @@ def traverse_trees_recursive(odb, tree_shas, path_prefix):
         be on the same level. A tree-sha may be None in which case None
     :param path_prefix: a prefix to be added to the returned paths on this level,
         set it '' for the first iteration
-    :note: The ordering of the returned items will be partially lost"""
-    trees_data = list()
-    nt = len(tree_shas)
-    for tree_sha in tree_shas:
-        if tree_sha is None:
-            data = list()
-        else:
-            data = tree_entries_from_data(odb.stream(tree_sha).read())
-        # END handle muted trees
-        trees_data.append(data)
-    # END for each sha to get data for
+    :param cache: TreeCache to obtain the trees from, or None to read them from the odb
+    :note: The entries are sorted by path. Use ``iter_trees_recursive`` to skip
+        subtrees which don't need to be compared"""
+    return list(iter_trees_recursive(odb, tree_shas, path_prefix, cache))
 
-    out = list()
-    out_append = out.append
-
-    # find all matching entries and recursively process them together if the match
-    # is a tree. If the match is a non-tree item, put it into the result.
-    # Processed items will be set None
-    for ti, tree_data in enumerate(trees_data):
-        for ii, item in enumerate(tree_data):
-            if not item:
-                continue
-            # END skip already done items
-            entries = [None for _ in range(nt)]
-            entries[ti] = item
-            sha, mode, name = item                          # its faster to unpack @UnusedVariable
-            is_dir = S_ISDIR(mode)                          # type mode bits
-
-            # find this item in all other tree data items
-            # wrap around, but stop one before our current index, hence
-            # ti+nt, not ti+1+nt
-            for tio in range(ti + 1, ti + nt):
-                tio = tio % nt
-                entries[tio] = _find_by_name(trees_data[tio], name, is_dir, ii)
-            # END for each other item data
-
-            # if we are a directory, enter recursion
-            if is_dir:
-                out.extend(traverse_trees_recursive(
-                    odb, [((ei and ei[0]) or None) for ei in entries], path_prefix + name + '/'))
-            else:
-                out_append(tuple(_to_full_path(e, path_prefix) for e in entries))
-            # END handle recursion
-
-            # finally mark it done
-            tree_data[ii] = None
-        # END for each item
-
-        # we are done with one tree, set all its data empty
-        del(tree_data[:])
-    # END for each tree_data chunk
-    return out
+
+def iter_tree_changes(odb, a_tree_sha, b_tree_sha, cache=None):
+    """Compare two trees without entering subtrees which are equal in both.
+
+    :return: iterator yielding tuple(a_entry, b_entry) for each blob/commit which
+        differs in sha or mode. The entry of the side it is missing on is None.
+        Entries have the format of ``traverse_tree_recursive``
+    :param a_tree_sha: binary sha of the tree to compare, or None for the empty tree
+    :param b_tree_sha: binary sha of the tree to compare against, or None
+    :param cache: TreeCache to obtain the trees from, or None to read them from the odb"""
+    for a, b in iter_trees_recursive(odb, [a_tree_sha, b_tree_sha], '', cache, equal_trees):
+        if a is not None and b is not None and (a[0] == b[0] and a[1] == b[1]):
+            continue
+        yield a, b
+    # END for each entry pair
 
 
-def traverse_tree_recursive(odb, tree_sha, path_prefix):
+def traverse_tree_recursive(odb, tree_sha, path_prefix, cache=None):
     """
     :return: list of entries of the tree pointed to by the binary tree_sha. An entry
         has the following format:
         * [0] 20 byte sha
         * [1] mode as int
         * [2] path relative to the repository
-    :param path_prefix: prefix to prepend to the front of all returned paths"""
+    :param path_prefix: prefix to prepend to the front of all returned paths
+    :param cache: TreeCache to obtain the trees from, or None to read them from the odb"""
     entries = list()
-    data = tree_entries_from_data(odb.stream(tree_sha).read())
+    data = _tree_entries(odb, tree_sha, cache)
 
     # unpacking/packing is faster than accessing individual items
     for sha, mode, name in data:
         if S_ISDIR(mode):
-            entries.extend(traverse_tree_recursive(odb, sha, path_prefix + name + '/'))
+            entries.extend(traverse_tree_recursive(odb, sha, path_prefix + name + '/', cache))
         else:
             entries.append((sha, mode, path_prefix + name))
     # END for each item
@@ -3,17 +3,20 @@
 #
 # This module is part of GitPython and is released under
 # the BSD License: http://www.opensource.org/licenses/bsd-license.php
+from stat import S_IFMT
+
 from git.util import join_path
 import git.diff as diff
-from git.util import to_bin_sha
+from git.util import to_bin_sha, bin_to_hex
 
 from . import util
 from .base import IndexObject
 from .blob import Blob
 from .submodule.base import Submodule
-from git.compat import string_types
+from git.compat import string_types, defenc
 
 from .fun import (
+    iter_tree_changes,
     tree_entries_from_data,
     tree_to_stream
 )
@@ -193,9 +196,8 @@ class Tree(IndexObject, diff.Diffable, util.Traversable, util.Serializable):
 
     def _set_cache_(self, attr):
         if attr == "_cache":
-            # Set the data when we need it
-            ostream = self.repo.odb.stream(self.binsha)
-            self._cache = tree_entries_from_data(ostream.read())
+            # Set the data when we need it, trees are shared by many commits
+            self._cache = self.repo.tree_cache.entries(self.repo.odb, self.binsha)
         else:
             super(Tree, self)._set_cache_(attr)
         # END handle attribute
@@ -262,6 +264,42 @@ class Tree(IndexObject, diff.Diffable, util.Traversable, util.Serializable):
         """:return: list(Blob, ...) list of blobs directly below this tree"""
         return [i for i in self if i.type == "blob"]
 
+    def diff_tree(self, other=diff.NULL_TREE):
+        """Compare this tree to another one without invoking git. Subtrees which are
+        equal in both trees are not read at all.
+
+        :param other: Tree to compare against. If git.NULL_TREE, all items of this
+            tree are reported as added, like ``diff`` does for commits.
+        :return: git.DiffIndex with one Diff for each changed blob or submodule. Patches
+            are not created and renames are not detected, a renamed path shows up as
+            deleted and added instead."""
+        if other is diff.NULL_TREE:
+            a_sha, b_sha = None, self.binsha
+        else:
+            a_sha, b_sha = self.binsha, other.binsha
+        # END handle empty tree
+
+        index = diff.DiffIndex()
+        for a, b in iter_tree_changes(self.repo.odb, a_sha, b_sha, self.repo.tree_cache):
+            rawpath = (a or b)[2].encode(defenc, 'surrogateescape')
+            a_blob_id = a and bin_to_hex(a[0]).decode('ascii')
+            b_blob_id = b and bin_to_hex(b[0]).decode('ascii')
+            a_mode = a and '%o' % a[1] or '000000'
+            b_mode = b and '%o' % b[1] or '000000'
+            if a is None:
+                change_type = 'A'
+            elif b is None:
+                change_type = 'D'
+            elif S_IFMT(a[1]) != S_IFMT(b[1]):
+                change_type = 'T'
+            else:
+                change_type = 'M'
+            # END handle change type
+            index.append(diff.Diff(self.repo, rawpath, rawpath, a_blob_id, b_blob_id, a_mode, b_mode,
+                                   a is None, b is None, None, None, '', change_type))
+        # END for each changed entry
+        return index
+
     @property
     def cache(self):
         """
@@ -1,3 +1,4 @@
+import errno
 import re
 import time
 
@@ -5,7 +6,8 @@ from git.compat import (
     PY3,
     xrange,
     string_types,
-    defenc
+    defenc,
+    is_win
 )
 from git.objects.util import (
     parse_date,
@@ -25,7 +27,7 @@ from git.util import (
 import os.path as osp
 
 
-__all__ = ["RefLog", "RefLogEntry"]
+__all__ = ["RefLog", "RefLogEntry", "RefLogView"]
 
 
 class RefLogEntry(tuple):
@@ -212,29 +214,21 @@ class RefLog(list, Serializable):
             specify an entry counted from the end of the list
 
         :raise IndexError: If the entry didn't exist
+        :raise IOError: If there is no reflog at filepath
 
         .. note:: This method is faster as it only parses the entry at index, skipping
-            all other lines. Nonetheless, the whole file has to be read if
-            the index is negative
+            all other lines. Negative indices are found by scanning the file backwards,
+            hence the most recent entries are read in constant time
         """
-        fp = open(filepath, 'rb')
-        if index < 0:
-            return RefLogEntry.from_line(fp.readlines()[index].strip())
-        else:
-            # read until index is reached
-            for i in xrange(index + 1):
-                line = fp.readline()
-                if not line:
-                    break
-                # END abort on eof
-            # END handle runup
-
-            if i != index or not line:
-                raise IndexError
-            # END handle exception
-
-            return RefLogEntry.from_line(line.strip())
-        # END handle index
+        if not osp.isfile(filepath):
+            raise IOError(errno.ENOENT, "No reflog at %s" % filepath, filepath)
+        # END handle missing log
+        view = RefLogView(filepath)
+        try:
+            return view[index]
+        finally:
+            view.close()
+        # END assure file is unmapped
 
     def to_file(self, filepath):
         """Write the contents of the reflog instance to a file at the given filepath.
@@ -315,3 +309,146 @@ class RefLog(list, Serializable):
     def _deserialize(self, stream):
         self.extend(self.iter_entries(stream))
     #} END serializable interface
+
+
+class RefLogView(object):
+
+    """Read-only view of a reflog file mapped into memory, providing its entries like a list.
+
+    Entries are only parsed once they are accessed. Those counted from the end, as with
+    negative indices or when iterating in reverse, are found by scanning the file backwards.
+    Hence the most recent entries are available in constant time, independently of the
+    size of the reflog.
+
+    The view reflects the reflog at the time it was created, entries appended afterwards
+    are not seen."""
+
+    __slots__ = ('_path', '_data', '_starts', '_next_start', '_rstarts', '_prev_start')
+
+    def __init__(self, filepath):
+        """Map the reflog at filepath, which may not exist, resulting in an empty view"""
+        self._path = filepath
+        try:
+            # on windows, a mapped file can't be replaced or deleted, which git does to expire
+            # or delete a reflog, hence it is read into memory there
+            self._data = file_contents_ro_filepath(filepath, allow_mmap=not is_win)
+        except (OSError, ValueError):
+            # the file may not exist, or be empty, which cannot be mapped
+            self._data = b''
+        # END handle missing log
+
+        # starts of lines found when scanning forward, and where to continue
+        self._starts = list()
+        self._next_start = 0
+        # starts of lines found when scanning backward, the last line first
+        self._rstarts = list()
+        self._prev_start = len(self._data)
+
+    def close(self):
+        """Unmap the reflog file. The view must not be used afterwards"""
+        if hasattr(self._data, 'close'):
+            self._data.close()
+        self._data = b''
+
+    #{ Utilities
+
+    def _scan_forward(self, count):
+        """Find the starts of the first count lines, or of all lines if there are less"""
+        data = self._data
+        size = len(data)
+        starts = self._starts
+        ofs = self._next_start
+        while len(starts) < count and ofs < size:
+            starts.append(ofs)
+            end = data.find(b'\n', ofs)
+            ofs = size if end < 0 else end + 1
+        # END for each line to find
+        self._next_start = ofs
+
+    def _scan_backward(self, count):
+        """Find the starts of the last count lines, or of all lines if there are less"""
+        data = self._data
+        rstarts = self._rstarts
+        ofs = self._prev_start
+        while len(rstarts) < count and ofs > 0:
+            # the previous line ends before our start, which is a newline unless the
+            # file doesn't end with one
+            end = ofs - 1
+            if ofs == len(data) and data[end:ofs] != b'\n':
+                end = ofs
+            # END handle missing trailing newline
+            ofs = data.rfind(b'\n', 0, end) + 1
+            rstarts.append(ofs)
+        # END for each line to find
+        self._prev_start = ofs
+
+    def _entry(self, start):
+        data = self._data
+        end = data.find(b'\n', start)
+        if end < 0:
+            end = len(data)
+        return RefLogEntry.from_line(data[start:end].strip())
+
+    def _entry_from_end(self, index):
+        """:return: entry at the given index counted from the end, where 0 is the last entry"""
+        self._scan_backward(index + 1)
+        if index >= len(self._rstarts):
+            raise IndexError("Reflog index out of range: %i" % -(index + 1))
+        return self._entry(self._rstarts[index])
+
+    def _entry_from_start(self, index):
+        self._scan_forward(index + 1)
+        if index >= len(self._starts):
+            raise IndexError("Reflog index out of range: %i" % index)
+        return self._entry(self._starts[index])
+
+    #} END utilities
+
+    #{ Interface
+
+    def __len__(self):
+        self._scan_forward(len(self._data))
+        return len(self._starts)
+
+    def __getitem__(self, index):
+        """:return: RefLogEntry at the given index, or list of RefLogEntries if index is
+            a slice. Slices whose bounds are both counted from the end, like [-10:], are
+            read without scanning the whole file"""
+        if isinstance(index, slice):
+            start, stop, step = index.start, index.stop, index.step
+            if step in (None, 1) and start is not None and start < 0 and (stop is None or stop < 0):
+                self._scan_backward(-start)
+                first = min(-start, len(self._rstarts)) - 1
+                last = stop is not None and -stop or 0
+                return [self._entry(self._rstarts[i]) for i in xrange(first, last - 1, -1)]
+            # END handle slices relative to the end
+            return [self[i] for i in xrange(*index.indices(len(self)))]
+        # END handle slices
+
+        if index < 0:
+            return self._entry_from_end(-index - 1)
+        return self._entry_from_start(index)
+
+    def __iter__(self):
+        """:return: iterator yielding all entries, the oldest one first"""
+        index = 0
+        while True:
+            self._scan_forward(index + 1)
+            if index >= len(self._starts):
+                return
+            yield self._entry(self._starts[index])
+            index += 1
+        # END for each line
+
+    def __reversed__(self):
+        """:return: iterator yielding all entries, the most recent one first"""
+        index = 0
+        while True:
+            self._scan_backward(index + 1)
+            if index >= len(self._rstarts):
+                return
+            yield self._entry(self._rstarts[index])
+            index += 1
+        # END for each line
+
+    #} END interface
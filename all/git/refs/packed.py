@@ -0,0 +1,207 @@
+"""Module with an index into git's packed-refs file"""
+import os
+
+from git.compat import defenc, is_win
+from git.util import file_contents_ro_filepath
+
+__all__ = ('PackedRefs', 'read_packed_refs')
+
+
+class PackedRefs(object):
+
+    """Provides the references stored in a packed-refs file, which is mapped into memory,
+    or read into it on windows.
+
+    If git wrote the file with the 'sorted' trait, single references are found by
+    bisecting the mapped file directly. Otherwise all references are read into a
+    dict once they are first looked up.
+
+    All paths and hexshas are returned as strings."""
+    __slots__ = ('path', 'traits', '_stat', '_data', '_start', '_refs')
+
+    _header = b'# pack-refs with:'
+
+    def __init__(self, path, stat=None):
+        """Map the packed-refs file at path
+
+        :param stat: tuple identifying the state of the file, as returned by ``_packed_refs_stat``
+        :raise TypeError: if the file was written using a packing scheme we don't understand"""
+        self.path = path
+        self._stat = stat
+        self._refs = None
+        if stat is not None and stat[2] == 0:
+            self._data = b''        # empty files cannot be mapped
+        else:
+            # on windows, a memory map would prevent git from replacing the file while
+            # the repository keeps us, so we read its contents instead
+            self._data = file_contents_ro_filepath(path, allow_mmap=not is_win)
+        # END handle empty file
+
+        data = self._data
+        self.traits = ()
+        self._start = 0
+        if data[:len(self._header)] == self._header:
+            eol = data.find(b'\n')
+            if eol < 0:
+                eol = len(data)
+            # END handle missing newline
+            self.traits = tuple(t.decode('ascii') for t in data[len(self._header):eol].split())
+            # the git source code shows "peeled", "fully-peeled" and "sorted" as the keywords
+            # that can go on this line, as per comments in git file refs/packed-backend.c
+            if 'peeled' not in self.traits:
+                raise TypeError("PackingType of packed-Refs not understood: %r" % data[:eol].decode(defenc))
+            # END abort if we do not understand the packing scheme
+            self._start = eol + 1
+        # END parse header
+
+    def close(self):
+        if hasattr(self._data, 'close'):
+            self._data.close()
+        self._data = b''
+        self._refs = None
+
+    #{ Interface
+
+    @property
+    def sorted(self):
+        """:return: True if the references are sorted by path in the file"""
+        return 'sorted' in self.traits
+
+    @property
+    def fully_peeled(self):
+        """:return: True if all references pointing to tag objects have their peeled
+            hexsha recorded, instead of only those below refs/tags/"""
+        return 'fully-peeled' in self.traits
+
+    def lookup(self, ref_path):
+        """:return: hexsha of the packed reference at the given full path, or None if
+            there is no such reference"""
+        if not self.sorted:
+            if self._refs is None:
+                self._refs = dict((path, hexsha) for hexsha, path in self)
+            # END read all references once
+            return self._refs.get(ref_path)
+        # END handle unsorted file
+
+        ofs = self._find(ref_path.encode(defenc))
+        data = self._data
+        if ofs >= len(data) or self._path_at(ofs) != ref_path.encode(defenc):
+            return None
+        return data[ofs:ofs + 40].decode('ascii')
+
+    def iter_prefix(self, prefix, peeled=False):
+        """:return: iterator yielding tuple(hexsha, path) pairs of all references whose
+            path starts with prefix, sorted by path if the file is sorted
+        :param peeled: if True, tuple(hexsha, path, peeled_hexsha) triples are yielded,
+            where peeled_hexsha is the object a tag object points to, or None"""
+        if not self.sorted:
+            return (item for item in self._iter_records(self._start, '', peeled) if item[1].startswith(prefix))
+        # END handle unsorted file
+        return self._iter_records(self._find(prefix.encode(defenc)), prefix, peeled)
+
+    def __iter__(self):
+        """:return: iterator yielding tuple(hexsha, path) pairs of all references"""
+        return self._iter_records(self._start, '')
+
+    #} END interface
+
+    #{ Utilities
+
+    def _next_record(self, ofs):
+        """:return: offset of the record after the one at ofs, skipping its peeled line"""
+        data = self._data
+        end = data.find(b'\n', ofs)
+        if end < 0:
+            return len(data)
+        end += 1
+        if data[end:end + 1] == b'^':
+            end = data.find(b'\n', end)
+            end = len(data) if end < 0 else end + 1
+        # END skip peeled line
+        return end
+
+    def _record_at(self, ofs, lo):
+        """:return: offset of the record containing the byte at ofs, which is not before lo"""
+        data = self._data
+        start = data.rfind(b'\n', lo, ofs) + 1
+        if start < lo:
+            start = lo
+        if data[start:start + 1] == b'^' and start > lo:
+            start = max(data.rfind(b'\n', lo, start - 1) + 1, lo)
+        # END handle peeled line
+        return start
+
+    def _path_at(self, ofs):
+        """:return: path of the record at ofs, as bytes"""
+        data = self._data
+        end = data.find(b'\n', ofs)
+        if end < 0:
+            end = len(data)
+        return data[ofs + 41:end].rstrip()
+
+    def _find(self, path):
+        """:return: offset of the first record whose path is not smaller than path, the
+            file size if there is none"""
+        lo, hi = self._start, len(self._data)
+        while lo < hi:
+            ofs = self._record_at((lo + hi) // 2, lo)
+            if self._path_at(ofs) < path:
+                lo = self._next_record(ofs)
+            else:
+                hi = ofs
+            # END handle comparison
+        # END bisect records
+        return lo
+
+    def _iter_records(self, ofs, prefix, peeled=False):
+        data = self._data
+        size = len(data)
+        while ofs < size:
+            end = data.find(b'\n', ofs)
+            if end < 0:
+                end = size
+            line = data[ofs:end].rstrip()
+            ofs = end + 1
+            # skip empty lines, and dereferenced tag object entries - previous line
+            # was the actual tag reference for it
+            if not line or line[:1] in (b'^', b'#'):
+                continue
+            hexsha, path = line.decode(defenc).split(' ', 1)
+            if not path.startswith(prefix):
+                if self.sorted:
+                    break
+                continue
+            # END handle prefix
+            if not peeled:
+                yield hexsha, path
+                continue
+            # END handle peeled
+            peeled_hexsha = None
+            if data[ofs:ofs + 1] == b'^':
+                peeled_hexsha = data[ofs + 1:ofs + 41].decode('ascii')
+            yield hexsha, path, peeled_hexsha
+        # END for each line
+
+    #} END utilities
+
+
+def _packed_refs_stat(path):
+    """:return: tuple identifying the state of the file at path"""
+    st = os.stat(path)
+    return (st.st_ino, st.st_mtime, st.st_size)
+
+
+def read_packed_refs(path, previous=None):
+    """Read the packed-refs file at the given path
+
+    :param previous: PackedRefs returned by a previous call, which is returned again
+        if the file did not change in the meanwhile
+    :return: PackedRefs, or None if there is no such file"""
+    try:
+        stat = _packed_refs_stat(path)
+    except OSError:
+        return None
+    # END handle missing file
+    if previous is not None and previous.path == path and previous._stat == stat:
+        return previous
+    return PackedRefs(path, stat)
@@ -0,0 +1,154 @@
+"""Module providing the state of many references at once"""
+from collections import namedtuple
+from operator import itemgetter
+import os
+import os.path as osp
+
+from git.compat import defenc
+from git.objects import Object
+from git.util import hex_to_bin
+from gitdb.exc import ODBError
+from gitdb.typ import str_tag_type
+
+__all__ = ('RefRecord', 'ref_snapshot')
+
+scandir = getattr(os, 'scandir', None)
+
+#: State of a reference: its full path, the binary sha it resolves to and, if that is a
+#: tag object, the binary sha of the object the tag finally points to, or None otherwise
+RefRecord = namedtuple('RefRecord', ('path', 'binsha', 'peeled'))
+
+
+def _collect_loose_paths(root, rela_dir, out):
+    """Append the paths relative to root of all loose references below rela_dir to out"""
+    directory = osp.join(root, rela_dir)
+    if scandir is not None:
+        try:
+            it = scandir(directory)
+        except OSError:
+            return
+        # END handle missing directory
+        # symbolic links to directories are not followed, like os.walk does
+        entries = [(e.name, e.is_dir(follow_symlinks=False)) for e in it]
+        if hasattr(it, 'close'):
+            it.close()
+    else:
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            return
+        # END handle missing directory
+        entries = [(name, osp.isdir(osp.join(directory, name)) and not osp.islink(osp.join(directory, name)))
+                   for name in names]
+    # END list directory
+
+    for name, is_dir in entries:
+        path = '%s/%s' % (rela_dir, name)
+        if is_dir:
+            _collect_loose_paths(root, path, out)
+        elif not name.endswith('.lock'):
+            out.append(path)
+        # END handle entry type
+    # END for each entry
+
+
+def _peel(repo, binsha):
+    """:return: binary sha of the object the tag object at binsha finally points to,
+        or None if binsha is no tag object"""
+    try:
+        if repo.odb.info(binsha).type != str_tag_type:
+            return None
+        obj = Object.new_from_sha(repo, binsha)
+        while obj.type == 'tag':
+            obj = obj.object
+        # END peel nested tags
+    except (ValueError, ODBError):
+        return None
+    # END handle missing objects
+    return obj.binsha
+
+
+def _read_loose_ref(repo, path, peel):
+    """:return: RefRecord of the loose reference at path, or None if it cannot be resolved"""
+    try:
+        with open(osp.join(repo.common_dir, path), 'rb') as fp:
+            value = fp.read().strip()
+    except (OSError, IOError):
+        return None
+    # END handle vanished reference
+
+    if value.startswith(b'ref:'):
+        # names like HEAD are inserted after the refs module is imported - we have an import
+        # dependency cycle and don't want to import these names at module level
+        from .symbolic import SymbolicReference
+        try:
+            hexsha = SymbolicReference.dereference_recursive(repo, value[4:].strip().decode(defenc))
+        except ValueError:
+            return None
+        # END handle dangling symbolic reference
+    else:
+        hexsha = value.decode('ascii', 'replace')
+    # END handle symbolic reference
+
+    if not repo.re_hexsha_only.match(hexsha):
+        return None
+    binsha = hex_to_bin(hexsha)
+    return RefRecord(path, binsha, peel and _peel(repo, binsha) or None)
+
+
+def ref_snapshot(repo, common_path='refs', peel=True):
+    """Read all references below the given path in one pass, merging loose references
+    with those in the packed-refs file, where the loose ones take precedence.
+
+    :param common_path: path below which references are listed, like 'refs/heads'
+    :param peel: if True, the peeled sha of references pointing to tag objects is determined.
+        Otherwise it is only set for packed references which have it recorded.
+    :return: list of RefRecords sorted by path. Symbolic references are resolved to the
+        sha of the reference they point to, those which cannot be resolved are skipped."""
+    prefix = common_path.rstrip('/') + '/'
+    loose = list()
+    _collect_loose_paths(repo.common_dir, prefix[:-1], loose)
+    loose.sort()
+
+    packed = iter(())
+    packed_refs = repo.packed_refs
+    if packed_refs is not None:
+        packed = packed_refs.iter_prefix(prefix, peeled=True)
+        if not packed_refs.sorted:
+            packed = iter(sorted(packed, key=itemgetter(1)))
+        # END handle unsorted file
+    # END handle packed refs
+
+    def packed_record(item):
+        hexsha, path, peeled_hexsha = item
+        binsha = hex_to_bin(hexsha)
+        if peeled_hexsha is not None:
+            peeled = hex_to_bin(peeled_hexsha)
+        elif not peel or packed_refs.fully_peeled or ('peeled' in packed_refs.traits and
+                                                       path.startswith('refs/tags/')):
+            peeled = None
+        else:
+            peeled = _peel(repo, binsha)
+        # END handle peeled sha
+        return RefRecord(path, binsha, peeled)
+
+    out = list()
+    item = next(packed, None)
+    for path in loose:
+        while item is not None and item[1] < path:
+            out.append(packed_record(item))
+            item = next(packed, None)
+        # END add preceding packed refs
+        if item is not None and item[1] == path:
+            item = next(packed, None)
+        # END skip packed ref overridden by loose one
+        record = _read_loose_ref(repo, path, peel)
+        if record is not None:
+            out.append(record)
+        # END handle unresolvable ref
+    # END for each loose ref
+    while item is not None:
+        out.append(packed_record(item))
+        item = next(packed, None)
+    # END add remaining packed refs
+    return out
@@ -6,9 +6,7 @@ from git.compat import (
 )
 from git.objects import Object, Commit
 from git.util import (
-    join_path,
     join_path_native,
-    to_native_path_linux,
     assure_directory_exists,
     hex_to_bin,
     LockedFD
@@ -20,7 +18,8 @@ from gitdb.exc import (
 
 import os.path as osp
 
-from .log import RefLog
+from .log import RefLog, RefLogView
+from .snapshot import ref_snapshot
 
 
 __all__ = ["SymbolicReference"]
@@ -86,44 +85,14 @@ class SymbolicReference(object):
         return osp.join(repo.common_dir, 'packed-refs')
 
     @classmethod
-    def _iter_packed_refs(cls, repo):
-        """Returns an iterator yielding pairs of sha1/path pairs (as bytes) for the corresponding refs.
-        :note: The packed refs file will be kept open as long as we iterate"""
-        try:
-            with open(cls._get_packed_refs_path(repo), 'rt') as fp:
-                for line in fp:
-                    line = line.strip()
-                    if not line:
-                        continue
-                    if line.startswith('#'):
-                        # "# pack-refs with: peeled fully-peeled sorted"
-                        # the git source code shows "peeled",
-                        # "fully-peeled" and "sorted" as the keywords
-                        # that can go on this line, as per comments in git file
-                        # refs/packed-backend.c
-                        # I looked at master on 2017-10-11,
-                        # commit 111ef79afe, after tag v2.15.0-rc1
-                        # from repo https://github.com/git/git.git
-                        if line.startswith('# pack-refs with:') and 'peeled' not in line:
-                            raise TypeError("PackingType of packed-Refs not understood: %r" % line)
-                        # END abort if we do not understand the packing scheme
-                        continue
-                    # END parse comment
-
-                    # skip dereferenced tag object entries - previous line was actual
-                    # tag reference for it
-                    if line[0] == '^':
-                        continue
-
-                    yield tuple(line.split(' ', 1))
-                # END for each line
-        except (OSError, IOError):
-            return
-        # END no packed-refs file handling
-        # NOTE: Had try-finally block around here to close the fp,
-        # but some python version wouldn't allow yields within that.
-        # I believe files are closing themselves on destruction, so it is
-        # alright.
+    def _iter_packed_refs(cls, repo, prefix=''):
+        """Returns an iterator yielding pairs of sha1/path pairs for the corresponding refs,
+        whose path starts with the given prefix.
+        :note: The packed refs file is kept mapped by the repository, see ``Repo.packed_refs``"""
+        packed_refs = repo.packed_refs
+        if packed_refs is None:
+            return iter(())
+        return packed_refs.iter_prefix(prefix)
 
     @classmethod
     def dereference_recursive(cls, repo, ref_path):
@@ -155,13 +124,11 @@ class SymbolicReference(object):
             # Probably we are just packed, find our entry in the packed refs file
             # NOTE: We are not a symbolic ref if we are in a packed file, as these
             # are excluded explicitly
-            for sha, path in cls._iter_packed_refs(repo):
-                if path != ref_path:
-                    continue
-                # sha will be used
-                tokens = sha, path
-                break
-            # END for each packed ref
+            packed_refs = repo.packed_refs
+            sha = packed_refs is not None and packed_refs.lookup(ref_path)
+            if sha:
+                tokens = sha, ref_path
+            # END handle packed ref
         # END handle packed refs
         if tokens is None:
             raise ValueError("Reference at %r does not exist" % ref_path)
@@ -381,6 +348,13 @@ class SymbolicReference(object):
             instead of calling this method repeatedly. It should be considered read-only."""
         return RefLog.from_file(RefLog.path(self))
 
+    def log_view(self):
+        """
+        :return: RefLogView providing the entries of our reflog, which are only read
+            once they are accessed. It is preferable over ``log()`` if only some of the
+            entries are needed, in particular the most recent ones."""
+        return RefLogView(RefLog.path(self))
+
     def log_append(self, oldbinsha, message, newbinsha=None):
         """Append a logentry to the logfile of this ref
 
@@ -466,10 +440,19 @@ class SymbolicReference(object):
 
                 # write the new lines
                 if made_change:
-                    # write-binary is required, otherwise windows will
-                    # open the file in text mode and change LF to CRLF !
-                    with open(pack_file_path, 'wb') as fd:
-                        fd.writelines(l.encode(defenc) for l in new_lines)
+                    # replace the file instead of truncating it, as it may be mapped
+                    # into memory, see ``Repo.packed_refs``
+                    lfd = LockedFD(pack_file_path)
+                    fd = lfd.open(write=True, stream=True)
+                    ok = False
+                    try:
+                        fd.write(b''.join(l.encode(defenc) for l in new_lines))
+                        lfd.commit()
+                        ok = True
+                    finally:
+                        if not ok:
+                            lfd.rollback()
+                    # END assure lock is released
 
             except (OSError, IOError):
                 pass  # it didn't exist at all
@@ -594,34 +577,20 @@ class SymbolicReference(object):
     def _iter_items(cls, repo, common_path=None):
         if common_path is None:
             common_path = cls._common_path_default
-        rela_paths = set()
-
-        # walk loose refs
-        # Currently we do not follow links
-        for root, dirs, files in os.walk(join_path_native(repo.common_dir, common_path)):
-            if 'refs' not in root.split(os.sep):  # skip non-refs subfolders
-                refs_id = [d for d in dirs if d == 'refs']
-                if refs_id:
-                    dirs[0:] = ['refs']
-            # END prune non-refs folders
-
-            for f in files:
-                if f == 'packed-refs':
-                    continue
-                abs_path = to_native_path_linux(join_path(root, f))
-                rela_paths.add(abs_path.replace(to_native_path_linux(repo.common_dir) + '/', ""))
-            # END for each file in root directory
-        # END for each directory to walk
-
-        # read packed refs
-        for sha, rela_path in cls._iter_packed_refs(repo):  # @UnusedVariable
-            if rela_path.startswith(common_path):
-                rela_paths.add(rela_path)
-            # END relative path matches common path
-        # END packed refs reading
+        rela_paths = [record.path for record in ref_snapshot(repo, common_path or 'refs', peel=False)]
+
+        if not common_path:
+            # references next to the refs folder, like HEAD
+            # Currently we do not follow links
+            for f in os.listdir(repo.common_dir):
+                if f != 'packed-refs' and osp.isfile(osp.join(repo.common_dir, f)):
+                    rela_paths.append(f)
+            # END for each file in the common directory
+            rela_paths.sort()
+        # END handle top-level references
 
         # return paths in sorted order
-        for path in sorted(rela_paths):
+        for path in rela_paths:
             try:
                 yield cls.from_path(repo, path)
             except ValueError:
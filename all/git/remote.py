@@ -7,6 +7,7 @@
 # Module implementing a remote object allowing easy access to git remotes
 import logging
 import re
+import threading
 
 from git.cmd import handle_process_output, Git
 from git.compat import (defenc, force_text, is_win)
@@ -79,6 +80,51 @@ def to_progress_instance(progress):
         return progress
 
 
+class ProgressAggregator(object):
+    """Combines the progress of concurrent fetches or pushes into a single progress instance.
+
+    The counts of each operation are summed up over all processes. An operation begins with
+    the first process starting it, and ends once all processes which started it are done with it.
+    The update() method of the progress instance is called by one thread at a time."""
+    __slots__ = ('_progress', '_lock', '_counts', '_active')
+
+    def __init__(self, progress):
+        self._progress = to_progress_instance(progress)
+        self._lock = threading.Lock()
+        self._counts = dict()   # op_code -> {process key: (cur_count, max_count)}
+        self._active = dict()   # op_code -> set(process keys)
+
+    def new_progress(self):
+        """:return: RemoteProgress instance for one more process, reporting to our progress"""
+        key = object()
+        return CallableRemoteProgress(lambda *args: self._update(key, *args))
+
+    def _update(self, key, op_code, cur_count, max_count=None, message=''):
+        op = op_code & RemoteProgress.OP_MASK
+        with self._lock:
+            counts = self._counts.setdefault(op, dict())
+            active = self._active.setdefault(op, set())
+            stage = 0
+            if op_code & RemoteProgress.BEGIN:
+                if not active:
+                    stage |= RemoteProgress.BEGIN
+                active.add(key)
+            # END handle begin
+            counts[key] = (cur_count or 0, max_count)
+            if op_code & RemoteProgress.END:
+                active.discard(key)
+                if not active:
+                    stage |= RemoteProgress.END
+            # END handle end
+
+            max_counts = [m for c, m in counts.values()]
+            max_count = None
+            if None not in max_counts:
+                max_count = float(sum(max_counts))
+            self._progress.update(op | stage, float(sum(c for c, m in counts.values())), max_count, message)
+        # END serialize updates
+
+
 class PushInfo(object):
     """
     Carries information about the result of a push operation of a single head::
@@ -4,7 +4,7 @@
 # This module is part of GitPython and is released under
 # the BSD License: http://www.opensource.org/licenses/bsd-license.php
 
-from collections import namedtuple
+from collections import deque, namedtuple
 import logging
 import os
 import re
@@ -25,16 +25,23 @@ from git.compat import (
 from git.config import GitConfigParser
 from git.db import GitCmdObjectDB
 from git.exc import InvalidGitRepositoryError, NoSuchPathError, GitCommandError
+from gitdb.exc import ODBError
 from git.index import IndexFile
 from git.objects import Submodule, RootModule, Commit
+from git.objects.fun import TreeCache
 from git.refs import HEAD, Head, Reference, TagReference
-from git.remote import Remote, add_progress, to_progress_instance
+from git.refs.packed import read_packed_refs
+from git.refs.snapshot import ref_snapshot
+from git.remote import Remote, ProgressAggregator, add_progress, to_progress_instance
 from git.util import Actor, finalize_process, decygpath, hex_to_bin, expand_path
 import os.path as osp
 
 from .fun import rev_parse, is_git_dir, find_submodule_git_dir, touch, find_worktree_git_dir
+from .graph import read_commit_graph, is_ancestor, merge_bases
+from .watch import RefWatcher
 import gc
 import gitdb
+from multiprocessing import cpu_count
 
 
 log = logging.getLogger(__name__)
@@ -58,13 +65,24 @@ class Repo(object):
     'working_tree_dir' is the working tree directory, but will raise AssertionError
     if we are a bare repository.
 
-    'git_dir' is the .git repository directory, which is always set."""
+    'git_dir' is the .git repository directory, which is always set.
+
+    'tree_cache' is the TreeCache holding the entries of recently parsed trees.
+
+    'commit_graph' is the CommitGraph of the object database, if git wrote one.
+
+    'packed_refs' is the PackedRefs index of the packed-refs file, if there is one.
+
+    'ref_watcher' is the RefWatcher noticing changes of references and the index."""
     DAEMON_EXPORT_FILE = 'git-daemon-export-ok'
 
     git = None  # Must exist, or  __del__  will fail in case we raise on `__init__()`
     working_dir = None
     _working_tree_dir = None
     git_dir = None
+    _commit_graph = None
+    _packed_refs = None
+    _ref_watcher = None
     _common_dir = None
 
     # precompiled regex
@@ -187,6 +205,16 @@ class Repo(object):
         if issubclass(odbt, GitCmdObjectDB):
             args.append(self.git)
         self.odb = odbt(*args)
+        self.tree_cache = TreeCache()
+
+    # attributes holding mapped files, which are read again once unpickled
+    _excluded_ = ('_commit_graph', '_packed_refs', '_ref_watcher')
+
+    def __getstate__(self):
+        d = self.__dict__.copy()
+        for name in self._excluded_:
+            d.pop(name, None)
+        return d
 
     def __enter__(self):
         return self
@@ -201,6 +229,17 @@ class Repo(object):
             pass
 
     def close(self):
+        if self._commit_graph is not None:
+            self._commit_graph.close()
+            self._commit_graph = None
+        # END release commit graph
+        if self._packed_refs is not None:
+            self._packed_refs.close()
+            self._packed_refs = None
+        # END release packed refs
+        if self._ref_watcher is not None:
+            self._ref_watcher.close()
+        # END stop watching
         if self.git:
             self.git.clear_cache()
             # Tempfiles objects on Windows are holding references to
@@ -281,6 +320,43 @@ class Repo(object):
     # alias for heads
     branches = heads
 
+    def ref_snapshot(self, common_path='refs', peel=True):
+        """Read the state of all references below common_path at once, which is faster than
+        resolving references one by one.
+
+        :param common_path: path below which references are listed, like 'refs/heads'
+        :param peel: if True, also find the objects references to tag objects finally point to
+        :return: list of RefRecord(path, binsha, peeled) tuples, sorted by path"""
+        return ref_snapshot(self, common_path, peel)
+
+    @property
+    def ref_watcher(self):
+        """:return: RefWatcher noticing changes of HEAD, the references and the index"""
+        if self._ref_watcher is None:
+            self._ref_watcher = RefWatcher(self.git_dir, self.common_dir)
+        return self._ref_watcher
+
+    @property
+    def ref_generation(self):
+        """:return: number which is incremented whenever HEAD, a reference or the index changed.
+            Values derived from them can be cached until the generation changes."""
+        return self.ref_watcher.poll()
+
+    def subscribe_ref_changes(self, callback):
+        """Call callback(generation) once a change of HEAD, a reference or the index is
+        noticed, which happens when the ``ref_generation`` is queried, or periodically
+        after ``ref_watcher.start()`` was called.
+
+        :return: callback"""
+        return self.ref_watcher.subscribe(callback)
+
+    @property
+    def packed_refs(self):
+        """:return: PackedRefs index of our packed-refs file, or None if there is none.
+            It is read again once the file changes on disk."""
+        self._packed_refs = read_packed_refs(osp.join(self.common_dir, 'packed-refs'), self._packed_refs)
+        return self._packed_refs
+
     @property
     def index(self):
         """:return: IndexFile representing this repository's index.
@@ -307,6 +383,56 @@ class Repo(object):
             raise ValueError("Remote named '%s' didn't exist" % name)
         return r
 
+    def fetch_all(self, remotes=None, repos=(), progress=None, max_threads=None, **kwargs):
+        """Fetch the latest changes of many remotes and repositories concurrently
+
+        :param remotes:
+            names of the remotes to fetch in each repository, or None to fetch all of their remotes
+        :param repos: iterable of further Repo instances to fetch into along with this one
+        :param progress:
+            progress instance or callable, see the 'push' method of Remote. It receives the
+            combined progress of all fetches, with the counts of each operation summed up.
+        :param max_threads:
+            the maximum amount of repositories to fetch into at once, or None to use one per CPU.
+            Remotes of the same repository are always fetched one after another, as each
+            fetch overwrites the repository's FETCH_HEAD file.
+        :param kwargs: Additional arguments to be passed to Remote.fetch
+        :return:
+            list of (Remote, IterableList(FetchInfo, ...)) tuples, in the order of the
+            repositories and their remotes"""
+        unique_repos = list()
+        git_dirs = set()
+        for repo in [self] + list(repos):
+            if repo.git_dir not in git_dirs:
+                git_dirs.add(repo.git_dir)
+                unique_repos.append(repo)
+        # END for each repository
+        aggregator = progress is not None and ProgressAggregator(progress) or None
+
+        def fetch(repo):
+            if remotes is None:
+                repo_remotes = repo.remotes
+            else:
+                repo_remotes = [repo.remote(str(name)) for name in remotes]
+            # END handle remotes
+            return [(remote, remote.fetch(progress=aggregator and aggregator.new_progress(), **kwargs))
+                    for remote in repo_remotes]
+
+        if max_threads is None:
+            max_threads = cpu_count()
+        max_threads = min(max_threads, len(unique_repos))
+        if max_threads < 2:
+            return [result for repo in unique_repos for result in fetch(repo)]
+        # END handle serial fetch
+
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(max_threads)
+        try:
+            return [result for results in pool.map(fetch, unique_repos) for result in results]
+        finally:
+            pool.terminate()
+        # END assure threads are stopped
+
     #{ Submodules
 
     @property
@@ -433,7 +559,7 @@ class Repo(object):
             files = [self._get_config_path(f) for f in self.config_level]
         else:
             files = [self._get_config_path(config_level)]
-        return GitConfigParser(files, read_only=True)
+        return GitConfigParser(files, read_only=True, repo=self)
 
     def config_writer(self, config_level="repository"):
         """
@@ -495,7 +621,8 @@ class Repo(object):
 
         :parm kwargs:
             Arguments to be passed to git-rev-list - common ones are
-            max_count and skip
+            max_count and skip. Pass prefetch=True to read the data of all commits
+            while iterating, see ``Commit.iter_items``
 
         :note: to receive only commits between two named revisions, use the
             "revA...revB" revision specifier
@@ -506,6 +633,35 @@ class Repo(object):
 
         return Commit.iter_items(self, rev, paths, **kwargs)
 
+    @property
+    def commit_graph(self):
+        """:return: CommitGraph of our object database, or None if there is none or it
+            cannot be read. It is read again once git rewrites it."""
+        try:
+            self._commit_graph = read_commit_graph(osp.join(self.common_dir, 'objects'), self._commit_graph)
+        except (OSError, IOError, ValueError, ODBError) as err:
+            log.debug("Could not read commit graph: %s", err)
+            self._commit_graph = None
+        # END handle unreadable graph
+        return self._commit_graph
+
+    def _load_commit_parents(self, binsha):
+        """:return: tuple(commit_time, parent_binshas) of the commit with the given binsha,
+            as required for commits outside of the commit graph"""
+        commit = Commit(self, binsha)
+        return commit.committed_date, [p.binsha for p in commit.parents]
+
+    def _graph_binshas(self, revs):
+        """:return: list of binary shas of the commits revs point to, or None if we cannot
+            answer queries about them in-process"""
+        if self.commit_graph is None or not all(revs):
+            return None
+        try:
+            return [r.binsha if isinstance(r, Commit) else self.commit(r).binsha for r in revs]
+        except (ValueError, IndexError, KeyError, ODBError):
+            return None
+        # END let git handle bad revisions
+
     def merge_base(self, *rev, **kwargs):
         """Find the closest common ancestor for the given revision (e.g. Commits, Tags, References, etc)
 
@@ -514,11 +670,20 @@ class Repo(object):
         :return: A list of Commit objects. If --all was not specified as kwarg, the list will have at max one Commit,
             or is empty if no common merge base exists.
         :raises ValueError: If not at least two revs are provided
-        """
+        :note: the merge base of two revisions is computed in-process if the repository
+            has a commit graph and no kwargs are given"""
         if len(rev) < 2:
             raise ValueError("Please specify at least two revs, got only %i" % len(rev))
         # end handle input
 
+        binshas = not kwargs and len(rev) == 2 and self._graph_binshas(rev)
+        if binshas:
+            bases = merge_bases(self.commit_graph, self._load_commit_parents, *binshas)
+            # git picks one of several best merge bases, let it decide which one
+            if len(bases) < 2:
+                return [Commit(self, binsha) for binsha in bases]
+        # END handle in-process merge base
+
         res = list()
         try:
             lines = self.git.merge_base(*rev, **kwargs).splitlines()
@@ -543,7 +708,13 @@ class Repo(object):
         :param ancestor_rev: Rev which should be an ancestor
         :param rev: Rev to test against ancestor_rev
         :return: ``True``, ancestor_rev is an accestor to rev.
+        :note: the check is done in-process if the repository has a commit graph
         """
+        binshas = self._graph_binshas((ancestor_rev, rev))
+        if binshas:
+            return is_ancestor(self.commit_graph, self._load_commit_parents, *binshas)
+        # END handle in-process check
+
         try:
             self.git.merge_base(ancestor_rev, rev, is_ancestor=True)
         except GitCommandError as err:
@@ -604,6 +775,21 @@ class Repo(object):
     alternates = property(_get_alternates, _set_alternates,
                           doc="Retrieve a list of alternates paths or set a list paths to be used as alternates")
 
+    def _working_tree_maybe_dirty(self, submodules, path):
+        """:return: False if the working tree is known to match the index, True if
+            changes are possible and need to be confirmed by git"""
+        if path and ('*' in path or '?' in path or '[' in path or path.startswith(':') or
+                     '..' in path.replace('\\', '/').split('/')):
+            return True
+        # END pathspecs and paths leaving the working tree are only understood by git
+        index = self.index
+        if submodules and any(e.mode == IndexFile.S_IFGITLINK for e in index.entries.values()):
+            return True
+        # END submodule state is only known to git
+        for d in index.iter_working_tree_changes(paths=path and [path]):  # @UnusedVariable
+            return True
+        return False
+
     def is_dirty(self, index=True, working_tree=True, untracked_files=False,
                  submodules=True, path=None):
         """
@@ -629,8 +815,9 @@ class Repo(object):
                 return True
         # END index handling
         if working_tree:
-            # diff index against working tree
-            if len(self.git.diff(*default_args)):
+            # diff index against working tree. Comparing stat data is exact if it finds
+            # no change, otherwise git confirms it as it applies filters
+            if self._working_tree_maybe_dirty(submodules, path) and len(self.git.diff(*default_args)):
                 return True
         # END working tree handling
         if untracked_files:
@@ -689,13 +876,17 @@ class Repo(object):
         :return: Head to the active branch"""
         return self.head.reference
 
-    def blame_incremental(self, rev, file, **kwargs):
+    def blame_incremental(self, rev, file, commits=None, **kwargs):
         """Iterator for blame information for the given file at the given revision.
 
         Unlike .blame(), this does not return the actual file's contents, only
-        a stream of BlameEntry tuples.
+        a stream of BlameEntry tuples. The output of git-blame is parsed while it
+        is produced, hence the first entries are available before git is done.
 
         :parm rev: revision specifier, see git-rev-parse for viable options.
+        :param commits: optional dict mapping hexshas to Commit objects. It is used
+            to cache the commits seen in the blame output, and may be shared among
+            calls to avoid parsing commit information once per file.
         :return: lazy iterator of BlameEntry tuples, where the commit
                  indicates the commit to blame for the line, and range
                  indicates a span of line numbers in the resulting file.
@@ -703,56 +894,124 @@ class Repo(object):
         If you combine all line number ranges outputted by this command, you
         should get a continuous range spanning all line numbers in the file.
         """
-        data = self.git.blame(rev, '--', file, p=True, incremental=True, stdout_as_string=False, **kwargs)
-        commits = dict()
+        if commits is None:
+            commits = dict()
+        # END handle commit cache
+        proc = self.git.blame(rev, '--', file, p=True, incremental=True, as_process=True, **kwargs)
+        readline = proc.stdout.readline
 
-        stream = (line for line in data.split(b'\n') if line)
-        while True:
-            line = next(stream)  # when exhausted, causes a StopIteration, terminating this function
-            hexsha, orig_lineno, lineno, num_lines = line.split()
-            lineno = int(lineno)
-            num_lines = int(num_lines)
-            orig_lineno = int(orig_lineno)
-            if hexsha not in commits:
-                # Now read the next few lines and build up a dict of properties
-                # for this commit
+        completed = False
+        try:
+            while True:
+                line = readline()
+                if not line:
+                    break
+                line = line.rstrip(b'\n')
+                if not line:
+                    continue
+                hexsha, orig_lineno, lineno, num_lines = line.split()
+                lineno = int(lineno)
+                num_lines = int(num_lines)
+                orig_lineno = int(orig_lineno)
+
+                # Read the properties of this entry up to "filename", which formally
+                # terminates the entry for --incremental. Properties are only kept
+                # for commits we don't know yet.
+                commit = commits.get(hexsha)
                 props = dict()
                 while True:
-                    line = next(stream)
+                    line = readline()
+                    if not line:
+                        raise ValueError("Unexpected end of blame output for %s" % hexsha.decode('ascii'))
+                    line = line.rstrip(b'\n')
                     if line == b'boundary':
                         # "boundary" indicates a root commit and occurs
                         # instead of the "previous" tag
                         continue
 
                     tag, value = line.split(b' ', 1)
-                    props[tag] = value
                     if tag == b'filename':
-                        # "filename" formally terminates the entry for --incremental
                         orig_filename = value
                         break
+                    if commit is None:
+                        props[tag] = value
+                # END for each property
+
+                if commit is None:
+                    commit = Commit(self, hex_to_bin(hexsha),
+                                    author=Actor(safe_decode(props[b'author']),
+                                                 safe_decode(props[b'author-mail'].lstrip(b'<').rstrip(b'>'))),
+                                    authored_date=int(props[b'author-time']),
+                                    committer=Actor(safe_decode(props[b'committer']),
+                                                    safe_decode(props[b'committer-mail'].lstrip(b'<').rstrip(b'>'))),
+                                    committed_date=int(props[b'committer-time']))
+                    commits[hexsha] = commit
+                # END handle new commit
+
+                yield BlameEntry(commit,
+                                 range(lineno, lineno + num_lines),
+                                 safe_decode(orig_filename),
+                                 range(orig_lineno, orig_lineno + num_lines))
+            # END for each entry
+            completed = True
+        finally:
+            if not completed:
+                # the consumer stopped iterating or we failed to parse the output - don't leave git running
+                kill = getattr(proc, '__del__', None)
+                if kill is not None:
+                    kill()
+            # END kill unfinished process
+        # END handle process
 
-                c = Commit(self, hex_to_bin(hexsha),
-                           author=Actor(safe_decode(props[b'author']),
-                                        safe_decode(props[b'author-mail'].lstrip(b'<').rstrip(b'>'))),
-                           authored_date=int(props[b'author-time']),
-                           committer=Actor(safe_decode(props[b'committer']),
-                                           safe_decode(props[b'committer-mail'].lstrip(b'<').rstrip(b'>'))),
-                           committed_date=int(props[b'committer-time']))
-                commits[hexsha] = c
-            else:
-                # Discard all lines until we find "filename" which is
-                # guaranteed to be the last line
-                while True:
-                    line = next(stream)  # will fail if we reach the EOF unexpectedly
-                    tag, value = line.split(b' ', 1)
-                    if tag == b'filename':
-                        orig_filename = value
-                        break
+        finalize_process(proc)
 
-            yield BlameEntry(commits[hexsha],
-                             range(lineno, lineno + num_lines),
-                             safe_decode(orig_filename),
-                             range(orig_lineno, orig_lineno + num_lines))
+    def blame_many(self, rev, files, max_threads=None, **kwargs):
+        """Iterator for the incremental blame information of many files at the given revision.
+
+        The files are blamed by concurrent git-blame processes, and all of them share
+        the same cache of commits, which are thus created only once.
+
+        :parm rev: revision specifier, see git-rev-parse for viable options.
+        :param files: iterable of paths to blame
+        :param max_threads: the maximum amount of git-blame processes to run at once,
+            or None to use one per CPU. A value smaller than 2 blames one file after
+            another.
+        :param kwargs: additional arguments passed to blame_incremental()
+        :return: iterator yielding (file, [BlameEntry, ...]) tuples, in the order
+            of the given files. At most two files per thread are blamed ahead of the
+            consumer."""
+        files = list(files)
+        commits = dict()
+        blame = lambda path: list(self.blame_incremental(rev, path, commits=commits, **kwargs))
+
+        if max_threads is None:
+            max_threads = cpu_count()
+        max_threads = min(max_threads, len(files))
+        if max_threads < 2:
+            for path in files:
+                yield path, blame(path)
+            return
+        # END handle serial blame
+
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(max_threads)
+        pending = deque()
+        try:
+            # submit a bounded window of files, so the results waiting for the consumer
+            # don't grow with the amount of files
+            for path in files:
+                pending.append((path, pool.apply_async(blame, (path,))))
+                if len(pending) >= 2 * max_threads:
+                    path, result = pending.popleft()
+                    yield path, result.get()
+            # END for each file to blame
+            while pending:
+                path, result = pending.popleft()
+                yield path, result.get()
+            # END for each pending file
+        finally:
+            pool.terminate()
+        # END assure threads are stopped
 
     def blame(self, rev, file, incremental=False, **kwargs):
         """The blame information for the given file at the given revision.
@@ -0,0 +1,378 @@
+"""Module with a reader for git's commit-graph files and ancestry queries built on it"""
+from heapq import heappush, heappop
+import os
+import os.path as osp
+
+from git.compat import xrange, is_win
+from gitdb.exc import ParseError
+from gitdb.util import file_contents_ro_filepath, unpack_from
+
+__all__ = ('CommitGraph', 'CommitGraphFile', 'read_commit_graph', 'is_ancestor', 'merge_bases')
+
+
+#{ Commit graph format
+GRAPH_SIGNATURE = b'CGPH'
+GRAPH_VERSION = 1
+GRAPH_HASH_VERSION_SHA1 = 1
+GRAPH_PARENT_NONE = 0x70000000
+GRAPH_EXTRA_EDGES_NEEDED = 0x80000000
+GRAPH_EDGE_LAST_MASK = 0x7fffffff
+GRAPH_LAST_EDGE = 0x80000000
+
+#: generation of commits whose generation is unknown, as they are not part of
+#: the graph or were written by a git version which didn't compute generations
+GENERATION_NUMBER_INFINITY = 0xffffffff
+
+_commit_data_size = 20 + 16
+#} END commit graph format
+
+
+class CommitGraphFile(object):
+
+    """A single commit-graph file, mapped into memory.
+
+    Commits are identified by their position within the graph. If the file is part
+    of a chain of split commit-graphs, positions continue those of its base graphs,
+    which is why the amount of commits in base graphs must be given."""
+    __slots__ = ('path', 'base_count', 'num_commits', '_data', '_fanout', '_oid_lookup',
+                 '_commit_data', '_extra_edges')
+
+    def __init__(self, path, base_count=0):
+        """Map the commit graph at path and read its chunk table
+        :raise ParseError: if the file is no commit graph we can read"""
+        self.path = path
+        self.base_count = base_count
+        # mapped directly, as the memory manager would keep showing a previous version
+        # of a file git rewrote in place. On windows, a memory map would prevent git from
+        # replacing the file, so we read its contents instead.
+        self._data = data = file_contents_ro_filepath(path, allow_mmap=not is_win)
+        signature, version, hash_version, num_chunks = unpack_from(">4sBBB", data, 0)
+        if signature != GRAPH_SIGNATURE:
+            raise ParseError("Invalid commit graph signature in %s: %r" % (path, signature))
+        if version != GRAPH_VERSION or hash_version != GRAPH_HASH_VERSION_SHA1:
+            raise ParseError("Unsupported commit graph version %i with hash version %i in %s"
+                             % (version, hash_version, path))
+        # END verify header
+
+        chunks = dict()
+        for i in xrange(num_chunks):
+            chunk_id, offset = unpack_from(">4sQ", data, 8 + i * 12)
+            chunks[chunk_id] = offset
+        # END for each chunk
+
+        try:
+            self._fanout = chunks[b'OIDF']
+            self._oid_lookup = chunks[b'OIDL']
+            self._commit_data = chunks[b'CDAT']
+        except KeyError as err:
+            raise ParseError("Commit graph at %s misses required chunk %s" % (path, err))
+        # END handle missing chunks
+        self._extra_edges = chunks.get(b'EDGE')
+        self.num_commits = unpack_from(">L", data, self._fanout + 255 * 4)[0]
+
+    def close(self):
+        if hasattr(self._data, 'close'):
+            self._data.close()
+        self._data = None
+
+    def lookup(self, binsha):
+        """:return: position of the commit with the given binary sha, or None if it
+            is not part of this file"""
+        data = self._data
+        first = ord(binsha[0:1])
+        lo = first and unpack_from(">L", data, self._fanout + (first - 1) * 4)[0]
+        hi = unpack_from(">L", data, self._fanout + first * 4)[0]
+        base = self._oid_lookup
+        while lo < hi:
+            mid = (lo + hi) // 2
+            ofs = base + mid * 20
+            mid_sha = data[ofs:ofs + 20]
+            if mid_sha < binsha:
+                lo = mid + 1
+            elif mid_sha > binsha:
+                hi = mid
+            else:
+                return self.base_count + mid
+            # END handle comparison
+        # END binary search
+        return None
+
+    def binsha(self, pos):
+        """:return: binary sha of the commit at the given position"""
+        ofs = self._oid_lookup + (pos - self.base_count) * 20
+        return self._data[ofs:ofs + 20]
+
+    def commit_data(self, pos):
+        """:return: tuple(tree_binsha, parent_positions, generation, commit_time) of the
+            commit at the given position"""
+        data = self._data
+        ofs = self._commit_data + (pos - self.base_count) * _commit_data_size
+        tree = data[ofs:ofs + 20]
+        parent1, parent2, word1, word2 = unpack_from(">LLLL", data, ofs + 20)
+
+        parents = list()
+        if parent1 != GRAPH_PARENT_NONE:
+            parents.append(parent1)
+            if parent2 & GRAPH_EXTRA_EDGES_NEEDED:
+                ofs = self._extra_edges + (parent2 & GRAPH_EDGE_LAST_MASK) * 4
+                while True:
+                    edge = unpack_from(">L", data, ofs)[0]
+                    parents.append(edge & GRAPH_EDGE_LAST_MASK)
+                    if edge & GRAPH_LAST_EDGE:
+                        break
+                    ofs += 4
+                # END for each extra edge
+            elif parent2 != GRAPH_PARENT_NONE:
+                parents.append(parent2)
+            # END handle second parent
+        # END handle parents
+
+        generation = (word1 >> 2) or GENERATION_NUMBER_INFINITY
+        commit_time = ((word1 & 0x3) << 32) | word2
+        return tree, parents, generation, commit_time
+
+
+class CommitGraph(object):
+
+    """The commit graph of a repository, which consists of a single file or of a
+    chain of split commit-graph files.
+
+    It provides the parents, generation number, commit time and root tree of all
+    commits it contains without reading the commits themselves. Parents of commits
+    in the graph are always part of the graph as well."""
+    __slots__ = ('files', '_stat')
+
+    def __init__(self, files, stat=None):
+        """
+        :param files: list of CommitGraphFile instances, the base graph first
+        :param stat: identification of the state of the files on disk, which
+            allows to tell whether they changed"""
+        self.files = files
+        self._stat = stat
+
+    def __len__(self):
+        return sum(f.num_commits for f in self.files)
+
+    def __contains__(self, binsha):
+        return self.lookup(binsha) is not None
+
+    def _file(self, pos):
+        for graph_file in reversed(self.files):
+            if pos >= graph_file.base_count:
+                return graph_file
+        # END for each file
+        raise IndexError(pos)
+
+    def close(self):
+        for graph_file in self.files:
+            graph_file.close()
+        # END for each file
+
+    def lookup(self, binsha):
+        """:return: position of the commit with the given binary sha, or None if it
+            is not part of the graph"""
+        for graph_file in self.files:
+            pos = graph_file.lookup(binsha)
+            if pos is not None:
+                return pos
+        # END for each file
+        return None
+
+    def binsha(self, pos):
+        """:return: binary sha of the commit at the given position"""
+        return self._file(pos).binsha(pos)
+
+    def commit_data(self, pos):
+        """:return: tuple(tree_binsha, parent_positions, generation, commit_time) of the
+            commit at the given position. The generation is GENERATION_NUMBER_INFINITY
+            if it is not known"""
+        return self._file(pos).commit_data(pos)
+
+    def parents(self, pos):
+        """:return: list of positions of the parents of the commit at pos"""
+        return self.commit_data(pos)[1]
+
+    def generation(self, pos):
+        """:return: generation number of the commit at pos, see ``commit_data``"""
+        return self.commit_data(pos)[2]
+
+    def tree(self, pos):
+        """:return: binary sha of the root tree of the commit at pos"""
+        return self.commit_data(pos)[0]
+
+
+def _graph_stat(path):
+    """:return: tuple identifying the state of the file at path"""
+    st = os.stat(path)
+    return (path, st.st_ino, st.st_size, st.st_mtime)
+
+
+def read_commit_graph(objects_dir, previous=None):
+    """Read the commit graph of the given object directory
+
+    :param objects_dir: path to the objects directory of a repository
+    :param previous: CommitGraph returned by a previous call, which is returned again
+        if the files on disk did not change in the meanwhile
+    :return: CommitGraph, or None if there is no commit graph
+    :raise ParseError: if the commit graph cannot be read"""
+    single_path = osp.join(objects_dir, 'info', 'commit-graph')
+    chain_path = osp.join(objects_dir, 'info', 'commit-graphs', 'commit-graph-chain')
+    for path in (single_path, chain_path):
+        try:
+            stat = _graph_stat(path)
+        except OSError:
+            continue
+        # END handle missing file
+        if previous is not None and previous._stat == stat:
+            return previous
+
+        if path == single_path:
+            return CommitGraph([CommitGraphFile(path)], stat)
+
+        files = list()
+        base_count = 0
+        with open(path, 'rb') as fp:
+            hexshas = fp.read().decode('ascii').split()
+        for hexsha in hexshas:
+            graph_file = CommitGraphFile(osp.join(osp.dirname(path), 'graph-%s.graph' % hexsha), base_count)
+            base_count += graph_file.num_commits
+            files.append(graph_file)
+        # END for each graph in chain
+        return CommitGraph(files, stat)
+    # END for each commit graph location
+    return None
+
+
+#{ Ancestry
+
+class _CommitInfo(object):
+
+    """Provides generation, commit time and parents of commits, using the commit
+    graph where possible and reading the commits from the object database otherwise"""
+    __slots__ = ('graph', 'load_commit', '_info')
+
+    def __init__(self, graph, load_commit):
+        """:param load_commit: Function(binsha) returning tuple(commit_time, parent_binshas)
+            of commits which are not part of the graph"""
+        self.graph = graph
+        self.load_commit = load_commit
+        self._info = dict()
+
+    def __call__(self, binsha):
+        """:return: tuple(generation, commit_time, parent_binshas, in_graph)"""
+        try:
+            return self._info[binsha]
+        except KeyError:
+            pass
+        # END handle cached info
+        graph = self.graph
+        pos = graph.lookup(binsha) if graph is not None else None
+        if pos is not None:
+            tree, parents, generation, commit_time = graph.commit_data(pos)
+            info = (generation, commit_time, [graph.binsha(p) for p in parents], True)
+        else:
+            commit_time, parents = self.load_commit(binsha)
+            info = (GENERATION_NUMBER_INFINITY, commit_time, parents, False)
+        # END handle commit outside of graph
+        self._info[binsha] = info
+        return info
+
+
+def is_ancestor(graph, load_commit, ancestor, binsha):
+    """:return: True if the commit ancestor is reachable from the commit binsha, or
+        the same commit.
+
+    Commits with a generation number not above the one of ancestor are not entered,
+    as ancestor cannot be reachable from them.
+
+    :param graph: CommitGraph or None
+    :param load_commit: Function(binsha) returning tuple(commit_time, parent_binshas)
+        for commits which are not part of the graph
+    :param ancestor: binary sha of the potential ancestor
+    :param binsha: binary sha of the commit to start from"""
+    if ancestor == binsha:
+        return True
+    info = _CommitInfo(graph, load_commit)
+    min_generation, _, _, ancestor_in_graph = info(ancestor)
+
+    stack = [binsha]
+    seen = set(stack)
+    while stack:
+        for parent in info(stack.pop())[2]:
+            if parent == ancestor:
+                return True
+            if parent in seen:
+                continue
+            seen.add(parent)
+            generation, _, _, in_graph = info(parent)
+            # ancestors of commits in the graph are in the graph as well
+            if in_graph and not ancestor_in_graph:
+                continue
+            if generation <= min_generation and min_generation != GENERATION_NUMBER_INFINITY:
+                continue
+            stack.append(parent)
+        # END for each parent
+    # END while there are commits to visit
+    return False
+
+
+_PARENT1 = 1
+_PARENT2 = 2
+_STALE = 4
+_RESULT = 8
+
+
+def merge_bases(graph, load_commit, a, b):
+    """:return: list of binary shas of the best common ancestors of commits a and b.
+        It is empty if they have no common history.
+
+    Commits are visited in order of decreasing generation, and then commit time, so
+    that commits are visited after all of their descendants. See ``is_ancestor`` for
+    a description of the parameters."""
+    if a == b:
+        return [a]
+    info = _CommitInfo(graph, load_commit)
+    flags = {a: _PARENT1, b: _PARENT2}
+    queue = list()
+    counter = [0]
+
+    def push(binsha):
+        generation, commit_time = info(binsha)[:2]
+        counter[0] += 1
+        heappush(queue, (-generation, -commit_time, counter[0], binsha))
+    # END push
+
+    push(a)
+    push(b)
+    results = list()
+    # paint the ancestry of both commits, until only stale commits are left
+    while any(not flags[item[3]] & _STALE for item in queue):
+        binsha = heappop(queue)[3]
+        commit_flags = flags[binsha] & (_PARENT1 | _PARENT2 | _STALE)
+        if commit_flags == _PARENT1 | _PARENT2:
+            if not flags[binsha] & _RESULT:
+                flags[binsha] |= _RESULT
+                results.append(binsha)
+            # END record result
+            # parents of a common ancestor are no merge bases
+            commit_flags |= _STALE
+        # END handle common ancestor
+
+        for parent in info(binsha)[2]:
+            parent_flags = flags.get(parent, 0)
+            if parent_flags & commit_flags == commit_flags:
+                continue
+            flags[parent] = parent_flags | commit_flags
+            push(parent)
+        # END for each parent
+    # END while there are non-stale commits
+
+    results = [binsha for binsha in results if not flags[binsha] & _STALE]
+    if len(results) < 2:
+        return results
+
+    # drop results reachable from other results
+    return [binsha for binsha in results
+            if not any(other != binsha and is_ancestor(graph, load_commit, binsha, other) for other in results)]
+
+#} END ancestry
@@ -0,0 +1,244 @@
+"""Module with a watcher noticing changes of the references and the index of a repository"""
+import logging
+import os
+import os.path as osp
+import threading
+import time
+
+from git.util import (
+    _inotify_watch,
+    _wait_for_events,
+    _IN_MODIFY,
+    _IN_ATTRIB,
+    _IN_CREATE,
+    _IN_DELETE,
+    _IN_MOVED_FROM,
+    _IN_MOVED_TO
+)
+
+__all__ = ('RefWatcher', )
+
+log = logging.getLogger(__name__)
+
+scandir = getattr(os, 'scandir', None)
+
+
+def _stat_key(st):
+    """:return: tuple identifying the state of a file by its stat result"""
+    return (st.st_ino, st.st_size, getattr(st, 'st_mtime_ns', st.st_mtime))
+
+
+def _collect_state(directory, out, dirs):
+    """Append tuple(path, state) pairs of directory and all files below it to out, and
+    add the existing directories to the dirs set"""
+    try:
+        out.append((directory, _stat_key(os.stat(directory))))
+    except OSError:
+        out.append((directory, None))
+        return
+    # END handle missing directory
+    dirs.add(directory)
+
+    if scandir is not None:
+        try:
+            it = scandir(directory)
+        except OSError:
+            return
+        # END handle vanished directory
+        entries = sorted((e.name, e) for e in it)
+        if hasattr(it, 'close'):
+            it.close()
+        for name, entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    _collect_state(entry.path, out, dirs)
+                else:
+                    out.append((entry.path, _stat_key(entry.stat(follow_symlinks=False))))
+            except OSError:
+                continue
+            # END handle vanished entry
+        # END for each entry
+        return
+    # END use scandir
+
+    try:
+        names = sorted(os.listdir(directory))
+    except OSError:
+        return
+    # END handle vanished directory
+    for name in names:
+        path = osp.join(directory, name)
+        try:
+            st = os.lstat(path)
+        except OSError:
+            continue
+        # END handle vanished entry
+        if osp.isdir(path) and not osp.islink(path):
+            _collect_state(path, out, dirs)
+        else:
+            out.append((path, _stat_key(st)))
+    # END for each name
+
+
+class RefWatcher(object):
+
+    """Notices changes of HEAD, the references and the index of a repository by comparing
+    the stat information of their files.
+
+    On linux, inotify reports changes of the watched directories, so polls only look at
+    the files once something changed. Elsewhere all files are compared on each poll.
+
+    Each noticed change increments the generation, and calls the subscribed callbacks with
+    the new generation. All changes happening between two polls are coalesced into one,
+    and polls following the previous one within min_interval seconds are answered without
+    looking for changes.
+
+    The watcher only knows the paths of the repository, so it may be kept by objects the
+    repository refers to without creating reference cycles."""
+    __slots__ = ('git_dir', 'common_dir', 'min_interval', 'generation', '_state', '_last_poll',
+                 '_callbacks', '_lock', '_stop', '_fd', '_dirs')
+
+    # inotify events which may change the state of the watched files
+    _event_mask = _IN_MODIFY | _IN_ATTRIB | _IN_CREATE | _IN_DELETE | _IN_MOVED_FROM | _IN_MOVED_TO
+
+    # default min_interval if all files have to be compared on each poll
+    stat_poll_interval = 0.5
+
+    def __init__(self, git_dir, common_dir=None, min_interval=None):
+        """:param git_dir: the .git directory, containing HEAD and the index
+        :param common_dir: directory with the references, the git_dir if None
+        :param min_interval: minimal amount of seconds between two looks for changes. If None,
+            it is 0 if changes are reported by inotify, and stat_poll_interval otherwise"""
+        self.git_dir = git_dir
+        self.common_dir = common_dir or git_dir
+        self.generation = 0
+        self._callbacks = list()
+        self._lock = threading.Lock()
+        self._stop = None
+        self._dirs = set()
+        self._fd = _inotify_watch([self.git_dir, self.common_dir], self._event_mask)
+        if min_interval is None:
+            min_interval = self._fd is None and self.stat_poll_interval or 0
+        self.min_interval = min_interval
+        self._last_poll = time.time()
+        self._state = self._scan()
+
+    def __del__(self):
+        if getattr(self, '_fd', None) is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _read_state(self):
+        """:return: tuple(state, dirs) of the list of tuple(path, state) pairs of all files we
+            watch, and the set of directories containing references"""
+        out = list()
+        dirs = set()
+        for path in (osp.join(self.git_dir, 'HEAD'), osp.join(self.git_dir, 'index'),
+                     osp.join(self.common_dir, 'packed-refs')):
+            try:
+                out.append((path, _stat_key(os.stat(path))))
+            except OSError:
+                out.append((path, None))
+        # END for each single file
+        _collect_state(osp.join(self.common_dir, 'refs'), out, dirs)
+        return out, dirs
+
+    def _scan(self):
+        """:return: list of tuple(path, state) pairs of all files we watch. New directories of
+            references are watched by inotify as well."""
+        while True:
+            state, dirs = self._read_state()
+            new_dirs = dirs - self._dirs
+            self._dirs = dirs
+            if self._fd is None or not new_dirs:
+                return state
+            # read the state once more, as changes in new directories were not reported yet
+            _inotify_watch(sorted(new_dirs), self._event_mask, self._fd)
+        # END until all directories are watched
+
+    @property
+    def uses_events(self):
+        """:return: True if changes are reported by inotify, instead of being searched on each poll"""
+        return self._fd is not None
+
+    #{ Interface
+
+    def poll(self):
+        """Look for changes, and notify subscribers if there were any
+
+        :return: the current generation"""
+        with self._lock:
+            now = time.time()
+            if now - self._last_poll < self.min_interval:
+                return self.generation
+            self._last_poll = now
+
+            if self._fd is not None and not _wait_for_events(self._fd, 0):
+                return self.generation
+            state = self._scan()
+            if state == self._state:
+                return self.generation
+            self._state = state
+            self.generation += 1
+            generation = self.generation
+            callbacks = list(self._callbacks)
+        # END with lock
+
+        for callback in callbacks:
+            callback(generation)
+        # END for each subscriber
+        return generation
+
+    def subscribe(self, callback):
+        """Call callback(generation) whenever a poll noticed a change
+
+        :return: callback, which allows using this method as decorator"""
+        with self._lock:
+            self._callbacks.append(callback)
+        return callback
+
+    def unsubscribe(self, callback):
+        """Stop calling the given callback
+        :raise ValueError: if it wasn't subscribed"""
+        with self._lock:
+            self._callbacks.remove(callback)
+
+    def start(self, interval=1.0):
+        """Poll every interval seconds in a daemon thread, so that subscribers are notified
+        of changes without anyone polling. Does nothing if we are polling already."""
+        if self._stop is not None:
+            return
+        stop = self._stop = threading.Event()
+
+        def run():
+            while not stop.wait(interval):
+                try:
+                    self.poll()
+                except Exception:
+                    log.exception("Failed to notify subscribers about changes in %s", self.git_dir)
+                # END handle failing subscriber
+            # END until stopped
+        # END run
+
+        thread = threading.Thread(target=run, name='RefWatcher(%s)' % self.git_dir)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        """Stop the thread polling for changes, if we started one"""
+        if self._stop is not None:
+            self._stop.set()
+            self._stop = None
+        # END handle running thread
+
+    def close(self):
+        """Stop polling, and release the inotify instance. Later polls compare all files."""
+        self.stop()
+        with self._lock:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+            # END close inotify instance
+        # END with lock
+
+    #} END interface
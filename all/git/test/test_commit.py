@@ -14,6 +14,7 @@ import time
 
 from git import (
     Commit,
+    CommitTable,
     Actor,
 )
 from git import Repo
@@ -240,6 +241,78 @@ class TestCommit(TestBase):
         rw_repo.index.commit('initial commit')
         list(rw_repo.iter_commits(rw_repo.head.ref))  # should fail unless bug is fixed
 
+    @with_rw_directory
+    def test_iteration_with_prefetch(self, rw_dir):
+        rw_repo = Repo.init(rw_dir)
+        for i in range(70):
+            rw_repo.index.commit(u'commit \xfc %i\n\nbody' % i)
+        # END for each commit
+
+        attrs = ('binsha', 'size', 'tree', 'parents', 'author', 'authored_date', 'committer',
+                 'committed_date', 'committer_tz_offset', 'message', 'encoding')
+        commits = list(rw_repo.iter_commits())
+        prefetched = list(rw_repo.iter_commits(prefetch=True))
+        self.assertEqual(len(prefetched), 70)
+        for commit, other in zip(commits, prefetched):
+            for attr in attrs:
+                self.assertEqual(getattr(commit, attr), getattr(other, attr))
+            # END for each attr
+        # END for each commit pair
+
+        # the object database stays usable while iterating
+        for i, commit in enumerate(Commit.iter_items(rw_repo, 'HEAD', prefetch=True)):
+            self.assertEqual(rw_repo.commit(commit.hexsha).message, commit.message)
+            self.assertEqual(commit.summary, u'commit \xfc %i' % (69 - i))
+        # END for each commit
+
+        # unknown objects raise once they are reached, without disturbing later reads
+        data = rw_repo.git.iter_object_data(['HEAD', 'f' * 40, 'HEAD~1'])
+        self.assertEqual(next(data)[0], rw_repo.head.commit.hexsha.encode('ascii'))
+        self.failUnlessRaises(ValueError, next, data)
+        self.assertEqual(rw_repo.git.get_object_data('HEAD~1')[0], commits[1].hexsha.encode('ascii'))
+
+    @with_rw_directory
+    def test_commit_table(self, rw_dir):
+        rw_repo = Repo.init(rw_dir)
+        authors = (Actor(u'f\xfc', 'foo@example.com'), Actor('bar', 'bar@example.com'))
+        committer = Actor('committer', 'committer@example.com')
+        for i in range(20):
+            rw_repo.index.commit('commit %i' % i, author=authors[i % 2], committer=committer,
+                                 author_date='%i +0200' % (1500000000 + i), commit_date='%i -0130' % (1500000100 + i))
+        # END for each commit
+
+        table = CommitTable.from_rev_list(rw_repo, 'HEAD')
+        self.assertEqual(len(table), 20)
+        self.assertEqual(len(table.actors), 3)
+        commits = list(rw_repo.iter_commits())
+        for commit, other in zip(commits, table):
+            self.assertEqual(commit, other)
+            for attr in ('author', 'authored_date', 'author_tz_offset', 'committer', 'committed_date',
+                         'committer_tz_offset', 'parents'):
+                self.assertEqual(getattr(commit, attr), getattr(other, attr))
+            # END for each attr
+        # END for each commit pair
+        self.assertEqual(table.parents(19), ())
+        self.assertEqual(table[-1], commits[-1])
+
+        recent = table.between(1500000110, committed=True)
+        self.assertEqual([c.hexsha for c in recent], [c.hexsha for c in commits[:10]])
+        self.assertEqual(len(table.between(1500000005, 1500000008, committed=False)), 3)
+        self.assertEqual(len(recent.by_author('foo@example.com')), 5)
+        self.assertEqual(len(table.by_author(authors[1], u'f\xfc')), 20)
+        self.assertEqual(len(table.by_author('committer')), 0)
+        self.assertEqual(len(table.by_author('committer', committed=True)), 20)
+        self.assertRaises(TypeError, table.by_author, 'committer', commited=True)
+        self.assertEqual(table.take([3, 1]).binsha(1), commits[1].binsha)
+
+        self.failUnlessRaises(ValueError, CommitTable.from_rev_list, rw_repo, 'HEAD', pretty='raw')
+
+        # dates beyond 2038 don't fit into 32 bits
+        rw_repo.index.commit('future', author_date='4102444800 +0000', commit_date='4102444801 +0000')
+        table = CommitTable.from_rev_list(rw_repo, 'HEAD', max_count=1)
+        self.assertEqual((table[0].authored_date, table[0].committed_date), (4102444800, 4102444801))
+        self.assertEqual(len(table.between(4102444801)), 1)
+
     def test_count(self):
         self.assertEqual(self.rorepo.tag('refs/tags/0.1.5').commit.count(), 143)
 
@@ -363,6 +436,28 @@ JzJMZDRLQLFvnzqZuCjE
         cmt._serialize(cstream)
         assert not re.search(r"^gpgsig ", cstream.getvalue().decode('ascii'), re.MULTILINE)
 
+    def test_deserialize_headers_only(self):
+        with open(fixture_path('commit_with_gpgsig'), 'rb') as fd:
+            data = fd.read()
+        full = Commit(self.rorepo, Commit.NULL_BIN_SHA)._deserialize(BytesIO(data))
+
+        # insert an encoding header after the committer, which is honored for the message
+        committer_end = data.index(b'\n', data.index(b'\ncommitter ') + 1) + 1
+        data = data[:committer_end] + b'encoding ISO-8859-1\n' + data[committer_end:]
+        data = data[:-1] + u'\xe4\n'.encode('latin-1')
+
+        cmt = Commit(self.rorepo, Commit.NULL_BIN_SHA)._deserialize(BytesIO(data), headers_only=True)
+        for attr in ('tree', 'parents', 'author', 'authored_date', 'committer', 'committed_date'):
+            self.assertEqual(getattr(cmt, attr), getattr(full, attr))
+        # END for each header attribute
+        self.assertEqual(cmt.encoding, 'ISO-8859-1')
+        self.assertEqual(cmt.message, full.message[:-1] + u'\xe4\n')
+        self.assertEqual(cmt.gpgsig, full.gpgsig)
+
+        cmt.message = u'changed'
+        cmt.gpgsig = None
+        self.assertEqual(cmt.message, u'changed')
+
     def assert_gpgsig_deserialization(self, cstream):
         assert 'gpgsig' in 'precondition: need gpgsig'
 
@@ -6,9 +6,13 @@
 
 import glob
 import io
+import os
+import time
 
 from git import (
-    GitConfigParser
+    config,
+    GitConfigParser,
+    Repo,
 )
 from git.compat import string_types
 from git.config import cp
@@ -265,3 +269,120 @@ class TestBase(TestCase):
 
         with self.assertRaises(cp.NoOptionError):
             cr.get_value('color', 'ui')
+
+    @with_rw_directory
+    def test_parsed_files_cache(self, rw_dir):
+        fpa = osp.join(rw_dir, 'a')
+        with GitConfigParser(fpa, read_only=False) as cw:
+            cw.set_value('core', 'value', 'a')
+            cw.set_value('section "sub"', 'value', 'b')
+        # END write config
+
+        # recently changed files may change unnoticed, and are parsed every time
+        with GitConfigParser(fpa) as cr:
+            self.assertEqual(cr.get_value('core', 'value'), 'a')
+        assert fpa not in config._layer_cache
+
+        past = time.time() - 60
+        os.utime(fpa, (past, past))
+        for _ in range(2):
+            with GitConfigParser([fpa, fixture_path('git_config_with_empty_value')]) as cr:
+                self.assertEqual(cr.get_value('core', 'value'), 'a')
+                assert cr.get_value('core', 'filemode')
+                self.assertEqual(cr.get_value('section "sub"', 'value'), 'b')
+                # read-only parsers refuse changes only after making them to their own values
+                with self.assertRaises(IOError):
+                    cr.set('core', 'value', 'changed')
+        # END for each read
+        assert fpa in config._layer_cache
+
+        # writes are seen by the next parser
+        with GitConfigParser(fpa, read_only=False) as cw:
+            self.assertEqual(cw.get_value('core', 'value'), 'a')
+            cw.set_value('core', 'value', 'c')
+        assert fpa not in config._layer_cache
+        with GitConfigParser(fpa) as cr:
+            self.assertEqual(cr.get_value('core', 'value'), 'c')
+
+    def test_values_continued_on_following_lines(self):
+        file_obj = io.BytesIO(b'[sec]\n'
+                              b'\tquoted = "first \\\\ \\"line\\tone\\\n'
+                              b'\t  second \xc3\xbc line\\n"\n'
+                              b'\tunquoted = a\\\n'
+                              b'\t b\n'
+                              b'\tescaped = C:\\\\\n'
+                              b'\tcomment = value ; comment\n'
+                              b'\tkept = "a ; b"\n')
+        file_obj.name = 'config'
+        cr = GitConfigParser(file_obj)
+        self.assertEqual(cr.get('sec', 'quoted'), u'first \\ "line\tone\t  second \xfc line\n')
+        self.assertEqual(cr.get('sec', 'unquoted'), 'a\t b')
+        self.assertEqual(cr.get('sec', 'escaped'), 'C:\\\\')
+        self.assertEqual(cr.get('sec', 'comment'), 'value')
+        self.assertEqual(cr.get('sec', 'kept'), '"a ; b"')
+
+    @with_rw_directory
+    def test_conditional_includes(self, rw_dir):
+        repo = Repo.init(osp.join(rw_dir, 'work', 'Repo'))
+        git_dir = repo.git_dir.replace('\\', '/')
+        branch = repo.active_branch.name
+        conditions = {
+            'gitdir_abs': 'gitdir:%s' % git_dir,
+            'gitdir_dir': 'gitdir:%s/' % osp.dirname(osp.dirname(git_dir)),
+            'gitdir_glob': 'gitdir:work/*/.git',
+            'gitdir_icase': 'gitdir/i:WORK/REPO/',
+            'gitdir_relative': 'gitdir:./work/',
+            'gitdir_other': 'gitdir:work/',
+            'gitdir_case': 'gitdir:WORK/REPO/',
+            'gitdir_glob_deep': 'gitdir:%s/*/.git' % rw_dir.replace('\\', '/'),
+            'onbranch': 'onbranch:%s' % branch,
+            'onbranch_glob': 'onbranch:%s*' % branch[:2],
+            'onbranch_other': 'onbranch:other',
+        }
+        matching = set(('gitdir_abs', 'gitdir_dir', 'gitdir_glob', 'gitdir_icase', 'gitdir_relative',
+                        'gitdir_other', 'onbranch', 'onbranch_glob'))
+        config_path = osp.join(rw_dir, 'config')
+        with open(config_path, 'wt') as fp:
+            for name, condition in conditions.items():
+                included_path = osp.join(rw_dir, name)
+                with open(included_path, 'wt') as ifp:
+                    ifp.write('[included]\n\t%s = true\n' % name)
+                fp.write('[includeIf "%s"]\n\tpath = %s\n' % (condition, included_path))
+            # END for each condition
+        # END write config
+
+        cr = GitConfigParser(config_path, repo=repo)
+        cr.read()
+        self.assertEqual(set(name for name, _ in cr.items('included')), matching)
+
+        # without repository, conditions are not met
+        cr = GitConfigParser(config_path)
+        assert not cr.has_section('included')
+
+        # the config reader of the repository knows its directory and branch
+        with repo.config_writer() as cw:
+            cw.set_value('includeIf "gitdir:%s"' % git_dir, 'path', osp.join(rw_dir, 'gitdir_abs'))
+        assert repo.config_reader().get_value('included', 'gitdir_abs')
+        with repo.config_writer() as cw:
+            cw.set_value('includeIf "onbranch:other"', 'path', osp.join(rw_dir, 'onbranch_other'))
+        self.failUnlessRaises(cp.NoOptionError, repo.config_reader().get_value, 'included', 'onbranch_other')
+
+        # relative gitdir conditions are resolved against the file containing them, even once
+        # files of other directories were read
+        nested_path = osp.join(rw_dir, 'nested', 'config')
+        os.mkdir(osp.dirname(nested_path))
+        with open(nested_path, 'wt') as fp:
+            fp.write('[includeIf "gitdir:./work/"]\n\tpath = %s\n' % osp.join(rw_dir, 'gitdir_relative'))
+            fp.write('[include]\n\tpath = %s\n' % osp.join(rw_dir, 'gitdir_abs'))
+        cr = GitConfigParser(nested_path, repo=repo)
+        cr.read()
+        self.assertEqual([name for name, _ in cr.items('included')], ['gitdir_abs'])
+
+        # writers ignore conditions, and still write back files with matching conditions
+        cw = GitConfigParser(config_path, read_only=False, repo=repo)
+        cw.set_value('user', 'email', 'a@b')
+        cw.release()
+        assert GitConfigParser(config_path).get_value('user', 'email') == 'a@b'
+        with repo.config_writer() as cw:
+            cw.set_value('user', 'name', 'someone')
+        assert repo.config_reader().get_value('user', 'name') == 'someone'
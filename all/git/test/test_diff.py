@@ -146,6 +146,105 @@ class TestDiff(TestBase):
         dr = res[3]
         assert dr.diff.endswith(b"+Binary files a/rps and b/rps differ\n")
 
+    def test_diff_raw_z_format(self):
+        for numstat in (False, True):
+            output = StringProcessAdapter(fixture('diff_raw_z_numstat'))
+            res = list(Diff._iter_from_raw_z_format(None, output, numstat))
+            self.assertEqual([d.change_type for d in res], ['M', 'D', 'M', 'R100', 'A'])
+            self._assert_diff_format(res)
+            self.assertEqual(res[4].b_rawpath, u'ü.txt'.encode('utf-8'))
+            self.assertIsNone(res[4].a_blob)
+            self.assertTrue(res[1].deleted_file)
+            self.assertIsNone(res[1].b_blob)
+            self.assertEqual((res[3].rename_from, res[3].rename_to), ('f20.txt', 'moved.txt'))
+            self.assertEqual(len(list(DiffIndex(res).iter_change_type('R'))), 1)
+
+            counts = [(d.insertions, d.deletions) for d in res]
+            if numstat:
+                self.assertEqual(counts, [(-1, -1), (0, 3), (1, 0), (0, 0), (1, 0)])
+            else:
+                self.assertEqual(counts, [(None, None)] * 5)
+        # END for each numstat mode
+
+    @with_rw_directory
+    def test_iter_diff(self, rw_dir):
+        r = Repo.init(rw_dir)
+        for name in ('a', 'b\tc', u'ä'):
+            with open(osp.join(rw_dir, name), 'w') as fp:
+                fp.write('%s\n' % name)
+        r.index.add(['a', 'b\tc', u'ä'])
+        commit = r.index.commit('initial')
+
+        diffs = list(commit.iter_diff(NULL_TREE, numstat=True))
+        self.assertEqual(sorted(d.b_path for d in diffs), ['a', 'b\tc', u'ä'])
+        self.assertEqual(set((d.insertions, d.deletions, d.change_type) for d in diffs), set([(1, 0, 'A')]))
+        self.assertEqual(diffs, list(commit.iter_diff(NULL_TREE, numstat=True)))
+        self.assertEqual(list(commit.iter_diff(commit.tree)), [])
+
+        # stopping early is fine
+        next(commit.iter_diff(NULL_TREE))
+
+    @with_rw_directory
+    def test_find_renames(self, rw_dir):
+        r = Repo.init(rw_dir)
+        lines = ['line %i of some file with enough content\n' % i for i in range(40)]
+        contents = {'same': lines[:10], 'similar': lines[10:30], 'changed': lines[30:], 'other': lines[:1]}
+        for name, content in contents.items():
+            with open(osp.join(rw_dir, name), 'w') as fp:
+                fp.write(''.join(content))
+        r.index.add(list(contents))
+        first = r.index.commit('first')
+
+        r.index.remove(['same', 'similar', 'other'], working_tree=True)
+        contents = {'same-moved': contents['same'], 'similar-moved': contents['similar'][:-2] + ['new\n'],
+                    'changed': contents['changed'] + ['more\n'], 'copied': contents['changed'],
+                    'unrelated': ['nothing in common\n']}
+        for name, content in contents.items():
+            with open(osp.join(rw_dir, name), 'w') as fp:
+                fp.write(''.join(content))
+        r.index.add(list(contents))
+        second = r.index.commit('second')
+
+        diffs = DiffIndex(first.iter_diff(second, no_renames=True))
+        expected = dict((d.b_path, (d.a_path, d.change_type)) for d in first.diff(second) if d.renamed_file)
+        for max_processes in (1, 2):
+            renames = diffs.find_renames(max_processes=max_processes)
+            self.assertEqual(dict((d.b_path, (d.a_path, d.change_type)) for d in renames if d.renamed_file),
+                             expected)
+            self.assertEqual(expected, {'same-moved': ('same', 'R100'), 'similar-moved': ('similar', 'R090')})
+            self.assertEqual(sorted(d.a_path for d in renames.iter_change_type('D')), ['other'])
+            self.assertEqual(sorted(d.b_path for d in renames.iter_change_type('A')), ['copied', 'unrelated'])
+        # END for each process count
+
+        copies = diffs.find_renames(copies=True)
+        copied = [d for d in copies if d.b_path == 'copied'][0]
+        self.assertEqual((copied.a_path, copied.change_type, copied.renamed_file), ('changed', 'C100', False))
+        self.assertEqual(len(copies), len(renames))
+        self.assertEqual(len(diffs.find_renames(threshold=95)), len(diffs) - 1)
+
+        # renamed files are sources of copies as well
+        r.index.remove(['same-moved', 'similar-moved'], working_tree=True)
+        contents = {'same-again': contents['same-moved'], 'same-copy': contents['same-moved'],
+                    'same-similar': contents['same-moved'][:-1] + ['new\n'],
+                    'similar-again': contents['similar-moved'], 'similar-copy': contents['similar-moved'][1:]}
+        for name, content in contents.items():
+            with open(osp.join(rw_dir, name), 'w') as fp:
+                fp.write(''.join(content))
+        r.index.add(list(contents))
+        third = r.index.commit('third')
+
+        diffs = DiffIndex(second.iter_diff(third, no_renames=True))
+        changes = dict((d.b_path, (d.a_path, d.change_type[0])) for d in diffs.find_renames(copies=True)
+                       if d.change_type[0] in 'RC')
+        self.assertEqual(changes, {'same-again': ('same-moved', 'R'), 'same-copy': ('same-moved', 'C'),
+                                   'same-similar': ('same-moved', 'C'), 'similar-again': ('similar-moved', 'R'),
+                                   'similar-copy': ('similar-moved', 'C')})
+        self.assertEqual([d.a_path for d in diffs.find_renames(copies=True).iter_change_type('D')], [])
+        renames = diffs.find_renames()
+        self.assertEqual(sorted(d.b_path for d in renames if d.renamed_file), ['same-again', 'similar-again'])
+        self.assertEqual(sorted(d.b_path for d in renames.iter_change_type('A')),
+                         ['same-copy', 'same-similar', 'similar-copy'])
+
     def test_diff_index_raw_format(self):
         output = StringProcessAdapter(fixture('diff_index_raw'))
         res = Diff._index_from_raw_format(None, output)
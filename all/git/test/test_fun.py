@@ -1,15 +1,17 @@
 from io import BytesIO
 from stat import S_IFDIR, S_IFREG, S_IFLNK
+import os
 from os import stat
 import os.path as osp
+import threading
 
 try:
     from unittest import skipIf, SkipTest
 except ImportError:
     from unittest2 import skipIf, SkipTest
 
-from git import Git
-from git.compat import PY3
+from git import Git, Repo, Tree, NULL_TREE
+from git.compat import PY3, safe_decode
 from git.index import IndexFile
 from git.index.fun import (
     aggressive_tree_merge
@@ -19,6 +21,10 @@ from git.objects.fun import (
     traverse_trees_recursive,
     tree_to_stream,
     tree_entries_from_data,
+    iter_tree_entries_from_data,
+    iter_trees_recursive,
+    iter_tree_changes,
+    TreeCache,
 )
 from git.repo.fun import (
     find_worktree_git_dir
@@ -29,7 +35,7 @@ from git.test.lib import (
     with_rw_repo,
     with_rw_directory
 )
-from git.util import bin_to_hex, cygpath, join_path_native
+from git.util import bin_to_hex, cygpath, hex_to_bin, join_path_native
 from gitdb.base import IStream
 from gitdb.typ import str_tree_type
 
@@ -295,3 +301,139 @@ class TestFun(TestBase):
     def test_tree_entries_from_data_with_failing_name_decode_py3(self):
         r = tree_entries_from_data(b'100644 \x9f\0aaa')
         assert r == [(b'aaa', 33188, '\udc9f')], r
+
+    def test_tree_entries_from_data_modes(self):
+        entries = [(b'a' * 20, 0o40000, u'dir'), (b'b' * 20, 0o100644, u'file with spaces'),
+                   (b'c' * 20, 0o100755, u'\xe9x\xe9c'), (b'd' * 20, 0o120000, u'link'),
+                   (b'e' * 20, 0o160000, u'sub'), (b'f' * 20, 0o100600, u'odd')]
+        stream = BytesIO()
+        tree_to_stream(entries, stream.write)
+        data = stream.getvalue()
+        assert tree_entries_from_data(data) == entries
+        assert tree_entries_from_data(b'040000 dir\0' + b'a' * 20) == entries[:1]
+        assert [(sha, mode, safe_decode(name)) for sha, mode, name in iter_tree_entries_from_data(data)] == entries
+
+    @with_rw_directory
+    def test_tree_cache(self, rw_dir):
+        r = Repo.init(rw_dir)
+        for name in ('a', 'b', 'dir/c', 'dir/sub/d'):
+            fp = osp.join(rw_dir, name)
+            if not osp.isdir(osp.dirname(fp)):
+                os.makedirs(osp.dirname(fp))
+            with open(fp, 'w') as fs:
+                fs.write(name)
+        # END for each file
+        r.index.add(['a', 'b', 'dir'])
+        tree = r.index.commit('initial').tree
+        odb = r.odb
+
+        cache = TreeCache()
+        entries = traverse_tree_recursive(odb, tree.binsha, '', cache)
+        assert entries == traverse_tree_recursive(odb, tree.binsha, '')
+        assert (len(cache), cache.hits, cache.misses) == (3, 0, 3)
+        assert traverse_trees_recursive(odb, [tree.binsha] * 2, '', cache) == [(e, e) for e in entries]
+        assert (len(cache), cache.hits, cache.misses) == (3, 6, 3)
+
+        # handed out entries may be changed without affecting the cache
+        cache.entries(odb, tree.binsha).append(None)
+        assert None not in cache.entries(odb, tree.binsha)
+
+        # the least recently used trees are dropped once the size is exceeded
+        dir_tree, sub_tree = tree['dir'], tree['dir/sub']
+        cache = TreeCache(max_size=tree.size + dir_tree.size)
+        for t in (tree, dir_tree, tree, sub_tree):
+            cache.entries(odb, t.binsha)
+        # END for each tree to request
+        assert tree.binsha in cache and sub_tree.binsha in cache and dir_tree.binsha not in cache
+        assert cache.size == tree.size + sub_tree.size
+        cache.clear()
+        assert (len(cache), cache.size, cache.hits, cache.misses) == (0, 0, 0, 0)
+
+        # trees of the repository share its cache
+        r.tree_cache.clear()
+        assert len(r.tree()) == 3
+        assert len(r.tree()) == 3 and r.tree_cache.hits == 1
+
+        # the cache may be shared by threads
+        datas = [odb.stream(t.binsha).read() for t in (tree, dir_tree, sub_tree)]
+        trees = dict((('%020i' % i).encode('ascii'), datas[i % 3]) for i in range(50))
+
+        class MemoryTrees(object):
+            def stream(self, binsha):
+                return BytesIO(trees[binsha])
+        # END odb reading prepared trees
+
+        cache = TreeCache(max_size=sum(len(d) for d in datas) * 4)
+        shas = sorted(trees)
+        errors = list()
+
+        def use_cache(offset):
+            try:
+                for i in range(2000):
+                    binsha = shas[(i * 7 + offset) % (1 + i % len(shas))]
+                    assert cache.entries(MemoryTrees(), binsha) == list(tree_entries_from_data(trees[binsha]))
+                # END for each request
+            except Exception as e:
+                errors.append(e)
+        # END thread function
+        threads = [threading.Thread(target=use_cache, args=(i,)) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        # END for each thread
+        assert errors == []
+        assert cache.hits + cache.misses == 8 * 2000
+        assert cache.size == sum(len(trees[binsha]) for binsha in shas if binsha in cache)
+        assert cache.size <= cache.max_size
+
+    @with_rw_directory
+    def test_pruned_tree_traversal(self, rw_dir):
+        r = Repo.init(rw_dir)
+
+        def make_tree(files, parent=None):
+            if parent is not None:
+                r.git.read_tree(parent)
+            for name, content in files.items():
+                if content is None:
+                    r.git.rm(name, cached=True)
+                    continue
+                fp = osp.join(rw_dir, name)
+                if not osp.isdir(osp.dirname(fp)):
+                    os.makedirs(osp.dirname(fp))
+                with open(fp, 'w') as fs:
+                    fs.write(content)
+                r.git.add(name)
+            # END for each file
+            return Tree(r, hex_to_bin(r.git.write_tree()), path='')
+        # END make tree helper
+
+        base = make_tree(dict(('dir%i/sub/file%i' % (i % 3, i), 'content %i' % i) for i in range(9)))
+        ours = make_tree({'dir0/sub/file0': 'ours', 'dir0/new': 'new', 'dir1/sub/file1': None}, base)
+        theirs = make_tree({'dir0/sub/file0': 'theirs', 'dir2/sub/file2': 'theirs'}, base)
+
+        # dir2 is equal in both trees and is not entered
+        cache = TreeCache()
+        changes = list(iter_tree_changes(r.odb, base.binsha, ours.binsha, cache))
+        assert [(a and a[2], b and b[2]) for a, b in changes] == \
+            [(None, 'dir0/new'), ('dir0/sub/file0', 'dir0/sub/file0'), ('dir1/sub/file1', None)]
+        assert cache.misses == 10 and base['dir2'].binsha not in cache
+        assert list(iter_tree_changes(r.odb, ours.binsha, ours.binsha, cache)) == []
+
+        diffs = base.diff_tree(ours)
+        assert [d.change_type for d in diffs] == ['A', 'M', 'D']
+        assert diffs[0].b_blob == ours['dir0/new'] and diffs[0].new_file
+        assert diffs[2].a_blob == base['dir1/sub/file1'] and diffs[2].deleted_file
+        assert len(base.diff_tree(NULL_TREE)) == 9
+
+        # pruned merges yield the same entries as fully traversed ones
+        trees = [base.binsha, ours.binsha, theirs.binsha]
+        full = traverse_trees_recursive(r.odb, trees, '')
+        assert len(full) == 10
+        assert list(iter_trees_recursive(r.odb, trees, '')) == full
+        entries = aggressive_tree_merge(r.odb, trees)
+        assert sorted((e.path, e.stage) for e in entries) == sorted(
+            [('dir0/new', 0), ('dir0/sub/file0', 1), ('dir0/sub/file0', 2), ('dir0/sub/file0', 3),
+             ('dir0/sub/file3', 0), ('dir0/sub/file6', 0), ('dir1/sub/file4', 0), ('dir1/sub/file7', 0),
+             ('dir2/sub/file2', 0), ('dir2/sub/file5', 0), ('dir2/sub/file8', 0)])
+        assert [e.binsha for e in entries if e.path == 'dir2/sub/file2'] == [theirs['dir2/sub/file2'].binsha]
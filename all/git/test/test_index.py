@@ -34,10 +34,11 @@ from git.exc import (
     HookExecutionError,
     InvalidGitRepositoryError
 )
-from git.index.fun import hook_path
+from git.index.fun import hook_path, read_cache, write_cache, write_cache_from_map
 from git.index.typ import (
     BaseIndexEntry,
-    IndexEntry
+    IndexEntry,
+    IndexEntryMap
 )
 from git.objects import Blob
 from git.test.lib import (
@@ -921,3 +922,268 @@ class TestIndex(TestBase):
                 assert str(err)
         else:
             raise AssertionError("Should have cought a HookExecutionError")
+
+    @with_rw_directory
+    def test_index_versions(self, rw_dir):
+        r = Repo.init(rw_dir)
+        for i in range(10):
+            fp = osp.join(rw_dir, 'dir%i' % (i % 3), 'file%i' % i)
+            if not osp.isdir(osp.dirname(fp)):
+                os.mkdir(osp.dirname(fp))
+            with open(fp, 'wb') as fs:
+                fs.write(('content %i' % i).encode('ascii'))
+        # END for each file
+        r.git.add('.')
+        r.git.update_index('--skip-worktree', 'dir1/file1')
+        ls_files = r.git.ls_files(s=True, v=True)
+
+        for version in (2, 3, 4):
+            r.git.update_index(index_version=version)
+            index = IndexFile(r)
+            assert isinstance(index.entries, IndexEntryMap)
+            self.assertEqual(index.version, max(version, 3))
+            self.assertEqual(len(index.entries), 10)
+            self.assertEqual(index.entries[('dir2/file5', 0)].size, len(b'content 5'))
+
+            # fully unpacked entries must match the lazily unpacked ones
+            with open(index.path, 'rb') as fp:
+                entries = read_cache(fp)[1]
+            self.assertEqual(entries, dict(index.entries.items()))
+
+            # skip-worktree requires version 3, which must survive rewriting
+            index.write()
+            self.assertEqual(r.git.ls_files(s=True, v=True), ls_files)
+        # END for each version
+
+    @with_rw_directory
+    def test_write_unchanged_entries(self, rw_dir):
+        r = Repo.init(rw_dir)
+        for i in range(20):
+            with open(osp.join(rw_dir, 'file%02i' % i), 'wb') as fs:
+                fs.write(('content %i' % i).encode('ascii'))
+        # END for each file
+        r.git.add('.')
+        r.git.update_index('--skip-worktree', 'file07')
+        with open(r.index.path, 'rb') as fp:
+            index_data = fp.read()
+
+        # an untouched index is written as it was read
+        index = IndexFile(r)
+        index.write()
+        with open(index.path, 'rb') as fp:
+            self.assertEqual(fp.read(), index_data)
+
+        # changed entries are spliced in between the copied ones
+        index = IndexFile(r)
+        entry = index.entries[('file03', 0)]
+        del(index.entries[('file05', 0)])
+        del(index.entries[('file19', 0)])
+        index.entries[('file00', 0)] = IndexEntry(entry[:3] + ('file00',) + entry[4:])
+        index.entries[('file10a', 0)] = IndexEntry(entry[:3] + ('file10a',) + entry[4:])
+        copied, serialized = BytesIO(), BytesIO()
+        write_cache_from_map(index.entries, copied, index._extension_data)
+        write_cache(index._entries_sorted(), serialized, index._extension_data)
+        self.assertEqual(copied.getvalue(), serialized.getvalue())
+
+        index.write()
+        ls_files = r.git.ls_files(s=True, v=True).splitlines()
+        self.assertEqual(len(ls_files), 19)
+        self.assertEqual(ls_files[6], 'S ' + r.git.ls_files('file07', s=True))
+        self.assertEqual(ls_files[10], 'H ' + r.git.ls_files('file03', s=True).replace('file03', 'file10a'))
+        self.assertNotIn('file05', r.git.ls_files())
+
+    @with_rw_directory
+    def test_diff_tree_in_process(self, rw_dir):
+        r = Repo.init(rw_dir)
+        for path in ('a/x', 'a/b/y', 'c/z', 'top', 'a.txt', 'a0'):
+            fp = osp.join(rw_dir, path)
+            if not osp.isdir(osp.dirname(fp)):
+                os.makedirs(osp.dirname(fp))
+            with open(fp, 'w') as fs:
+                fs.write(path)
+        # END for each file
+        r.git.add('.')
+        r.git.commit(message='initial')
+        head = r.head.commit
+
+        def assert_diff(num_changes, in_process=True):
+            index = IndexFile(r)
+            res = index.diff('HEAD')
+            self.assertEqual(len(res), num_changes)
+            # a keyword argument enforces git to compute the diff
+            self.assertEqual(list(res), list(index.diff('HEAD', no_ext_diff=True)))
+            self.assertEqual(index._diff_tree(head) is not None, in_process)
+        # END assert helper
+
+        assert_diff(0)
+        with open(osp.join(rw_dir, 'a', 'b', 'y'), 'a') as fs:
+            fs.write('changed')
+        os.chmod(osp.join(rw_dir, 'c', 'z'), 0o755)
+        r.git.add('.')
+        assert_diff(2)
+
+        r.git.rm('a0', 'a/x', cached=True)
+        assert_diff(4)
+
+        with open(osp.join(rw_dir, 'a', 'b', 'new'), 'w') as fs:
+            fs.write('new')
+        r.git.add('a/b/new')
+        assert_diff(5, in_process=False)    # possible renames are left to git
+
+        r.git.reset('a0', 'a/x')
+        assert_diff(3)
+
+        # directories matching their cache tree node are skipped
+        r.git.commit(message='second')
+        head = r.head.commit
+        index = IndexFile(r)
+        self.assertTrue(index._get_cache_tree().valid)
+        entry = index.entries[('a0', 0)]
+        index.entries[('a0', 0)] = IndexEntry(entry[:1] + (head.tree['top'].binsha,) + entry[2:])
+        r.tree_cache.clear()
+        self.assertEqual([(d.change_type, d.a_path) for d in index.diff('HEAD')], [('M', 'a0')])
+        self.assertNotIn(head.tree['a'].binsha, r.tree_cache)
+        self.assertNotIn(head.tree['c'].binsha, r.tree_cache)
+
+    @with_rw_directory
+    def test_write_tree_with_cache_tree(self, rw_dir):
+        r = Repo.init(rw_dir)
+        for i in range(12):
+            dp = osp.join(rw_dir, 'dir%i' % (i % 3), 'sub%i' % (i % 2))
+            if not osp.isdir(dp):
+                os.makedirs(dp)
+            with open(osp.join(dp, 'file%i' % i), 'wb') as fs:
+                fs.write(('content %i' % i).encode('ascii'))
+        # END for each file
+        r.git.add('.')
+        r.index.commit('initial')
+        r.git.read_tree('HEAD')
+
+        index = IndexFile(r)
+        cache_tree = index._get_cache_tree()
+        assert cache_tree is not None and cache_tree.valid
+        self.assertEqual(index.write_tree().binsha, r.head.commit.tree.binsha)
+
+        # changed paths invalidate their subtrees only
+        with open(osp.join(rw_dir, 'dir1', 'sub1', 'file1'), 'wb') as fs:
+            fs.write(b'changed')
+        index.add(['dir1/sub1/file1'], write_extension_data=True)
+        assert not cache_tree.subtrees['dir1'].valid
+        assert cache_tree.subtrees['dir2'].valid
+
+        # the extension written alongside must make git write the same tree
+        tree = index.write_tree()
+        index.write()
+        self.assertEqual(tree.hexsha, r.git.write_tree())
+        assert cache_tree.subtrees['dir1'].subtrees['sub1'].valid
+        self.assertEqual(index.entries.changed_paths, set())
+
+        # cached trees missing in the object database are written again
+        missing = (tree['dir2'], tree['dir2/sub0'])
+        for sub in missing:
+            os.remove(osp.join(r.git_dir, 'objects', sub.hexsha[:2], sub.hexsha[2:]))
+        # the loose object database caches paths of objects it has seen
+        pruned_repo = Repo(rw_dir)
+        pruned_index = IndexFile(pruned_repo)
+        assert pruned_index._get_cache_tree().subtrees['dir2'].subtrees['sub0'].valid
+        self.assertEqual(pruned_index.write_tree().binsha, tree.binsha)
+        for sub in missing:
+            assert pruned_repo.odb.has_object(sub.binsha)
+
+        # without cache tree, changed paths are not recorded
+        index._extension_data = b''
+        index.write()
+        plain_index = IndexFile(r)
+        assert plain_index._get_cache_tree() is None
+        entry = plain_index.entries[('dir0/sub0/file0', 0)]
+        plain_index.entries[('dir0/sub0/file0', 0)] = entry
+        assert plain_index.entries.changed_paths is None
+
+        # replacing the entries dictionary discards the cache tree
+        index.entries = dict(index.entries.items())
+        assert index._get_cache_tree() is None
+        self.assertEqual(index.write_tree().binsha, tree.binsha)
+
+    @with_rw_directory
+    def test_iter_working_tree_changes(self, rw_dir):
+        r = Repo.init(rw_dir)
+        for i in range(6):
+            with open(osp.join(rw_dir, 'file%i' % i), 'wb') as fs:
+                fs.write(('content %i' % i).encode('ascii'))
+        # END for each file
+        r.git.add('.')
+        r.index.commit('initial')
+        assert not list(r.index.iter_working_tree_changes())
+        assert not r.is_dirty()
+
+        # same size changes are found even if they happen while the index is written
+        with open(osp.join(rw_dir, 'file1'), 'wb') as fs:
+            fs.write(b'content X')
+        os.remove(osp.join(rw_dir, 'file2'))
+
+        def changes(**kwargs):
+            return sorted((d.a_path, d.change_type, d.a_blob, d.b_blob, d.a_mode, d.b_mode)
+                          for d in r.index.iter_working_tree_changes(**kwargs))
+        expected = sorted((d.a_path, d.change_type, d.a_blob, d.b_blob, d.a_mode, d.b_mode)
+                          for d in r.index.diff(None))
+        self.assertEqual(len(expected), 2)
+        self.assertEqual(changes(), expected)
+        self.assertEqual(changes(max_threads=2), expected)
+        self.assertEqual(changes(paths=['file2']), expected[1:])
+        assert r.is_dirty()
+        assert not r.is_dirty(path='file3')
+
+        # paths are normalized, and the root includes everything
+        self.assertEqual(changes(paths=['.']), expected)
+        self.assertEqual(changes(paths=['']), expected)
+        self.assertEqual(changes(paths=['./file2']), expected[1:])
+        assert r.is_dirty(index=False, path='.')
+        assert r.is_dirty(index=False, path='./file1')
+
+        os.mkdir(osp.join(rw_dir, 'subdir'))
+        with open(osp.join(rw_dir, 'subdir', 'file'), 'wb') as fs:
+            fs.write(b'content')
+        r.git.add('.')
+        r.index.commit('subdir')
+        assert not r.is_dirty(index=False, path='./subdir')
+        with open(osp.join(rw_dir, 'subdir', 'file'), 'ab') as fs:
+            fs.write(b' changed')
+        assert r.is_dirty(index=False, path='./subdir')
+        assert r.is_dirty(index=False, path='./subdir/')
+        self.assertEqual([d.a_path for d in r.index.iter_working_tree_changes(paths=['./subdir'])],
+                         ['subdir/file'])
+        assert not r.is_dirty(index=False, path='subdir/../file3')
+        assert r.is_dirty(index=False, path='subdir/../subdir')
+
+        # like git, assume-unchanged and skip-worktree entries are not compared
+        r.git.update_index('--assume-unchanged', 'subdir/file')
+        r.git.update_index('--skip-worktree', 'file3')
+        os.remove(osp.join(rw_dir, 'file3'))
+        self.assertEqual(r.git.diff('--name-only', '--', 'subdir', 'file3'), '')
+        self.assertEqual(list(IndexFile(r).iter_working_tree_changes(paths=['subdir', 'file3'])), [])
+        assert not r.is_dirty(index=False, path='subdir')
+
+    @with_rw_directory
+    def test_add_with_threads(self, rw_dir):
+        r = Repo.init(rw_dir)
+        paths = list()
+        for i in range(20):
+            dp = osp.join(rw_dir, 'dir%i' % (i % 4))
+            if not osp.isdir(dp):
+                os.mkdir(dp)
+            paths.append(osp.join('dir%i' % (i % 4), 'file%i' % i))
+            with open(osp.join(rw_dir, paths[-1]), 'wb') as fs:
+                fs.write(('content %i\n' % i).encode('ascii') * i)
+        # END for each file
+
+        serial_progress = list()
+        serial = r.index.add(paths, max_threads=1, write=False,
+                             fprogress=lambda *args: serial_progress.append(args[:2]))
+        threaded_progress = list()
+        threaded = r.index.add(paths, max_threads=4, write=False,
+                               fprogress=lambda *args: threaded_progress.append(args[:2]))
+        self.assertEqual(serial, threaded)
+        self.assertEqual(serial_progress, threaded_progress)
+        for entry in threaded:
+            assert r.odb.has_object(entry.binsha)
+        # END for each entry
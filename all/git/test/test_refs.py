@@ -12,18 +12,24 @@ from git import (
     TagReference,
     RemoteReference,
     Commit,
+    Repo,
     SymbolicReference,
     GitCommandError,
-    RefLog
+    RefLog,
+    RefLogView
 )
 from git.objects.tag import TagObject
 from git.test.lib import (
+    patch,
     TestBase,
-    with_rw_repo
+    fixture_path,
+    with_rw_repo,
+    with_rw_directory
 )
-from git.util import Actor
+from git.util import Actor, bin_to_hex
 
 import git.refs as refs
+import os
 import os.path as osp
 
 
@@ -566,3 +572,146 @@ class TestRefs(TestBase):
 
     def test_reflog(self):
         assert isinstance(self.rorepo.heads.master.log(), RefLog)
+
+    @with_rw_directory
+    def test_packed_refs(self, rw_dir):
+        r = Repo.init(rw_dir)
+        r.index.commit('initial')
+        for i in range(20):
+            r.create_head('branch-%i' % i)
+            r.create_tag('tag-%i' % i, message=(i % 2 and 'annotated' or None))
+        # END for each ref pair
+        r.git.pack_refs(all=True)
+
+        packed_refs = r.packed_refs
+        self.assertTrue(packed_refs.sorted)
+        self.assertIs(r.packed_refs, packed_refs)
+        show_ref = dict(reversed(l.split()) for l in r.git.show_ref().splitlines())
+        self.assertEqual(dict((path, hexsha) for hexsha, path in packed_refs), show_ref)
+        self.assertEqual(len(show_ref), 41)
+        for path, hexsha in show_ref.items():
+            self.assertEqual(packed_refs.lookup(path), hexsha)
+        # END for each ref
+        for path in ('refs/heads', 'refs/heads/branch-', 'refs/tags/tag-99', 'refs/zzz', 'a'):
+            self.assertIsNone(packed_refs.lookup(path))
+        # END for each missing ref
+        self.assertEqual([p for h, p in packed_refs.iter_prefix('refs/tags/')],
+                         sorted(p for p in show_ref if p.startswith('refs/tags/')))
+        self.assertEqual(len(r.tags), 20)
+
+        # changes are picked up, while previous indices stay readable
+        TagReference.delete(r, 'tag-1')
+        self.assertIsNot(r.packed_refs, packed_refs)
+        self.assertIsNone(r.packed_refs.lookup('refs/tags/tag-1'))
+        self.assertIsNotNone(packed_refs.lookup('refs/tags/tag-1'))
+        self.assertEqual(len(r.tags), 19)
+
+        # files without the sorted trait are read entirely
+        packed_refs_path = osp.join(rw_dir, '.git', 'packed-refs')
+        with open(packed_refs_path + '.new', 'w') as fp:
+            fp.write('# pack-refs with: peeled \n%s refs/tags/b\n%s refs/tags/a\n' % (show_ref['refs/tags/tag-2'],
+                                                                                     show_ref['refs/tags/tag-3']))
+        os.rename(packed_refs_path + '.new', packed_refs_path)
+        self.assertFalse(r.packed_refs.sorted)
+        self.assertEqual(r.packed_refs.lookup('refs/tags/a'), show_ref['refs/tags/tag-3'])
+        self.assertEqual([t.name for t in r.tags if not t.name.startswith('tag-')], ['a', 'b'])
+        r.close()
+
+    @with_rw_directory
+    def test_ref_snapshot(self, rw_dir):
+        r = Repo.init(rw_dir)
+        r.index.commit('initial')
+        for i in range(10):
+            r.create_head('branch-%i' % i)
+            r.create_tag('tag-%i' % i, message=(i % 2 and 'annotated' or None))
+        # END for each ref pair
+        r.git.pack_refs(all=True)
+        # loose refs overriding packed ones, and refs only available as loose ones
+        r.create_head('branch-3', 'HEAD', force=True).commit = r.index.commit('second')
+        r.create_head('loose')
+        r.create_tag('loose-tag', ref='tag-1', message='tag of a tag')
+        r.git.symbolic_ref('refs/heads/symbolic', 'refs/heads/loose')
+        r.git.symbolic_ref('refs/heads/dangling', 'refs/heads/nothing')
+
+        show_ref = list()
+        for line in r.git.show_ref(dereference=True).splitlines():
+            hexsha, path = line.split()
+            if path.endswith('^{}'):
+                show_ref[-1] = (show_ref[-1][0], show_ref[-1][1], hexsha)
+            else:
+                show_ref.append((path, hexsha, None))
+        # END for each line
+        snapshot = r.ref_snapshot()
+        self.assertEqual([(p, bin_to_hex(b).decode('ascii'), s and bin_to_hex(s).decode('ascii'))
+                          for p, b, s in snapshot], show_ref)
+        self.assertEqual(len(snapshot), 24)
+        self.assertEqual([record.path for record in r.ref_snapshot('refs/heads/branch-')], [])
+        self.assertEqual([record.peeled for record in r.ref_snapshot('refs/tags', peel=False)
+                          if record.path == 'refs/tags/loose-tag'], [None])
+
+        self.assertEqual([h.name for h in r.heads],
+                         sorted(['branch-%i' % i for i in range(10)] + ['loose', 'master', 'symbolic']))
+        self.assertEqual(r.heads['branch-3'].commit.message, 'second')
+        self.assertEqual(r.heads.symbolic.reference, r.heads.loose)
+        self.assertEqual(len(r.tags), 11)
+
+    @with_rw_directory
+    def test_reflog_view(self, rw_dir):
+        for name in ('reflog_HEAD', 'reflog_master'):
+            path = fixture_path(name)
+            reflog = RefLog.from_file(path)
+            view = RefLogView(path)
+            count = len(reflog)
+            self.assertEqual(len(view), count)
+            self.assertEqual(list(view), list(reflog))
+            self.assertEqual(list(reversed(RefLogView(path))), list(reversed(reflog)))
+
+            # negative indices are read from the end, on a fresh view each time
+            for index in (-1, -2, -count, 0, 1, count - 1):
+                self.assertEqual(RefLogView(path)[index], reflog[index])
+                self.assertEqual(RefLog.entry_at(path, index), reflog[index])
+            # END for each index
+            for index in (-count - 1, count):
+                self.failUnlessRaises(IndexError, RefLogView(path).__getitem__, index)
+                self.failUnlessRaises(IndexError, RefLog.entry_at, path, index)
+            # END for each invalid index
+
+            bounds = (None, -count - 3, -count, -7, -1, 0, 3, count + 5)
+            for start in bounds:
+                for stop in bounds:
+                    for step in (None, 2, -1):
+                        self.assertEqual(RefLogView(path)[start:stop:step], reflog[start:stop:step])
+                    # END for each step
+                # END for each stop
+            # END for each start
+            view.close()
+        # END for each reflog
+
+        # the last line doesn't need a newline
+        data = open(fixture_path('reflog_HEAD'), 'rb').read().rstrip(b'\n')
+        path = osp.join(rw_dir, 'reflog')
+        with open(path, 'wb') as fp:
+            fp.write(data)
+        reflog = RefLog.from_file(fixture_path('reflog_HEAD'))
+        self.assertEqual(list(reversed(RefLogView(path))), list(reversed(reflog)))
+        self.assertEqual(RefLogView(path)[-3:], reflog[-3:])
+
+        # missing reflogs are empty views, but entry_at doesn't find them
+        missing = osp.join(rw_dir, 'missing')
+        self.assertEqual(list(RefLogView(missing)), [])
+        self.assertEqual(RefLogView(missing)[-5:], [])
+        self.failUnlessRaises(IOError, RefLog.entry_at, missing, -1)
+
+        r = Repo.init(osp.join(rw_dir, 'repo'))
+        r.index.commit('initial')
+        r.index.commit('second')
+        self.assertEqual(r.head.log_view()[-1], r.head.log()[-1])
+        self.assertEqual(r.head.log_view()[-1].message, 'second')
+
+        # on windows, the reflog is read into memory, so git may replace it while a view exists
+        with patch.object(refs.log, 'is_win', True):
+            view = r.head.log_view()
+        assert isinstance(view._data, bytes)
+        r.git.reflog('expire', '--expire=now', '--all')
+        self.assertEqual(view[-1].message, 'second')
+        self.assertEqual(len(r.head.log_view()), 0)
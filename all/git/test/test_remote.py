@@ -22,6 +22,7 @@ from git import (
     RemoteReference,
     TagReference,
     Remote,
+    Repo,
     GitCommandError
 )
 from git.cmd import Git
@@ -30,10 +31,12 @@ from git.test.lib import (
     TestBase,
     with_rw_repo,
     with_rw_and_rw_remote_repo,
+    with_rw_directory,
     fixture,
     GIT_DAEMON_PORT,
     assert_raises
 )
+from git.remote import ProgressAggregator
 from git.util import IterableList, rmtree, HIDE_WINDOWS_FREEZE_ERRORS
 import os.path as osp
 
@@ -633,6 +636,59 @@ class TestRemote(TestBase):
         # will raise fatal: Will not delete all non-push URLs
         assert_raises(GitCommandError, remote.delete_url, test3)
 
+    def test_progress_aggregator(self):
+        updates = list()
+        aggregator = ProgressAggregator(lambda *args: updates.append(args))
+        first, second = aggregator.new_progress(), aggregator.new_progress()
+        first._parse_progress_line('Receiving objects:  50% (1/2)')
+        second._parse_progress_line('Receiving objects:  25% (1/4)')
+        first._parse_progress_line('Receiving objects: 100% (2/2), done.')
+        second._parse_progress_line('Receiving objects: 100% (4/4), done.')
+        second._parse_progress_line('Resolving deltas: 1')
+
+        RECEIVING = RemoteProgress.RECEIVING
+        self.assertEqual([args[:3] for args in updates], [
+            (RECEIVING | RemoteProgress.BEGIN, 1.0, 2.0),
+            (RECEIVING, 2.0, 6.0),
+            (RECEIVING, 3.0, 6.0),
+            (RECEIVING | RemoteProgress.END, 6.0, 6.0),
+            (RemoteProgress.RESOLVING | RemoteProgress.BEGIN, 1.0, None),
+        ])
+
+    @with_rw_directory
+    def test_fetch_all(self, rw_dir):
+        source = Repo.init(osp.join(rw_dir, 'source'))
+        source.index.commit('initial')
+        other_source = Repo.init(osp.join(rw_dir, 'other_source'))
+        other_source.index.commit('initial')
+
+        repos = list()
+        for name in ('first', 'second', 'third'):
+            repo = Repo.init(osp.join(rw_dir, name))
+            repo.create_remote('origin', source.git_dir)
+            repo.create_remote('other', other_source.git_dir)
+            repos.append(repo)
+        # END for each repository
+
+        updates = list()
+        for max_threads in (1, 3):
+            results = repos[0].fetch_all(repos=repos[1:] + repos[:1], max_threads=max_threads,
+                                         progress=lambda *args: updates.append(args))
+            self.assertEqual([(remote.repo, remote.name) for remote, infos in results],
+                             [(repo, name) for repo in repos for name in ('origin', 'other')])
+            for remote, infos in results:
+                assert isinstance(infos, IterableList)
+                for info in infos:
+                    assert isinstance(info, FetchInfo)
+                assert remote.refs.master.commit == (remote.name == 'origin' and source or other_source).head.commit
+            # END for each result
+
+            results = repos[0].fetch_all(['other'], repos=repos[1:], max_threads=max_threads)
+            self.assertEqual([remote.name for remote, infos in results], ['other'] * 3)
+        # END for each amount of threads
+
+        self.assertRaises(ValueError, repos[0].fetch_all, ['missing'])
+
     def test_fetch_error(self):
         rem = self.rorepo.remote('origin')
         with self.assertRaisesRegex(GitCommandError, "Couldn't find remote ref __BAD_REF__"):
@@ -11,6 +11,7 @@ import os
 import pickle
 import sys
 import tempfile
+import threading
 try:
     from unittest import skipIf, SkipTest
 except ImportError:
@@ -49,11 +50,13 @@ from git.exc import (
     BadObject,
 )
 from git.repo.fun import touch
+from git.repo.watch import RefWatcher
 from git.test.lib import (
     patch,
     TestBase,
     with_rw_repo,
     fixture,
+    StringProcessAdapter,
     assert_false,
     assert_equal,
     assert_true,
@@ -61,7 +64,7 @@ from git.test.lib import (
 )
 from git.util import HIDE_WINDOWS_KNOWN_ERRORS, cygpath
 from git.test.lib import with_rw_directory
-from git.util import join_path_native, rmtree, rmfile, bin_to_hex
+from git.util import join_path_native, rmtree, rmfile, bin_to_hex, hex_to_bin
 
 import functools as fnt
 import os.path as osp
@@ -413,7 +416,7 @@ class TestRepo(TestBase):
     def test_blame_incremental(self, git):
         # loop over two fixtures, create a test fixture for 2.11.1+ syntax
         for git_fixture in ('blame_incremental', 'blame_incremental_2.11.1_plus'):
-            git.return_value = fixture(git_fixture)
+            git.return_value = StringProcessAdapter(fixture(git_fixture))
             blame_output = self.rorepo.blame_incremental('9debf6b0aafb6f7781ea9d1383c86939a1aacde3', 'AUTHORS')
             blame_output = list(blame_output)
             self.assertEqual(len(blame_output), 5)
@@ -432,6 +435,70 @@ class TestRepo(TestBase):
             orig_ranges = flatten([entry.orig_linenos for entry in blame_output])
             self.assertEqual(orig_ranges, flatten([range(2, 3), range(14, 15), range(1, 2), range(2, 13), range(13, 15)]))   # noqa E501
 
+    @with_rw_directory
+    def test_blame_many(self, rw_dir):
+        r = Repo.init(rw_dir)
+        paths = ['file%i' % i for i in range(4)]
+        for i in range(3):
+            for path in paths:
+                with open(osp.join(rw_dir, path), 'a') as fp:
+                    fp.write('%s line %i\n' % (path, i))
+            # END for each path
+            r.index.add(paths)
+            r.index.commit('commit %i' % i)
+        # END for each commit
+
+        for max_threads in (1, 3, None):
+            blamed = list(r.blame_many('HEAD', paths, max_threads=max_threads))
+            assert [path for path, entries in blamed] == paths
+            for path, entries in blamed:
+                expected = list(r.blame_incremental('HEAD', path))
+                assert [(e.commit, e.linenos, e.orig_path) for e in entries] == \
+                    [(e.commit, e.linenos, e.orig_path) for e in expected]
+            # END for each file
+
+            # all files share the same commit objects
+            commits = set(id(e.commit) for path, entries in blamed for e in entries)
+            assert len(commits) == 3
+        # END for each amount of threads
+
+        # the commit cache may be shared among calls
+        commits = dict()
+        entries = list(r.blame_incremental('HEAD', paths[0], commits=commits))
+        assert len(commits) == 3
+        assert list(r.blame_incremental('HEAD', paths[1], commits=commits))[0].commit is entries[0].commit
+
+        self.assertRaises(GitCommandError, list, r.blame_incremental('HEAD', 'does-not-exist'))
+
+        # files are blamed in a bounded window ahead of the consumer
+        started = list()
+        r.blame_incremental = lambda rev, path, commits=None: started.append(path) or iter(())
+        blamed = r.blame_many('HEAD', ['file%i' % i for i in range(20)], max_threads=2)
+        self.assertEqual(next(blamed), ('file0', []))
+        self.assertLessEqual(len(started), 4)
+        self.assertEqual(len(list(blamed)), 19)
+        self.assertEqual(len(started), 20)
+
+    @patch.object(Git, '_call_process')
+    def test_blame_incremental_stopped_early(self, git):
+        class Process(StringProcessAdapter):
+            killed = False
+
+            def __del__(self):
+                self.killed = True
+        # END process recording whether it was killed
+
+        proc = git.return_value = Process(fixture('blame_incremental'))
+        blame_output = self.rorepo.blame_incremental('9debf6b0aafb6f7781ea9d1383c86939a1aacde3', 'AUTHORS')
+        next(blame_output)
+        assert not proc.killed
+        blame_output.close()
+        assert proc.killed
+
+        proc = git.return_value = Process(fixture('blame_incremental'))
+        self.assertEqual(len(list(self.rorepo.blame_incremental('HEAD', 'AUTHORS'))), 5)
+        assert not proc.killed
+
     @patch.object(Git, '_call_process')
     def test_blame_complex_revision(self, git):
         git.return_value = fixture('blame_complex_revision')
@@ -934,6 +1001,70 @@ class TestRepo(TestBase):
         for i, j in itertools.permutations([c1, 'ffffff', ''], r=2):
             self.assertRaises(GitCommandError, repo.is_ancestor, i, j)
 
+    @with_rw_directory
+    def test_commit_graph(self, rw_dir):
+        r = Repo.init(rw_dir)
+        if r.git.version_info[:3] < (2, 34, 0):
+            raise SkipTest("git commit-graph --split=no-merge unsupported")
+        assert r.commit_graph is None
+
+        empty_tree = r.index.write_tree().hexsha
+
+        def commit(msg, *parents):
+            args = list(itertools.chain(*(('-p', p) for p in parents)))
+            return r.git.commit_tree(empty_tree, '-m', msg, *args, env=dict(GIT_COMMITTER_NAME='c',
+                                                                            GIT_COMMITTER_EMAIL='c@c',
+                                                                            GIT_AUTHOR_NAME='a',
+                                                                            GIT_AUTHOR_EMAIL='a@a'))
+        # END commit helper
+
+        root = commit('root')
+        a1 = commit('a1', root)
+        b1 = commit('b1', root)
+        a2 = commit('a2', a1)
+        c1 = commit('c1', root)
+        criss = commit('criss', a2, b1)
+        cross = commit('cross', b1, a2)
+        octopus = commit('octopus', a2, b1, c1)
+        other_root = commit('other root')
+        r.git.update_ref('refs/heads/master', octopus)
+        r.git.update_ref('refs/heads/criss', criss)
+        r.git.commit_graph('write', '--reachable')
+
+        graph = r.commit_graph
+        assert len(graph) == 7
+        assert r.commit_graph is graph
+        pos = graph.lookup(hex_to_bin(octopus))
+        assert [bin_to_hex(graph.binsha(p)).decode('ascii') for p in graph.parents(pos)] == [a2, b1, c1]
+        assert bin_to_hex(graph.tree(pos)).decode('ascii') == empty_tree
+        assert graph.generation(pos) == graph.generation(graph.lookup(hex_to_bin(a2))) + 1
+        assert graph.lookup(hex_to_bin(cross)) is None
+
+        # cross is not part of the first graph, but of the second layer of the chain
+        for split in (False, True):
+            if split:
+                r.git.update_ref('refs/heads/cross', cross)
+                os.remove(osp.join(r.git_dir, 'objects', 'info', 'commit-graph'))
+                r.git.commit_graph('write', '--reachable', '--split=no-merge')
+                r.git.update_ref('refs/heads/other', other_root)
+                r.git.commit_graph('write', '--reachable', '--split=no-merge')
+                assert len(r.commit_graph.files) == 2
+                assert len(r.commit_graph) == 9
+            # END setup split graph
+
+            commits = (root, a1, b1, a2, c1, criss, cross, octopus, other_root)
+            for x, y in itertools.product(commits, repeat=2):
+                expected = r.git.merge_base(x, y, all=True, with_exceptions=False).split()
+                bases = [c.hexsha for c in r.merge_base(x, y)]
+                assert len(bases) == min(len(expected), 1)
+                assert set(bases) <= set(expected)
+                assert r.is_ancestor(x, y) == (expected == [x])
+            # END for each pair of commits
+        # END for each graph layout
+        assert r.merge_base(criss, cross)[0].hexsha in (a2, b1)
+        self.failUnlessRaises(GitCommandError, r.merge_base, root, 'ffffff')
+        self.failUnlessRaises(GitCommandError, r.is_ancestor, root, 'ffffff')
+
     @with_rw_directory
     def test_git_work_tree_dotgit(self, rw_dir):
         """Check that we find .git as a worktree file and find the worktree
@@ -986,3 +1117,81 @@ class TestRepo(TestBase):
             self.assertEqual(r.working_dir, repo_dir)
         finally:
             os.environ = oldenv
+
+    @with_rw_directory
+    def test_ref_watcher(self, rw_dir):
+        r = Repo.init(rw_dir)
+        r.index.commit('initial')
+        if r.ref_watcher.uses_events:
+            # every poll asks inotify for changes
+            self.assertEqual(r.ref_watcher.min_interval, 0)
+        else:
+            # comparing all files is throttled
+            self.assertEqual(r.ref_watcher.min_interval, RefWatcher.stat_poll_interval)
+            r.ref_watcher.min_interval = 0
+        # END handle platform
+        generation = r.ref_generation
+        self.assertEqual(r.ref_generation, generation)
+
+        notified = list()
+        self.assertEqual(r.subscribe_ref_changes(notified.append), notified.append)
+        for change in (lambda: r.create_head('branch'),
+                       lambda: r.create_tag('tag'),
+                       lambda: r.git.pack_refs(all=True),
+                       lambda: r.head.reset('HEAD', index=True),
+                       lambda: setattr(r.head, 'reference', r.heads.branch)):
+            change()
+            generation += 1
+            self.assertEqual(r.ref_generation, generation)
+        # END for each change
+        self.assertEqual(notified, list(range(generation - 4, generation + 1)))
+        r.ref_watcher.unsubscribe(notified.append)
+
+        # changes between polls are coalesced, as are polls within the minimal interval
+        r.create_head('other')
+        r.create_head('another')
+        r.ref_watcher.min_interval = 3600
+        self.assertEqual(r.ref_watcher.poll(), generation)
+        r.ref_watcher.min_interval = 0
+        self.assertEqual(r.ref_watcher.poll(), generation + 1)
+
+        # polling in the background
+        changed = threading.Event()
+        r.subscribe_ref_changes(lambda generation: changed.set())
+        r.ref_watcher.start(0.01)
+        r.delete_head('other')
+        self.assertTrue(changed.wait(10))
+        r.close()
+        self.assertEqual(len(notified), 5)
+
+        # without inotify, all files are compared on each poll
+        watcher = RefWatcher(r.git_dir, min_interval=0)
+        watcher.close()
+        assert not watcher.uses_events
+        generation = watcher.poll()
+        r.create_head('new/head')
+        self.assertEqual(watcher.poll(), generation + 1)
+        self.assertEqual(watcher.poll(), generation + 1)
+
+    @skipIf(not sys.platform.startswith('linux'), "inotify is only available on linux")
+    @with_rw_directory
+    def test_ref_watcher_events(self, rw_dir):
+        r = Repo.init(rw_dir)
+        r.index.commit('initial')
+        watcher = RefWatcher(r.git_dir)
+        assert watcher.uses_events
+        generation = watcher.poll()
+
+        # references in new directories are noticed, as are changes in them later on
+        r.create_head('feature/one')
+        self.assertEqual(watcher.poll(), generation + 1)
+        r.create_head('feature/two')
+        self.assertEqual(watcher.poll(), generation + 2)
+        r.heads['feature/one'].commit = r.head.commit
+        r.index.commit('second')
+        self.assertEqual(watcher.poll(), generation + 3)
+
+        # without events, the files are not looked at
+        watcher._state = None
+        self.assertEqual(watcher.poll(), generation + 3)
+        watcher.close()
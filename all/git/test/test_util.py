@@ -5,6 +5,7 @@
 # the BSD License: http://www.opensource.org/licenses/bsd-license.php
 
 import tempfile
+import threading
 import time
 try:
     from unittest import skipIf
@@ -32,6 +33,8 @@ from git.util import (
     get_user_id,
     Actor,
     IterableList,
+    RemoteProgress,
+    CallableRemoteProgress,
     cygpath,
     decygpath
 )
@@ -174,6 +177,76 @@ class TestUtils(TestBase):
             extra_time *= 6  # NOTE: Indeterministic failures here...
         self.assertLess(elapsed, wait_time + extra_time)
 
+    def test_blocking_lock_file_wakeup(self):
+        my_file = tempfile.mktemp()
+        lock_file = BlockingLockFile(my_file)
+        lock_file._obtain_lock()
+        stats = BlockingLockFile.contention_stats()
+
+        # the waiter notices the release long before its maximum check interval
+        release_time = 0.05
+        timer = threading.Timer(release_time, lock_file._release_lock)
+        timer.start()
+        start = time.time()
+        wait_lock = BlockingLockFile(my_file, 10, 5)
+        wait_lock._obtain_lock()
+        elapsed = time.time() - start
+        timer.join()
+        assert wait_lock._has_lock()
+        self.assertGreaterEqual(elapsed, release_time * 0.9)
+        self.assertLess(elapsed, 0.5)
+
+        new_stats = BlockingLockFile.contention_stats()
+        self.assertEqual(new_stats['waits'], stats['waits'] + 1)
+        self.assertGreater(new_stats['retries'], stats['retries'])
+        self.assertEqual(new_stats['timeouts'], stats['timeouts'])
+        self.assertGreater(new_stats['wait_time'], stats['wait_time'])
+
+        # uncontended locks are obtained without waiting, timeouts are counted
+        wait_lock._release_lock()
+        lock_file._obtain_lock()
+        self.failUnlessRaises(IOError, BlockingLockFile(my_file, 0.01, 0.02)._obtain_lock)
+        lock_file._release_lock()
+        self.assertEqual(BlockingLockFile.contention_stats()['timeouts'], new_stats['timeouts'] + 1)
+        self.assertEqual(BlockingLockFile.contention_stats()['waits'], new_stats['waits'] + 1)
+
+    def test_progress_parsing(self):
+        updates = list()
+        progress = CallableRemoteProgress(lambda *args: updates.append(args))
+        line = ('remote: Compressing objects:  50% (1/2)   \rremote: Compressing objects: 100% (2/2)\x1b[K\r'
+                'remote: Compressing objects: 100% (2/2), done.\x1b[K')
+        assert progress._parse_progress_line(line) == []
+        assert progress._parse_progress_line('Counting objects: 4, done.') == []
+        assert progress._parse_progress_line('Total 3 (delta 0), reused 0') == ['Total 3 (delta 0), reused 0']
+        self.assertEqual(updates, [
+            (RemoteProgress.COMPRESSING | RemoteProgress.BEGIN, 1.0, 2.0, ''),
+            (RemoteProgress.COMPRESSING, 2.0, 2.0, ''),
+            (RemoteProgress.COMPRESSING | RemoteProgress.END, 2.0, 2.0, ''),
+            (RemoteProgress.COUNTING | RemoteProgress.BEGIN | RemoteProgress.END, 4.0, None, ''),
+        ])
+        assert progress.other_lines == ['Total 3 (delta 0), reused 0']
+
+        # unknown operations are dropped along with the rest of the line
+        assert progress._parse_progress_line('CompreReceiving objects: 10% (1/10)\rCounting objects: 5') == []
+        assert len(updates) == 4
+
+    def test_progress_update_rate(self):
+        updates = list()
+        progress = CallableRemoteProgress(lambda *args: updates.append(args), max_update_rate=1)
+        for i in range(1, 101):
+            progress._parse_progress_line('Receiving objects:  %i%% (%i/100)' % (i, i))
+        progress._parse_progress_line('Resolving deltas:  50% (1/2)')
+        progress._parse_progress_line('Receiving objects: 100% (100/100), done.')
+
+        # the first update of an operation begins it, the one after that is the
+        # only one allowed within a second, and the end is always reported
+        self.assertEqual([(op_code, cur_count) for op_code, cur_count, max_count, message in updates], [
+            (RemoteProgress.RECEIVING | RemoteProgress.BEGIN, 1.0),
+            (RemoteProgress.RECEIVING, 2.0),
+            (RemoteProgress.RESOLVING | RemoteProgress.BEGIN, 1.0),
+            (RemoteProgress.RECEIVING | RemoteProgress.END, 100.0),
+        ])
+
     def test_user_id(self):
         self.assertIn('@', get_user_id())
 
@@ -11,8 +11,11 @@ import os
 import platform
 import subprocess
 import re
+import select
 import shutil
 import stat
+import sys
+import threading
 import time
 try:
     from unittest import SkipTest
@@ -345,6 +348,100 @@ def expand_path(p, expand_vars=True):
     except Exception:
         return None
 
+
+# translation tables marking all control characters with NUL, for unicode and byte strings.
+# Mapping all of ascii keeps unicode.translate() on its fast path
+_control_chars_marks = dict((i, i) for i in range(32, 128))
+_control_chars_marks.update(dict.fromkeys(range(32), 0))
+_control_chars_marks_bytes = b'\x00' * 32 + bytes(bytearray(range(32, 256)))
+
+
+def _cut_control_chars(line):
+    """:return: line up to its first control character, as sent by git if it believes to
+        be writing to a terminal"""
+    if isinstance(line, bytes):
+        marked = line.translate(_control_chars_marks_bytes)
+        index = marked.find(b'\x00')
+    else:
+        marked = line.translate(_control_chars_marks)
+        index = marked.find(u'\x00')
+    # END handle string type
+    if index < 0:
+        return line
+    return line[:index]
+
+
+# inotify functions of the c library, False if unavailable, or None if not loaded yet
+_inotify = None
+_IN_MODIFY = 0x2
+_IN_ATTRIB = 0x4
+_IN_MOVED_FROM = 0x40
+_IN_MOVED_TO = 0x80
+_IN_CREATE = 0x100
+_IN_DELETE = 0x200
+_IN_CLOEXEC = 0o2000000
+_IN_NONBLOCK = 0o4000
+
+
+def _inotify_watch(paths, mask, fd=None):
+    """Watch the given paths for the inotify events in mask
+
+    :param fd: inotify file descriptor to add watches to. Paths which can't be watched
+        are skipped then.
+    :return: file descriptor becoming readable whenever an event occurs, or None if
+        inotify isn't supported on this platform, or if fd was None and a path couldn't
+        be watched. It must be closed with os.close()"""
+    global _inotify
+    if _inotify is None:
+        _inotify = False
+        if sys.platform.startswith('linux'):
+            try:
+                import ctypes
+                import ctypes.util
+                libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+                _inotify = (libc.inotify_init1, libc.inotify_add_watch)
+            except (ImportError, OSError, AttributeError):
+                pass
+        # END load inotify
+    # END handle inotify initialization
+    if not _inotify:
+        return None
+
+    inotify_init1, inotify_add_watch = _inotify
+    new_fd = fd is None
+    if new_fd:
+        fd = inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if fd < 0:
+            return None
+    # END create instance
+    for path in paths:
+        if not isinstance(path, bytes):
+            path = path.encode(sys.getfilesystemencoding())
+        if inotify_add_watch(fd, path, mask) < 0 and new_fd:
+            os.close(fd)
+            return None
+    # END for each path
+    return fd
+
+
+def _wait_for_events(fd, timeout):
+    """Wait at most timeout seconds for events of the given file descriptor, as returned by
+    _inotify_watch(), and consume them. If fd is None, just sleep.
+
+    :return: True if there were events"""
+    if fd is None:
+        time.sleep(timeout)
+        return False
+    if not select.select([fd], [], [], timeout)[0]:
+        return False
+    try:
+        while os.read(fd, 4096):
+            pass
+    except OSError:
+        # no more events
+        pass
+    return True
+
 #} END utilities
 
 #{ Classes
@@ -366,17 +463,73 @@ class RemoteProgress(object):
 
     __slots__ = ('_cur_line',
                  '_seen_ops',
+                 '_update_interval',
+                 '_next_updates',
                  'error_lines',  # Lines that started with 'error:' or 'fatal:'.
                  'other_lines')  # Lines not denoting progress (i.e.g. push-infos).
     re_op_absolute = re.compile(r"(remote: )?([\w\s]+):\s+()(\d+)()(.*)")
     re_op_relative = re.compile(r"(remote: )?([\w\s]+):\s+(\d+)% \((\d+)/(\d+)\)(.*)")
 
-    def __init__(self):
+    # maps the operation names git prints to their operation ids
+    _op_codes = {
+        'Counting objects': COUNTING,
+        'Compressing objects': COMPRESSING,
+        'Writing objects': WRITING,
+        'Receiving objects': RECEIVING,
+        'Resolving deltas': RESOLVING,
+        'Finding sources': FINDING_SOURCES,
+        'Checking out files': CHECKING_OUT,
+    }
+
+    def __init__(self, max_update_rate=None):
+        """Initialize this instance
+
+        :param max_update_rate:
+            if not None, the maximum amount of times per second update() is called
+            for each operation. Progress updates exceeding it are skipped, except for
+            those beginning or ending an operation."""
         self._seen_ops = list()
         self._cur_line = None
+        self._update_interval = max_update_rate and 1.0 / max_update_rate
+        self._next_updates = dict()
         self.error_lines = []
         self.other_lines = []
 
+    def _parse_op(self, sline):
+        """Split the given progress line into its operation and counts.
+
+        :return: tuple(op_code, cur_count, max_count, message) or None if the line doesn't contain progress.
+            op_code is 0 if the operation is unknown."""
+        # Counting objects: 4, done.
+        # remote: Compressing objects:  50% (1/2)
+        op_line = sline
+        if op_line.startswith('remote: '):
+            op_line = op_line[8:]
+        op_name, sep, rest = op_line.partition(':')
+        op_code = self._op_codes.get(op_name)
+        if op_code is not None and rest[:1].isspace():
+            rest = rest.lstrip()
+            percent, sep, tail = rest.partition('% (')
+            if sep and percent.isdigit():
+                counts, sep, message = tail.partition(')')
+                cur_count, slash, max_count = counts.partition('/')
+                if sep and slash and cur_count.isdigit() and max_count.isdigit():
+                    return op_code, cur_count, max_count, message
+            # END handle relative progress
+            message = rest.lstrip('0123456789')
+            if len(message) < len(rest):
+                return op_code, rest[:len(rest) - len(message)], None, message
+        # END fast path
+
+        # Lines of unknown operations or with unusual formatting are left to the regular expressions
+        match = self.re_op_relative.match(sline)
+        if match is None:
+            match = self.re_op_absolute.match(sline)
+        if not match:
+            return None
+        remote, op_name, percent, cur_count, max_count, message = match.groups()  # @UnusedVariable
+        return self._op_codes.get(op_name, 0), cur_count or None, max_count or None, message
+
     def _parse_progress_line(self, line):
         """Parse progress information from the given line as retrieved by git-push
         or git-fetch.
@@ -397,50 +550,19 @@ class RemoteProgress(object):
         sub_lines = line.split('\r')
         failed_lines = list()
         for sline in sub_lines:
-            # find escape characters and cut them away - regex will not work with
+            # find escape characters and cut them away - parsing will not work with
             # them as they are non-ascii. As git might expect a tty, it will send them
-            last_valid_index = None
-            for i, c in enumerate(reversed(sline)):
-                if ord(c) < 32:
-                    # its a slice index
-                    last_valid_index = -i - 1
-                # END character was non-ascii
-            # END for each character in sline
-            if last_valid_index is not None:
-                sline = sline[:last_valid_index]
-            # END cut away invalid part
-            sline = sline.rstrip()
-
-            cur_count, max_count = None, None
-            match = self.re_op_relative.match(sline)
-            if match is None:
-                match = self.re_op_absolute.match(sline)
-
-            if not match:
+            sline = _cut_control_chars(sline).rstrip()
+
+            parsed = self._parse_op(sline)
+            if parsed is None:
                 self.line_dropped(sline)
                 failed_lines.append(sline)
                 continue
-            # END could not get match
-
-            op_code = 0
-            remote, op_name, percent, cur_count, max_count, message = match.groups()  # @UnusedVariable
-
-            # get operation id
-            if op_name == "Counting objects":
-                op_code |= self.COUNTING
-            elif op_name == "Compressing objects":
-                op_code |= self.COMPRESSING
-            elif op_name == "Writing objects":
-                op_code |= self.WRITING
-            elif op_name == 'Receiving objects':
-                op_code |= self.RECEIVING
-            elif op_name == 'Resolving deltas':
-                op_code |= self.RESOLVING
-            elif op_name == 'Finding sources':
-                op_code |= self.FINDING_SOURCES
-            elif op_name == 'Checking out files':
-                op_code |= self.CHECKING_OUT
-            else:
+            # END could not parse line
+
+            op_code, cur_count, max_count, message = parsed
+            if not op_code:
                 # Note: On windows it can happen that partial lines are sent
                 # Hence we get something like "CompreReceiving objects", which is
                 # a blend of "Compressing objects" and "Receiving objects".
@@ -469,6 +591,13 @@ class RemoteProgress(object):
                 op_code |= self.END
                 message = message[:-len(self.DONE_TOKEN)]
             # END end message handling
+
+            if self._update_interval and not op_code & self.STAGE_MASK:
+                now = time.time()
+                if now < self._next_updates.get(op_code, 0):
+                    continue
+                self._next_updates[op_code] = now + self._update_interval
+            # END skip updates exceeding the rate
             message = message.strip(self.TOKEN_SEPARATOR)
 
             self.update(op_code,
@@ -524,9 +653,9 @@ class CallableRemoteProgress(RemoteProgress):
     """An implementation forwarding updates to any callable"""
     __slots__ = ('_callable')
 
-    def __init__(self, fn):
+    def __init__(self, fn, max_update_rate=None):
         self._callable = fn
-        super(CallableRemoteProgress, self).__init__()
+        super(CallableRemoteProgress, self).__init__(max_update_rate)
 
     def update(self, *args, **kwargs):
         self._callable(*args, **kwargs)
@@ -794,16 +923,27 @@ class BlockingLockFile(LockFile):
     """The lock file will block until a lock could be obtained, or fail after
     a specified timeout.
 
+    While waiting, the lock is checked again after exponentially growing intervals,
+    starting at half a millisecond. On linux, inotify wakes waiters up as soon as
+    the lock file is removed.
+
     :note: If the directory containing the lock was removed, an exception will
         be raised during the blocking period, preventing hangs as the lock
         can never be obtained."""
     __slots__ = ("_check_interval", "_max_block_time")
 
+    # interval after the first failed attempt to obtain the lock
+    _initial_check_interval = 0.0005
+
+    # contention totals of all instances, see contention_stats()
+    _contention = dict(waits=0, retries=0, timeouts=0, wait_time=0.0)
+    _contention_lock = threading.Lock()
+
     def __init__(self, file_path, check_interval_s=0.3, max_block_time_s=MAXSIZE):
         """Configure the instance
 
         :parm check_interval_s:
-            Period of time to sleep until the lock is checked the next time.
+            Maximum period of time to sleep until the lock is checked the next time.
             By default, it waits a nearly unlimited time
 
         :parm max_block_time_s: Maximum amount of seconds we may lock"""
@@ -811,33 +951,78 @@ class BlockingLockFile(LockFile):
         self._check_interval = check_interval_s
         self._max_block_time = max_block_time_s
 
+    @classmethod
+    def contention_stats(cls):
+        """:return: dict with totals over all BlockingLockFile instances. 'waits' is the amount
+            of times a lock couldn't be obtained right away, 'retries' the amount of further
+            attempts to obtain it, 'timeouts' the amount of times we gave up, and 'wait_time'
+            the seconds spent waiting"""
+        with cls._contention_lock:
+            return dict(cls._contention)
+
+    def _record_contention(self, retries, wait_time, timeout=False):
+        with self._contention_lock:
+            stats = self._contention
+            stats['waits'] += 1
+            stats['retries'] += retries
+            stats['timeouts'] += int(timeout)
+            stats['wait_time'] += wait_time
+        # END update totals
+
     def _obtain_lock(self):
         """This method blocks until it obtained the lock, or raises IOError if
         it ran out of time or if the parent directory was not available anymore.
         If this method returns, you are guaranteed to own the lock"""
+        try:
+            return super(BlockingLockFile, self)._obtain_lock()
+        except IOError:
+            pass
+        # END fast path
+
         starttime = time.time()
         maxtime = starttime + float(self._max_block_time)
-        while True:
-            try:
-                super(BlockingLockFile, self)._obtain_lock()
-            except IOError:
+        interval = min(self._initial_check_interval, self._check_interval)
+        lock_dir = osp.dirname(self._lock_file_path())
+        watch_fd = None
+        retries = 0
+        try:
+            while True:
                 # synity check: if the directory leading to the lockfile is not
                 # readable anymore, raise an exception
                 curtime = time.time()
-                if not osp.isdir(osp.dirname(self._lock_file_path())):
+                if not osp.isdir(lock_dir):
+                    self._record_contention(retries, curtime - starttime)
                     msg = "Directory containing the lockfile %r was not readable anymore after waiting %g seconds" % (
                         self._lock_file_path(), curtime - starttime)
                     raise IOError(msg)
                 # END handle missing directory
 
                 if curtime >= maxtime:
+                    self._record_contention(retries, curtime - starttime, timeout=True)
                     msg = "Waited %g seconds for lock at %r" % (maxtime - starttime, self._lock_file_path())
                     raise IOError(msg)
                 # END abort if we wait too long
-                time.sleep(self._check_interval)
-            else:
+
+                if watch_fd is None and retries == 0:
+                    # watch before trying again, so a removal right after our first attempt isn't missed
+                    watch_fd = _inotify_watch([lock_dir], _IN_DELETE | _IN_MOVED_FROM)
+                else:
+                    _wait_for_events(watch_fd, min(interval, maxtime - curtime))
+                    interval = min(interval * 2, self._check_interval)
+                # END wait
+
+                retries += 1
+                try:
+                    super(BlockingLockFile, self)._obtain_lock()
+                except IOError:
+                    continue
+                self._record_contention(retries, time.time() - starttime)
                 break
-        # END endless loop
+            # END endless loop
+        finally:
+            if watch_fd is not None:
+                os.close(watch_fd)
+        # END close watch
 
 
 class IterableList(list):
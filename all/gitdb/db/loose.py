@@ -223,7 +223,13 @@ class LooseObjectDB(FileDBBase, ObjectDBR, ObjectDBW):
             obj_path = self.db_path(self.object_path(hexsha))
             obj_dir = dirname(obj_path)
             if not isdir(obj_dir):
-                mkdir(obj_dir)
+                try:
+                    mkdir(obj_dir)
+                except OSError:
+                    # another thread may have created it concurrently
+                    if not isdir(obj_dir):
+                        raise
+                # END handle concurrent creation
             # END handle destination directory
             # rename onto existing doesn't work on windows
             if os.name == 'nt':
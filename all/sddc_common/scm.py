@@ -16,6 +16,7 @@ Branch = namedtuple('Branch', ['name', 'is_published','is_local'])
 
 gname = attrgetter('name')
 del_remote = lambda n:n.split('/',1)[-1]
+ref_names = lambda repo,path:[r.path[len(path)+1:] for r in repo.ref_snapshot(path,peel=False)]
 
 
 class SCMFailure(Exception):
@@ -158,9 +159,9 @@ def branches(repo, local=True, remote=True, excl=forbidden_branches):
 
     repo_check(repo)
 
-    r = [n for n in map(del_remote,map(gname,repo.remote().refs)) if n not in excl] if remote and repo.remotes else []
+    r = [n for n in ref_names(repo,'refs/remotes/'+repo.remote().name) if n not in excl] if remote and repo.remotes else []
 
-    l = [n for n in map(gname,repo.heads) if n not in excl] if local else []
+    l = [n for n in ref_names(repo,'refs/heads') if n not in excl] if local else []
 
     return [Branch(n, is_published=n in r, is_local=n in l) for n in sorted(set(r+l))]
 
@@ -316,6 +317,16 @@ def fetch(repo):
     return repo.git.fetch('origin')
 
 
+def fetch_all(repos, remotes=None, progress=None):
+    """Fetches the remotes of all given repos concurrently."""
+
+    repos = [repo_check(repo) for repo in repos]
+    if not repos:
+        return []
+
+    return repos[0].fetch_all(remotes, repos=repos[1:], progress=progress)
+
+
 def is_empty(repo):
     """Check to see if a repo is empty"""
     